@@ -0,0 +1,134 @@
+import hashlib
+import random
+
+"""
+Random number backends for RNG. Every RNG owns one backend instance, so RNGs
+never share state with each other or with the global `random` module, and
+several of them can run side by side (e.g. in threads) while each stays
+reproducible from its seed.
+
+A backend only has to provide the handful of methods RNG uses, which are the
+ones random.Random already has:
+
+    seed(seed)          reseed the generator
+    randint(a, b)       integer in [a, b], both ends included
+    random()            float in [0.0, 1.0)
+
+Available backends, selected by name with make_backend() (which also takes
+any class implementing the methods above):
+
+    "random"  random.Random (Mersenne Twister), the default
+    "numpy"   numpy.random.Generator, needs numpy installed
+    "pcg64"   a pure Python PCG64 (XSL-RR), reproducible without numpy
+"""
+
+
+def derive_seed(seed, stream_id):
+    # Seed for substream `stream_id` of `seed`. Stable across processes and
+    # python versions, so forked streams are reproducible.
+    digest = hashlib.blake2b(f"{seed}:{stream_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class StdlibBackend(random.Random):
+    name = "random"
+
+
+class NumpyBackend:
+    name = "numpy"
+
+    def __init__(self, seed):
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("the numpy RNG backend requires numpy, install it with `pip install numpy`")
+        self.numpy = numpy
+        self.seed(seed)
+
+    def seed(self, seed):
+        # numpy only takes non negative seeds, negative ones are used as 128
+        # bit two's complement so that every backend accepts the same seeds
+        if seed < 0:
+            seed &= 0xffffffffffffffffffffffffffffffff
+        self.generator = self.numpy.random.Generator(self.numpy.random.PCG64(seed))
+
+    def randint(self, a, b):
+        if a >= 0 and b <= 0xffffffffffffffff:
+            return int(self.generator.integers(a, b, endpoint=True, dtype=self.numpy.uint64))
+        if b - a <= 0xffffffffffffffff:
+            return a + int(self.generator.integers(0, b - a, endpoint=True, dtype=self.numpy.uint64))
+        # wider than 64 bits: rejection sampling over enough 64 bit words
+        n = b - a + 1
+        words = (n.bit_length() + 63) // 64
+        excess = words * 64 - n.bit_length()
+        while True:
+            r = int.from_bytes(self.generator.bit_generator.random_raw(words).tobytes(), "little") >> excess
+            if r < n:
+                return a + r
+
+    def random(self):
+        return float(self.generator.random())
+
+
+class PCG64Backend:
+    name = "pcg64"
+
+    MULTIPLIER = 0x2360ed051fc65da44385df649fccf645
+    MASK64 = 0xffffffffffffffff
+    MASK128 = 0xffffffffffffffffffffffffffffffff
+
+    def __init__(self, seed):
+        self.seed(seed)
+
+    def seed(self, seed):
+        # expand the seed to the 128 bit initial state and stream selector
+        digest = hashlib.sha256(str(seed).encode()).digest()
+        initstate = int.from_bytes(digest[:16], "little")
+        initseq = int.from_bytes(digest[16:], "little")
+        self.state = 0
+        self.inc = ((initseq << 1) | 1) & self.MASK128
+        self.next64()
+        self.state = (self.state + initstate) & self.MASK128
+        self.next64()
+
+    def next64(self):
+        self.state = (self.state * self.MULTIPLIER + self.inc) & self.MASK128
+        state = self.state
+        rot = state >> 122
+        x = ((state >> 64) ^ state) & self.MASK64
+        return ((x >> rot) | (x << ((-rot) & 63))) & self.MASK64
+
+    def getrandbits(self, k):
+        bits = 0
+        for shift in range(0, k, 64):
+            bits |= self.next64() << shift
+        return bits & ((1 << k) - 1)
+
+    def randint(self, a, b):
+        n = b - a + 1
+        k = n.bit_length()
+        r = self.getrandbits(k)
+        while r >= n:
+            r = self.getrandbits(k)
+        return a + r
+
+    def random(self):
+        return (self.next64() >> 11) * (1.0 / (1 << 53))
+
+
+BACKENDS = {
+    StdlibBackend.name: StdlibBackend,
+    NumpyBackend.name: NumpyBackend,
+    PCG64Backend.name: PCG64Backend,
+}
+
+
+def make_backend(name, seed):
+    # `name` can also be a backend class, for backends not listed here
+    if callable(name):
+        return name(seed)
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"unknown RNG backend {name!r}, expected one of {sorted(BACKENDS)}")
+    return backend(seed)
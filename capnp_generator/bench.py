@@ -0,0 +1,336 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+"""
+Generation benchmarks. Each case runs in a fresh process (so startup time and
+peak RSS are its own) and reports machine readable metrics:
+
+    generate:<schema>     StructNode.generate, to_bytes and to_bytes_packed
+                          (messages/s, bytes/s)
+    template:<schema>     TemplateNode.generate_bytes with 16 skeletons and
+                          the default reshape rate (messages/s, bytes/s)
+    startup:<schema>      capnp.load + RootNode, with a cold and a warm
+                          index cache (seconds)
+    rng:<backend>:<what>  RNG.getList/getTextBytes/getBlob for a range of
+                          lengths (items/s, bytes/s)
+
+Schemas are example.capnp and synthetic schemas written to a temporary
+directory, varying field count, nesting depth, union width, list fields and
+import fan-out (see synthetic_schema). List length is varied through the rng
+cases, since StructNode picks its own list lengths.
+
+    python -m capnp_generator.bench --output bench.json
+    python -m capnp_generator.bench --baseline bench.json
+
+With --baseline, every metric is compared against the stored run and the
+exit status is 1 if any got worse by more than --tolerance. Message sizes
+(*_bytes_per_message) and the timings taken only once per run are shown in
+the comparison but never count as a regression.
+"""
+
+EXAMPLE_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "example.capnp")
+
+# name -> synthetic_schema() parameters
+SYNTHETIC = {
+    "flat-8": dict(fields=8),
+    "flat-64": dict(fields=64),
+    "deep-8": dict(fields=4, depth=8),
+    "union-16": dict(fields=4, union_width=16),
+    "lists-8": dict(fields=4, lists=8),
+    "imports-8": dict(fields=4, fanout=8),
+}
+
+PRIMITIVES = ["UInt8", "UInt16", "UInt32", "UInt64", "Int8", "Int16", "Int32", "Int64", "Float32", "Float64", "Bool"]
+LIST_ELEMENTS = ["UInt8", "UInt32", "Float64", "Text", "Data", "Leaf"]
+
+RNG_LENGTHS = [16, 1024, 65536]
+
+
+def _file_id(name):
+    # capnp file ids must have the high bit set
+    digest = hashlib.sha256(name.encode()).digest()
+    return int.from_bytes(digest[:8], "little") | (1 << 63)
+
+
+def synthetic_schema(directory, name, fields=8, depth=1, union_width=0, lists=0, fanout=0):
+    # Writes <name>.capnp (and its imports) to directory. The root type is
+    # Root: `fields` primitive/text/data fields, a chain of `depth` nested
+    # structs, a union of `union_width` arms, `lists` list fields and one
+    # field per imported file.
+    lines = [f"@{_file_id(name):#x};", ""]
+    for i in range(fanout):
+        imported = f"{name}_import{i}"
+        with open(os.path.join(directory, imported + ".capnp"), "w") as f:
+            f.write(f"@{_file_id(imported):#x};\n\nstruct Imported{i} {{\n  a @0 :UInt32;\n  b @1 :Text;\n}}\n")
+        lines.append(f'using I{i} = import "{imported}.capnp";')
+    lines.append("")
+    lines.append("struct Leaf {\n  a @0 :UInt64;\n  b @1 :Text;\n}")
+    for level in range(depth - 1, 0, -1):
+        child = f"Nested{level + 1}" if level + 1 < depth else "Leaf"
+        lines.append(f"struct Nested{level} {{\n  value @0 :Int32;\n  child @1 :{child};\n}}")
+
+    body = []
+    ordinal = 0
+
+    def add(line):
+        nonlocal ordinal
+        body.append(line.replace("@N", f"@{ordinal}"))
+        ordinal += 1
+
+    for i in range(fields):
+        kind = (PRIMITIVES + ["Text", "Data"])[i % (len(PRIMITIVES) + 2)]
+        add(f"  f{i} @N :{kind};")
+    if depth > 1:
+        add("  nested @N :Nested1;")
+    for i in range(lists):
+        add(f"  l{i} @N :List({LIST_ELEMENTS[i % len(LIST_ELEMENTS)]});")
+    for i in range(fanout):
+        add(f"  i{i} @N :I{i}.Imported{i};")
+    if union_width:
+        body.append("  choice :union {")
+        for i in range(union_width):
+            kind = "Leaf" if i % 2 else PRIMITIVES[i % len(PRIMITIVES)]
+            add(f"    u{i} @N :{kind};")
+        body.append("  }")
+    lines.append("struct Root {\n" + "\n".join(body) + "\n}")
+
+    path = os.path.join(directory, name + ".capnp")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+
+def _load(path):
+    import capnp
+    from .node import _capnp_search_path
+    return capnp.SchemaParser().load(path, imports=_capnp_search_path())
+
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _timed(fn, min_time):
+    # Calls fn() until min_time passed, returns (calls, seconds, last result)
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        result = fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return calls, elapsed, result
+
+
+def bench_generate(path, type_name, min_time):
+    from .node import RootNode, StructNode
+    from .rng import RNG
+    root_node = RootNode(_load(path))
+    node = StructNode(root_node.structs_by_name[type_name], root_node, RNG(1, 1000))
+    # every message is dropped once serialized, so peak RSS is the
+    # generator's and not the benchmark's; each phase is timed on its own
+    perf_counter = time.perf_counter
+    times = {"generate": 0.0, "to_bytes": 0.0, "to_bytes_packed": 0.0}
+    sizes = {"to_bytes": 0, "to_bytes_packed": 0}
+    count = 0
+    start = perf_counter()
+    while perf_counter() - start < min_time or not count:
+        t0 = perf_counter()
+        msg = node.generate()
+        t1 = perf_counter()
+        sizes["to_bytes"] += len(msg.to_bytes())
+        t2 = perf_counter()
+        # serialize the same message again on purpose
+        msg.clear_write_flag()
+        t3 = perf_counter()
+        sizes["to_bytes_packed"] += len(msg.to_bytes_packed())
+        t4 = perf_counter()
+        del msg
+        times["generate"] += t1 - t0
+        times["to_bytes"] += t2 - t1
+        times["to_bytes_packed"] += t4 - t3
+        count += 1
+    result = {
+        "generate_messages_per_s": count / times["generate"],
+    }
+    for name in ("to_bytes", "to_bytes_packed"):
+        result[f"{name}_messages_per_s"] = count / times[name]
+        result[f"{name}_bytes_per_s"] = sizes[name] / times[name]
+        result[f"{name}_bytes_per_message"] = sizes[name] / count
+    result["generate_bytes_per_s"] = result["generate_messages_per_s"] * result["to_bytes_bytes_per_message"]
+    return result
+
+
+def bench_template(path, type_name, min_time):
+    from .node import RootNode, StructNode
+    from .rng import RNG
+    from .template import TemplateNode
+    root_node = RootNode(_load(path))
+    node = TemplateNode(StructNode(root_node.structs_by_name[type_name], root_node, RNG(1, 1000)))
+    size = 0
+    calls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time or not calls:
+        size += len(node.generate_bytes())
+        calls += 1
+    elapsed = time.perf_counter() - start
+    return {
+        "generate_messages_per_s": calls / elapsed,
+        "generate_bytes_per_s": size / elapsed,
+    }
+
+
+def bench_startup(path, min_time):
+    from .node import RootNode
+    result = {}
+    start = time.perf_counter()
+    schema = _load(path)
+    result["load_s"] = time.perf_counter() - start
+    calls, elapsed, _ = _timed(lambda: RootNode(schema), min_time)
+    result["root_node_s"] = elapsed / calls
+    with tempfile.TemporaryDirectory(prefix="capnp_generator_bench_") as cache_dir:
+        start = time.perf_counter()
+        RootNode(schema, cache_dir=cache_dir)
+        result["root_node_cold_cache_s"] = time.perf_counter() - start
+        calls, elapsed, _ = _timed(lambda: RootNode(schema, cache_dir=cache_dir), min_time)
+        result["root_node_warm_cache_s"] = elapsed / calls
+    return result
+
+
+def bench_rng(backend, what, min_time):
+    from .rng import RNG
+    rng = RNG(1, 1000, backend=backend)
+    result = {}
+    for length in RNG_LENGTHS:
+        if what == "text":
+            fn = lambda: rng.getTextBytes(length)
+        elif what == "blob":
+            fn = lambda: rng.getBlob(length)
+        else:
+            fn = lambda: rng.getList(what, length)
+        calls, elapsed, value = _timed(fn, min_time)
+        result[f"len{length}_items_per_s"] = calls * length / elapsed
+        if what in ("text", "blob"):
+            result[f"len{length}_bytes_per_s"] = calls * len(value) / elapsed
+    return result
+
+
+def _run_case(case):
+    # entry point of the per-case worker process
+    name, fn, args = case
+    process_start = time.perf_counter()
+    result = globals()[fn](*args)
+    result["peak_rss_bytes"] = _peak_rss()
+    result["case_s"] = time.perf_counter() - process_start
+    return name, result
+
+
+def cases(directory, min_time, backends):
+    yield ("generate:example", "bench_generate", (EXAMPLE_SCHEMA, "Person", min_time))
+    yield ("template:example", "bench_template", (EXAMPLE_SCHEMA, "Person", min_time))
+    yield ("startup:example", "bench_startup", (EXAMPLE_SCHEMA, min_time))
+    for name, params in SYNTHETIC.items():
+        path = synthetic_schema(directory, name.replace("-", "_"), **params)
+        yield (f"generate:{name}", "bench_generate", (path, "Root", min_time))
+        yield (f"template:{name}", "bench_template", (path, "Root", min_time))
+        yield (f"startup:{name}", "bench_startup", (path, min_time))
+    for backend in backends:
+        for what in ("uint8", "uint32", "float64", "text", "blob"):
+            yield (f"rng:{backend}:{what}", "bench_rng", (backend, what, min_time))
+
+
+def run(min_time=1.0, only=None, backends=("random",)):
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    # holds the synthetic schemas
+    with tempfile.TemporaryDirectory(prefix="capnp_generator_bench_") as directory:
+        for case in cases(directory, min_time, backends):
+            if only and not any(pattern in case[0] for pattern in only):
+                continue
+            with context.Pool(1) as pool:
+                name, result = pool.apply(_run_case, (case,))
+            results[name] = result
+            print(f"{name}: " + ", ".join(f"{k}={v:.4g}" for k, v in result.items()), file=sys.stderr)
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "min_time": min_time,
+        "results": results,
+    }
+
+
+# metrics that are timed once per run, too noisy to fail a comparison on
+SINGLE_SHOT = ("case_s", "load_s", "root_node_cold_cache_s")
+
+
+def _higher_is_better(metric):
+    return metric.endswith("_per_s")
+
+
+def _informational(metric):
+    # Reported by compare() but never counted as a regression: message sizes
+    # aren't a speed, and single shot timings are mostly noise
+    return metric.endswith("_bytes_per_message") or metric in SINGLE_SHOT
+
+
+def compare(report, baseline, tolerance):
+    # Returns (lines, regressions) comparing report against baseline
+    lines = []
+    regressions = 0
+    for name, metrics in report["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        for metric, value in metrics.items():
+            if metric not in old or not old[metric]:
+                continue
+            ratio = value / old[metric]
+            if _informational(metric):
+                worse = False
+            elif _higher_is_better(metric):
+                worse = ratio < 1 - tolerance
+            else:
+                worse = ratio > 1 + tolerance
+            regressions += worse
+            lines.append(f"{'REGRESSION ' if worse else ''}{name} {metric}: {old[metric]:.4g} -> {value:.4g} ({ratio:.2f}x)")
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark capnp_generator")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against results stored with --output")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative slowdown (default 0.1)")
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds to run each measurement")
+    parser.add_argument("--filter", action="append", help="only run cases whose name contains this")
+    parser.add_argument("--backend", action="append", help="RNG backends for the rng cases (default: random)")
+    args = parser.parse_args(argv)
+
+    report = run(args.min_time, args.filter, args.backend or ["random"])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(report, baseline, args.tolerance)
+        print("\n".join(lines), file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
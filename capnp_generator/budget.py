@@ -0,0 +1,146 @@
+"""
+Generation budgets. By default nothing limits how large a generated message
+gets: list lengths, text sizes and the nesting of structs are whatever the
+RNG draws. A Budget caps a message's total size in words, the nesting depth
+of structs, the length of each list and the number of list elements across
+the whole message. StructNode(..., budget=Budget(...)) keeps every message
+within it by shrinking the lengths it draws and by leaving struct fields and
+lists null once there is no room left for them (union members are still
+selected, as empty structs, so the message stays valid).
+
+The lengths are still drawn from the RNG and then clamped, so a budgeted
+node generates the same messages for the same seed every time. Sizes follow
+the wire format (see https://capnproto.org/encoding.html) closely enough to
+keep memory predictable. max_words is not a hard limit, though: a selected
+union member struct that doesn't fit is still created, empty, so a message
+can exceed max_words by the sum of the fixed sizes (data and pointer words)
+of every such struct in it, at most one per union in the message.
+"""
+
+# bits per list element of each primitive type
+ELEMENT_BITS = {
+    "void": 0, "bool": 1,
+    "uint8": 8, "int8": 8,
+    "uint16": 16, "int16": 16,
+    "uint32": 32, "int32": 32, "float32": 32,
+    "uint64": 64, "int64": 64, "float64": 64,
+}
+
+
+class Budget:
+    # Any limit left as None is not enforced. max_depth counts struct levels
+    # below the root: with max_depth=0 no struct field or struct list of the
+    # root type is generated.
+    __slots__ = ("max_words", "max_depth", "max_list_length", "max_elements")
+
+    def __init__(self, max_words=None, max_depth=None, max_list_length=None, max_elements=None):
+        self.max_words = max_words
+        self.max_depth = max_depth
+        self.max_list_length = max_list_length
+        self.max_elements = max_elements
+
+    def to_dict(self):
+        # Budget(**budget.to_dict()) is the same budget
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def start(self, plan):
+        # Usage of a new message with root struct `plan`
+        return Usage(self, 1 + plan.data_words + plan.pointer_words)
+
+    def __repr__(self):
+        return (f"Budget(max_words={self.max_words}, max_depth={self.max_depth}, "
+                f"max_list_length={self.max_list_length}, max_elements={self.max_elements})")
+
+
+class Usage:
+    # What one message has used up of its budget so far. depth is maintained
+    # by the generator around every nested struct.
+    __slots__ = ("budget", "words", "elements", "depth")
+
+    def __init__(self, budget, words=0):
+        self.budget = budget
+        self.words = words
+        self.elements = 0
+        self.depth = 0
+
+    def _words_left(self):
+        if self.budget.max_words is None:
+            return None
+        return max(self.budget.max_words - self.words, 0)
+
+    def struct(self, plan):
+        # Whether a struct of type `plan` fits one level below the current
+        # depth. If so its words are charged.
+        max_depth = self.budget.max_depth
+        if max_depth is not None and self.depth >= max_depth:
+            return False
+        size = plan.data_words + plan.pointer_words
+        left = self._words_left()
+        if left is not None and size > left:
+            return False
+        self.words += size
+        return True
+
+    def empty_struct(self, plan):
+        # Charges a struct that is there but left empty (a selected union
+        # member that didn't fit), whether it fits or not. This is how a
+        # message ends up over max_words.
+        self.words += plan.data_words + plan.pointer_words
+
+    def blob(self, length):
+        # Byte length a data field of `length` bytes is shrunk to
+        left = self._words_left()
+        if left is not None:
+            length = min(length, left * 8)
+        self.words += (length + 7) // 8
+        return length
+
+    def text(self, length):
+        # Same as blob() for a text field, which is stored with an extra NUL.
+        # None if not even that fits, and the text has to stay null.
+        left = self._words_left()
+        if left is not None:
+            if left < 1:
+                return None
+            length = min(length, left * 8 - 1)
+        self.words += (length + 8) // 8
+        return length
+
+    def list(self, element, length):
+        # Number of elements a list of `element` (a FieldOp) drawn with
+        # `length` elements is shrunk to, or None if the list has to stay
+        # null. The list itself is charged, its elements' contents are
+        # charged as they are generated.
+        budget = self.budget
+        if budget.max_list_length is not None:
+            length = min(length, budget.max_list_length)
+        if budget.max_elements is not None:
+            length = min(length, max(budget.max_elements - self.elements, 0))
+        kind = element.kind
+        if kind == "struct":
+            if budget.max_depth is not None and self.depth >= budget.max_depth:
+                return None
+            size = element.plan.data_words + element.plan.pointer_words
+            left = self._words_left()
+            if left is not None:
+                # even an empty struct list takes a word for its tag
+                if left < 1:
+                    return None
+                if size:
+                    length = min(length, (left - 1) // size)
+            words = 1 + length * size
+        elif kind in ("text", "data", "list"):
+            left = self._words_left()
+            if left is not None:
+                length = min(length, left)
+            words = length
+        else:
+            # primitives and enums
+            bits = ELEMENT_BITS.get(element.typestring, 16)
+            left = self._words_left()
+            if left is not None and bits:
+                length = min(length, left * 64 // bits)
+            words = (length * bits + 63) // 64
+        self.words += words
+        self.elements += length
+        return length
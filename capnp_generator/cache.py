@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+
+"""
+On-disk cache of RootNode indexes. Loading a schema, indexing every nested
+type, crawling the imports and compiling the generation plans is repeated by
+every process that builds a RootNode. RootNode(schema, cache_dir=...) stores
+the result of all that here, and a later process can rebuild the same state
+by looking types up directly instead of walking the schema.
+
+Entries are stored per schema file (by canonical path), and carry a key made
+from the content hashes of the schema file and every file it imports. An
+entry is only used if that key still matches the files on disk, so editing
+any of them invalidates it.
+"""
+
+CACHE_VERSION = 4
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def index_key(path, import_paths):
+    digest = hashlib.sha256()
+    for p in [path] + sorted(import_paths):
+        digest.update(p.encode())
+        digest.update(file_digest(p).encode())
+    return digest.hexdigest()
+
+
+def _entry_path(cache_dir, path):
+    name = hashlib.sha256(os.path.realpath(path).encode()).hexdigest()
+    return os.path.join(cache_dir, name + ".json")
+
+
+def load_index(cache_dir, path):
+    # Returns the cached index for the schema file at `path`, or None if there
+    # is none or it is out of date.
+    try:
+        with open(_entry_path(cache_dir, path), "r") as f:
+            index = json.load(f)
+        if index.get("version") != CACHE_VERSION:
+            return None
+        import_paths = [import_path for _, import_path, _ in index["imports"]]
+        if index_key(os.path.realpath(path), import_paths) != index["key"]:
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return index
+
+
+def save_index(cache_dir, path, index):
+    path = os.path.realpath(path)
+    import_paths = [import_path for _, import_path, _ in index["imports"]]
+    index = dict(index, version=CACHE_VERSION, key=index_key(path, import_paths))
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = _entry_path(cache_dir, path)
+    tmp = f"{entry}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp, entry)
@@ -0,0 +1,232 @@
+import argparse
+import json
+import multiprocessing
+import os
+from array import array
+import capnp
+from .backends import derive_seed
+from .budget import Budget
+from .dedup import deduplicator_for, iter_distinct, write_indices
+from .node import RootNode, StructNode, _capnp_search_path
+from .rng import RNG
+from .stream import MessageWriter, stream_messages
+from .template import TemplateNode
+
+"""
+Corpus generation across a process pool. A corpus of `count` messages of one
+root type is split into shards; shard k is generated by its own worker from
+an RNG seeded with derive_seed(master_seed, k), and written to its own file
+as a stream of standard segment framed (optionally packed) messages. With a
+budget (see budget.py) every message is kept within the given size limits,
+so each worker's memory use stays bounded. The manifest written next to the
+shards records everything needed to regenerate any message of the corpus
+from the master seed, see regenerate_message().
+Each shard's RNG reseeds itself every `step` messages (see RNG.advance), so
+regenerating a message takes at most `step` messages worth of work, however
+large the shard. With templates, messages are built from skeletons (see
+template.py), which is recorded in the manifest as well.
+
+With dedup, a shard only keeps the messages whose shape is new to it (see
+dedup.py), and the index of each kept message within the shard's run is
+written next to it (shard["indices"], read with read_indices()). Message
+indices (`count`, regenerate_message()) are still those of the messages
+generated, kept or not. Duplicates are only dropped within a shard.
+
+Since the seeds depend only on the master seed and the shard index, for a
+given number of shards the output is the same no matter how many processes
+are used.
+"""
+
+MANIFEST_NAME = "manifest.json"
+
+# messages between RNG checkpoints, see RNG.advance
+DEFAULT_STEP = 1000
+
+
+def shard_sizes(count, shards):
+    base, extra = divmod(count, shards)
+    return [base + (1 if i < extra else 0) for i in range(shards)]
+
+
+def shard_filename(index, packed):
+    return f"shard-{index:05d}.{'capnp.packed' if packed else 'capnp'}"
+
+
+def _load_root(schema_path, cache_dir):
+    # A private parser, so this works even if the caller already loaded the
+    # same file under another path through the global one.
+    schema = capnp.SchemaParser().load(schema_path, imports=_capnp_search_path())
+    return RootNode(schema, cache_dir=cache_dir)
+
+
+def _generate_shard(job):
+    # Runs in a worker process: modules can't be pickled, so every worker
+    # loads the schema itself.
+    schema_path, type_name, seed, count, path, packed, backend, cache_dir, budget, step, templates, dedup = job
+    root_node = _load_root(schema_path, cache_dir)
+    rng = RNG(seed, step, backend=backend)
+    node = _make_node(root_node, type_name, rng, budget, templates)
+    if dedup is None:
+        with open(path, "wb", buffering=0) as out:
+            _, size = stream_messages(node, out, count, packed)
+        return size, count
+    deduplicator = deduplicator_for(node, **dedup)
+    indices = array("Q")
+    with open(path, "wb", buffering=0) as out:
+        with MessageWriter(out, packed) as writer:
+            for index, data in iter_distinct(node, deduplicator, count, packed):
+                writer.write_bytes(data)
+                indices.append(index)
+    with open(_indices_path(path), "wb") as out:
+        write_indices(out, indices)
+    return writer.bytes, len(indices)
+
+
+def _indices_path(shard_path):
+    return shard_path.rpartition(".capnp")[0] + ".indices"
+
+
+def _make_node(root_node, type_name, rng, budget, templates):
+    # templates is None or the TemplateNode parameters as a dict
+    node = StructNode(root_node.structs_by_name[type_name], root_node, rng, budget=budget)
+    if templates is not None:
+        node = TemplateNode(node, **templates)
+    return node
+
+
+def generate_corpus(schema_path, type_name, master_seed, count, out_dir, shards=None, processes=None, packed=False, backend="random", cache_dir=None, budget=None, step=DEFAULT_STEP, templates=None, dedup=None):
+    # templates is a dict of TemplateNode parameters (templates,
+    # reshape_rate) to build messages from skeletons, or None. dedup is a
+    # dict of deduplicator_for() parameters (capacity, bloom, error_rate)
+    # to only keep messages of new shapes, or None.
+    # Generates the corpus into out_dir and returns the manifest
+    processes = processes or os.cpu_count() or 1
+    shards = shards or processes
+    schema_path = os.path.realpath(schema_path)
+    os.makedirs(out_dir, exist_ok=True)
+
+    manifest = {
+        "schema": schema_path,
+        "type": type_name,
+        "master_seed": master_seed,
+        "count": count,
+        "packed": packed,
+        "backend": backend,
+        "budget": budget.to_dict() if budget is not None else None,
+        "step": step,
+        "templates": templates,
+        "dedup": dedup,
+        "shards": [],
+    }
+    jobs = []
+    first = 0
+    for index, size in enumerate(shard_sizes(count, shards)):
+        seed = derive_seed(master_seed, index)
+        filename = shard_filename(index, packed)
+        shard = {"index": index, "seed": seed, "first": first, "count": size, "file": filename}
+        if dedup is not None:
+            shard["indices"] = os.path.basename(_indices_path(filename))
+        manifest["shards"].append(shard)
+        jobs.append((schema_path, type_name, seed, size, os.path.join(out_dir, filename), packed, backend, cache_dir, budget, step, templates, dedup))
+        first += size
+
+    if processes == 1:
+        results = [_generate_shard(job) for job in jobs]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_generate_shard, jobs, chunksize=1)
+    for shard, (size, kept) in zip(manifest["shards"], results):
+        shard["bytes"] = size
+        if dedup is not None:
+            shard["kept"] = kept
+
+    with open(os.path.join(out_dir, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def _find_shard(manifest, index):
+    for shard in manifest["shards"]:
+        if shard["first"] <= index < shard["first"] + shard["count"]:
+            return shard
+    raise IndexError(f"message {index} is not part of this corpus ({manifest['count']} messages)")
+
+
+def regenerate_messages(manifest, start, stop, cache_dir=None):
+    # Yields messages start..stop-1 of the corpus described by `manifest`
+    # (the dict returned by generate_corpus or loaded from manifest.json).
+    if start >= stop:
+        return
+    root_node = _load_root(manifest["schema"], cache_dir)
+    budget = manifest.get("budget")
+    budget = Budget(**budget) if budget is not None else None
+    index = start
+    while index < stop:
+        shard = _find_shard(manifest, index)
+        rng = RNG(shard["seed"], manifest.get("step", DEFAULT_STEP), backend=manifest["backend"])
+        node = _make_node(root_node, manifest["type"], rng, budget, manifest.get("templates"))
+        yield node.generate_at(index - shard["first"])
+        index += 1
+        while index < min(stop, shard["first"] + shard["count"]):
+            yield node.generate()
+            index += 1
+
+
+def regenerate_message(manifest, index, cache_dir=None):
+    # Rebuild message `index` of the corpus described by `manifest`
+    _find_shard(manifest, index)
+    return next(regenerate_messages(manifest, index, index + 1, cache_dir))
+
+
+def add_budget_arguments(parser):
+    parser.add_argument("--max-words", type=int, default=None, help="size limit of each message in 8 byte words")
+    parser.add_argument("--max-depth", type=int, default=None, help="struct nesting limit of each message")
+    parser.add_argument("--max-list-length", type=int, default=None, help="length limit of each list")
+    parser.add_argument("--max-elements", type=int, default=None, help="limit on list elements per message")
+
+
+def budget_from_args(args):
+    # Budget for the add_budget_arguments() options, None if none were given
+    limits = (args.max_words, args.max_depth, args.max_list_length, args.max_elements)
+    return Budget(*limits) if any(limit is not None for limit in limits) else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="generate a sharded corpus of random capnp messages")
+    parser.add_argument("schema", help="capnp schema file")
+    parser.add_argument("type", help="name of the root struct type")
+    parser.add_argument("seed", type=lambda s: int(s, 0), help="master seed")
+    parser.add_argument("count", type=int, help="number of messages")
+    parser.add_argument("out_dir", help="directory for the shards and manifest")
+    parser.add_argument("--shards", type=int, default=None, help="number of shards (default: one per process)")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes (default: cpu count)")
+    parser.add_argument("--packed", action="store_true", help="write packed messages")
+    parser.add_argument("--backend", default="random", help="RNG backend (random, numpy, pcg64)")
+    parser.add_argument("--cache-dir", default=None, help="schema index cache directory")
+    parser.add_argument("--step", type=int, default=DEFAULT_STEP, help=f"messages between RNG checkpoints (default {DEFAULT_STEP})")
+    parser.add_argument("--templates", type=int, default=None, help="build messages from this many cached skeletons")
+    parser.add_argument("--reshape-rate", type=float, default=0.01, help="probability of a new skeleton per message with --templates (default 0.01)")
+    parser.add_argument("--dedup", action="store_true", help="only keep messages of shapes not seen before in their shard")
+    parser.add_argument("--dedup-capacity", type=int, default=1 << 20, help="shapes remembered per shard with --dedup (default 2**20)")
+    parser.add_argument("--bloom", type=float, default=None, metavar="ERROR_RATE", help="remember shapes in a Bloom filter with this false positive rate")
+    add_budget_arguments(parser)
+    args = parser.parse_args(argv)
+    templates = dict(templates=args.templates, reshape_rate=args.reshape_rate) if args.templates else None
+    dedup = None
+    if args.dedup:
+        dedup = dict(capacity=args.dedup_capacity, bloom=args.bloom is not None, error_rate=args.bloom or 0.001)
+    manifest = generate_corpus(
+        args.schema, args.type, args.seed, args.count, args.out_dir,
+        shards=args.shards, processes=args.processes, packed=args.packed,
+        backend=args.backend, cache_dir=args.cache_dir, budget=budget_from_args(args),
+        step=args.step, templates=templates, dedup=dedup
+    )
+    if dedup is not None:
+        kept = sum(shard["kept"] for shard in manifest["shards"])
+        print(f"kept {kept} of {manifest['count']} messages in {len(manifest['shards'])} shards in {args.out_dir}")
+    else:
+        print(f"wrote {manifest['count']} messages in {len(manifest['shards'])} shards to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
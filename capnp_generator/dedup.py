@@ -0,0 +1,267 @@
+import hashlib
+import math
+import struct
+import sys
+from array import array
+from .inplace import ELEMENT_COMPOSITE, ELEMENT_POINTER, composite_tag, iter_frames, resolve_pointer
+from .stream import iter_messages
+from .template import TemplateNode
+
+"""
+Deduplication of generated messages by shape. Small types and low entropy
+fields make many messages equivalent for a fuzzer, so instead of comparing
+bytes, ShapeHasher fingerprints a serialized message by its structure alone:
+the union arm chosen in every struct, which pointers are null, the length of
+every list, text and data (bucketed, see length_bucket) and every enum
+value. Primitive values and the contents of text and data are left out. The
+message is walked in its wire format like template.py does, with the
+generation plans (see plan.py), so nothing is built through pycapnp.
+
+A Deduplicator keeps the fingerprints seen so far in a FingerprintSet, which
+is exact but forgets the oldest fingerprints once it holds `capacity`, or in
+a BloomFilter, which is smaller for the same capacity but takes a message
+for a duplicate with probability error_rate even if its shape is new.
+
+    dedup = Deduplicator(node.plan, FingerprintSet(1 << 20))
+    for index, data in iter_distinct(node, dedup, count=100000):
+        ...
+
+iter_distinct() yields the index of each message in the run along with it,
+which is what regenerating it takes (see StructNode.generate_at). Corpora
+generated with dedup (see corpus.py) store those indices next to each shard,
+see read_indices().
+"""
+
+_uint16 = struct.Struct("<H")
+
+# tokens of pointers that aren't followed
+NULL = 0
+PRESENT = 1
+
+
+def length_bucket(length):
+    # 0, 1, 2-3, 4-7, 8-15, ... are one bucket each
+    return length.bit_length()
+
+
+class ShapeHasher:
+    def __init__(self, plan, bucket=length_bucket):
+        # plan is the StructPlan of the messages' root type, bucket maps a
+        # length to the (small, non-negative) number it is hashed as
+        self.plan = plan
+        self.bucket = bucket
+        # plan id -> { discriminant: FieldOp }
+        self.union_ops = {}
+        self.segments = None
+        self.tokens = None
+
+    def fingerprint(self, data):
+        # 64 bit fingerprint of the shape of the (unpacked, framed) message
+        # `data`
+        self.segments = next(iter_frames(data))
+        self.tokens = array("H")
+        target = resolve_pointer(self.segments, 0, 0)
+        if target is None:
+            self.tokens.append(NULL)
+        else:
+            seg, start, tag = target
+            self.struct(seg, start, (tag >> 32) & 0xffff, tag >> 48, self.plan)
+        digest = hashlib.blake2b(self.tokens.tobytes(), digest_size=8).digest()
+        self.segments = self.tokens = None
+        return int.from_bytes(digest, "little")
+
+    def struct(self, seg, start, data_words, pointer_words, plan):
+        self.sections(seg, start, data_words, start + data_words, pointer_words, plan)
+
+    def sections(self, seg, start, data_words, pointers, pointer_words, plan):
+        for op in plan.fields:
+            self.field(seg, start, data_words, pointers, pointer_words, op)
+        if plan.union:
+            union_ops = self.union_ops.get(plan.id)
+            if union_ops is None:
+                union_ops = self.union_ops[plan.id] = {op.discriminant: op for op in plan.union}
+            discriminant = self.uint16(seg, start, data_words, plan.discriminant_offset)
+            self.tokens.append(discriminant)
+            op = union_ops.get(discriminant)
+            if op is not None:
+                self.field(seg, start, data_words, pointers, pointer_words, op)
+
+    def uint16(self, seg, start, data_words, offset):
+        # 16 bit value `offset` of a data section, 0 beyond its end
+        if (offset + 1) * 2 > data_words * 8:
+            return 0
+        return _uint16.unpack_from(self.segments[seg], start * 8 + offset * 2)[0]
+
+    def field(self, seg, start, data_words, pointers, pointer_words, op):
+        kind = op.kind
+        if kind == "enum":
+            self.tokens.append(self.uint16(seg, start, data_words, op.offset))
+        elif kind == "group":
+            self.sections(seg, start, data_words, pointers, pointer_words, op.plan)
+        elif kind in ("text", "data", "struct", "list"):
+            if op.offset < pointer_words:
+                self.pointer(seg, pointers + op.offset, op)
+            else:
+                self.tokens.append(NULL)
+
+    def pointer(self, seg, index, op):
+        target = resolve_pointer(self.segments, seg, index)
+        if target is None:
+            self.tokens.append(NULL)
+            return
+        seg, start, tag = target
+        kind = op.kind
+        if kind == "struct":
+            self.tokens.append(PRESENT)
+            if tag & 3 == 0:
+                self.struct(seg, start, (tag >> 32) & 0xffff, tag >> 48, op.plan)
+        elif tag & 3 != 1:
+            self.tokens.append(PRESENT)
+        elif kind == "list":
+            self.list(seg, start, (tag >> 32) & 7, tag >> 35, op.element)
+        else:
+            # text and data, by length (text without its NUL)
+            count = tag >> 35
+            self.tokens.append(PRESENT + self.bucket(count - 1 if kind == "text" and count else count))
+
+    def list(self, seg, start, element_size, count, element):
+        kind = element.kind
+        if element_size == ELEMENT_COMPOSITE:
+            # count is in words, the element count is in the tag word
+            count, data_words, pointer_words = composite_tag(self.segments, seg, start, count)
+        self.tokens.append(PRESENT + self.bucket(count))
+        if kind == "enum":
+            if element_size == 3:
+                self.tokens.frombytes(self.segments[seg][start * 8:start * 8 + count * 2])
+        elif kind == "struct":
+            if element_size != ELEMENT_COMPOSITE:
+                return
+            step = data_words + pointer_words
+            for i in range(count):
+                self.struct(seg, start + 1 + i * step, data_words, pointer_words, element.plan)
+        elif kind in ("text", "data", "list"):
+            if element_size != ELEMENT_POINTER:
+                return
+            for i in range(count):
+                self.pointer(seg, start + i, element)
+
+
+class FingerprintSet:
+    # Exact set of the most recent fingerprints. Fingerprints are added to
+    # a current generation, which replaces the previous one when it is half
+    # the capacity, so at most `capacity` are held and at least the last
+    # capacity / 2 are remembered.
+    def __init__(self, capacity=1 << 20):
+        self.capacity = capacity
+        self.current = set()
+        self.previous = set()
+
+    def add(self, fingerprint):
+        # True if `fingerprint` is new
+        if fingerprint in self.current or fingerprint in self.previous:
+            return False
+        if len(self.current) >= max(self.capacity // 2, 1):
+            self.previous = self.current
+            self.current = set()
+        self.current.add(fingerprint)
+        return True
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+
+class BloomFilter:
+    # Bloom filter sized for `capacity` fingerprints at a false positive
+    # rate of error_rate. The bit positions are derived from the two halves
+    # of the fingerprint (double hashing).
+    def __init__(self, capacity=1 << 20, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.bits / capacity * math.log(2)), 1)
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def add(self, fingerprint):
+        # True if `fingerprint` is (probably) new
+        h1 = fingerprint & 0xffffffff
+        h2 = (fingerprint >> 32) | 1
+        bits = self.bits
+        array = self.array
+        new = False
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % bits
+            mask = 1 << (position & 7)
+            if not array[position >> 3] & mask:
+                array[position >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __len__(self):
+        return self.count
+
+
+def make_seen(capacity=1 << 20, bloom=False, error_rate=0.001):
+    return BloomFilter(capacity, error_rate) if bloom else FingerprintSet(capacity)
+
+
+class Deduplicator:
+    def __init__(self, plan, seen=None, bucket=length_bucket):
+        # seen is a FingerprintSet or BloomFilter, a FingerprintSet of the
+        # default capacity if None
+        self.hasher = ShapeHasher(plan, bucket)
+        self.seen = seen if seen is not None else FingerprintSet()
+        self.kept = 0
+        self.dropped = 0
+
+    def add(self, data):
+        # True if the shape of `data` (an unpacked, framed message) is new
+        if self.seen.add(self.hasher.fingerprint(data)):
+            self.kept += 1
+            return True
+        self.dropped += 1
+        return False
+
+
+def _struct_node(node):
+    return node.node if isinstance(node, TemplateNode) else node
+
+
+def iter_distinct(node, dedup, count=None, packed=False, start=0):
+    # iter_messages(), but yields (index in the run, data) of only the
+    # messages `dedup` (a Deduplicator) keeps. `count` is the number of
+    # messages generated, not kept.
+    module = _struct_node(node).node
+    for index, data in enumerate(iter_messages(node, count, False, start), start):
+        if dedup.add(data):
+            if packed:
+                with module.from_bytes(data) as reader:
+                    data = reader.as_builder().to_bytes_packed()
+            yield index, data
+
+
+def deduplicator_for(node, capacity=1 << 20, bloom=False, error_rate=0.001):
+    # Deduplicator for the messages of `node` (a StructNode or TemplateNode)
+    return Deduplicator(_struct_node(node).plan, make_seen(capacity, bloom, error_rate))
+
+
+def write_indices(out, indices):
+    # indices is an array("Q"), written as little endian uint64
+    if sys.byteorder == "big":
+        indices = array("Q", indices)
+        indices.byteswap()
+    out.write(indices.tobytes())
+
+
+def read_indices(path):
+    # The run indices of the messages in a shard written with dedup, in the
+    # order of the shard file: message i of the file is message
+    # shard["first"] + indices[i] of the corpus
+    indices = array("Q")
+    with open(path, "rb") as f:
+        indices.frombytes(f.read())
+    if sys.byteorder == "big":
+        indices.byteswap()
+    return indices
@@ -0,0 +1,355 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import struct
+import sys
+import time
+from .corpus import DEFAULT_STEP, _load_root, add_budget_arguments, budget_from_args
+from .node import StructNode
+from .rng import RNG
+from .stream import iter_messages
+
+"""
+Sends generated messages to one or more targets (TCP or Unix socket
+endpoints) as fast as they take them. Generation runs once, feeding a queue
+that a pool of connections per target drains concurrently:
+
+    python -m capnp_generator.driver example.capnp Person 0x1234 \\
+        --target unix:/tmp/target.sock --target 127.0.0.1:9000 \\
+        --connections 4 --pipeline 16 --rate 5000 --crash-log crashes.jsonl
+
+Each connection keeps up to `pipeline` messages in flight. With
+response="frame" the target answers every message with one (unpacked,
+standard framed) message, and a message is in flight until its answer
+arrives; without responses it is in flight until it is one of the last
+`pipeline` messages written. rate caps the messages per second across all
+connections.
+
+A connection that fails (the target closed it, reset it, or can't be
+reached) is reopened after reconnect_delay, doubling up to max_delay while
+it keeps failing. Every failure of an open connection is recorded with the
+run's seed and step and the indices of the messages that were in flight,
+which is what `python -m capnp_generator.replay` needs to regenerate them.
+Those messages are not sent again, and a connection that fails once every
+message was taken off the queue is not reopened.
+
+For trying a harness without a target, stand_in() serves a target that
+echoes every message back and drops the connection, without answering, on
+every crash_after-th message (--stand-in on the command line).
+"""
+
+_uint32 = struct.Struct("<I")
+
+
+def parse_target(text):
+    # "unix:/path" or "[host:]port" -> ("unix", path) or ("tcp", host, port)
+    if text.startswith("unix:"):
+        return ("unix", text[5:])
+    host, _, port = text.rpartition(":")
+    return ("tcp", host or "127.0.0.1", int(port))
+
+
+def format_target(target):
+    return f"unix:{target[1]}" if target[0] == "unix" else f"{target[1]}:{target[2]}"
+
+
+async def open_target(target):
+    if target[0] == "unix":
+        return await asyncio.open_unix_connection(target[1])
+    return await asyncio.open_connection(target[1], target[2])
+
+
+async def read_frame(reader):
+    # One message in the standard (unpacked) stream framing
+    header = await reader.readexactly(4)
+    count = _uint32.unpack(header)[0] + 1
+    table = await reader.readexactly(((4 + 4 * count + 7) & ~7) - 4)
+    size = sum(struct.unpack_from(f"<{count}I", table)) * 8
+    return header + table + await reader.readexactly(size)
+
+
+class RateLimiter:
+    # Spaces calls to wait() at least 1/rate seconds apart on average
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next = time.monotonic()
+
+    async def wait(self):
+        now = time.monotonic()
+        if self.next > now:
+            await asyncio.sleep(self.next - now)
+        else:
+            # don't save up for a burst after a stall
+            self.next = now
+        self.next += self.interval
+
+
+class TrafficDriver:
+    def __init__(self, node, targets, count=None, start=0, packed=False, connections=1, pipeline=1, rate=None,
+                 response=None, reconnect_delay=0.1, max_delay=5.0, max_reconnects=None, crash_log=None):
+        # node is a StructNode or TemplateNode, whose RNG the crash records
+        # take the seed and step from. targets are parse_target() tuples.
+        # crash_log is an optional text file crashes are written to as JSON
+        # lines, as they happen.
+        self.node = node
+        self.targets = targets
+        self.count = count
+        self.start = start
+        self.packed = packed
+        self.connections = connections
+        self.pipeline = pipeline
+        self.rate = rate
+        self.response = response
+        self.reconnect_delay = reconnect_delay
+        self.max_delay = max_delay
+        self.max_reconnects = max_reconnects
+        self.crash_log = crash_log
+        self.crashes = []
+        self.sent = 0
+        self.answered = 0
+        self.queue = None
+
+    async def run(self):
+        # Sends every message (or until all connections gave up), returns
+        # the list of crash records
+        self.queue = asyncio.Queue(maxsize=self.connections * len(self.targets) * max(self.pipeline, 1) * 2)
+        workers = [
+            asyncio.create_task(self.connection(target))
+            for target in self.targets
+            for _ in range(self.connections)
+        ]
+        producer = asyncio.create_task(self.produce(len(workers)))
+        try:
+            # the producer is awaited too, if generation fails the workers
+            # would otherwise wait on the queue forever
+            pending = {producer, *workers}
+            while not pending.isdisjoint(workers):
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    task.result()
+        finally:
+            producer.cancel()
+            for worker in workers:
+                worker.cancel()
+        return self.crashes
+
+    async def produce(self, workers):
+        limiter = RateLimiter(self.rate) if self.rate else None
+        for index, data in enumerate(iter_messages(self.node, self.count, self.packed, self.start), self.start):
+            if limiter is not None:
+                await limiter.wait()
+            await self.queue.put((index, data))
+        # one end marker per connection
+        for _ in range(workers):
+            await self.queue.put(None)
+
+    async def connection(self, target):
+        delay = self.reconnect_delay
+        reconnects = 0
+        # set once this connection took its end marker off the queue, after
+        # which a failure ends the connection instead of reopening it
+        finished = asyncio.Event()
+        while True:
+            pending = collections.deque(maxlen=None if self.response else self.pipeline)
+            try:
+                reader, writer = await open_target(target)
+            except OSError as e:
+                error = e
+            else:
+                try:
+                    await self.pump(reader, writer, pending, finished)
+                    return
+                except (OSError, asyncio.IncompleteReadError) as e:
+                    error = e
+                    self.record_crash(target, pending, e)
+                    if finished.is_set():
+                        return
+                    delay = self.reconnect_delay
+                finally:
+                    writer.close()
+            reconnects += 1
+            if self.max_reconnects is not None and reconnects > self.max_reconnects:
+                print(f"giving up on {format_target(target)}: {error}", file=sys.stderr)
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+
+    async def pump(self, reader, writer, pending, finished):
+        # Sends messages from the queue until the end marker, sets `finished`
+        # and waits for the answers still outstanding. Raises if the target
+        # goes away.
+        window = asyncio.Semaphore(self.pipeline)
+        responses = asyncio.create_task(self.read_responses(reader, pending, window))
+        try:
+            unacknowledged = 0
+            while True:
+                # only what can block for long is raced against the reader
+                if self.response:
+                    if window.locked():
+                        await self._wait(window.acquire(), responses)
+                    else:
+                        await window.acquire()
+                # don't take a message off the queue for a dead connection
+                if responses.done():
+                    responses.result()
+                if self.queue.empty():
+                    item = await self._wait(self.queue.get(), responses)
+                else:
+                    item = self.queue.get_nowait()
+                if item is None:
+                    finished.set()
+                    if self.response:
+                        window.release()
+                    break
+                index, data = item
+                pending.append(index)
+                if responses.done():
+                    # the connection died while the message was taken, it is
+                    # recorded as in flight
+                    responses.result()
+                writer.write(data)
+                self.sent += 1
+                unacknowledged += 1
+                if unacknowledged >= self.pipeline:
+                    # raises if the connection was lost
+                    await writer.drain()
+                    unacknowledged = 0
+            await writer.drain()
+            if self.response:
+                for _ in range(self.pipeline):
+                    await self._wait(window.acquire(), responses)
+        finally:
+            responses.cancel()
+
+    async def _wait(self, awaitable, responses):
+        # Awaits `awaitable`, unless the response reader fails first
+        task = asyncio.ensure_future(awaitable)
+        done, _ = await asyncio.wait((task, responses), return_when=asyncio.FIRST_COMPLETED)
+        if task not in done:
+            task.cancel()
+            responses.result()
+            raise ConnectionResetError("connection closed by the target")
+        return task.result()
+
+    async def read_responses(self, reader, pending, window):
+        if self.response == "frame":
+            while True:
+                await read_frame(reader)
+                pending.popleft()
+                self.answered += 1
+                window.release()
+        # without responses, only notice when the target closes the connection
+        while await reader.read(1 << 16):
+            pass
+        raise ConnectionResetError("connection closed by the target")
+
+    def record_crash(self, target, pending, error):
+        rng = self.node.rng
+        crash = {
+            "time": time.time(),
+            "target": format_target(target),
+            "seed": rng.run_seed,
+            "step": rng.step,
+            "backend": rng.backend,
+            "indices": list(pending),
+            "error": f"{type(error).__name__}: {error}",
+        }
+        self.crashes.append(crash)
+        if self.crash_log is not None:
+            self.crash_log.write(json.dumps(crash) + "\n")
+            self.crash_log.flush()
+        pending.clear()
+
+
+async def stand_in(target, crash_after=None):
+    # Starts a target that echoes every (unpacked) message back, except that
+    # it drops the connection on every crash_after-th message it receives. Returns
+    # the asyncio server.
+    received = 0
+
+    async def handle(reader, writer):
+        nonlocal received
+        try:
+            while True:
+                data = await read_frame(reader)
+                received += 1
+                if crash_after and received % crash_after == 0:
+                    # "crashes" on this message, without answering it
+                    writer.transport.abort()
+                    return
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    if target[0] == "unix":
+        if os.path.exists(target[1]):
+            os.unlink(target[1])
+        return await asyncio.start_unix_server(handle, target[1])
+    return await asyncio.start_server(handle, target[1], target[2])
+
+
+async def _main(driver, stand_ins):
+    servers = [await stand_in(target, crash_after) for target, crash_after in stand_ins]
+    try:
+        started = time.perf_counter()
+        crashes = await driver.run()
+        elapsed = time.perf_counter() - started
+    finally:
+        for server in servers:
+            server.close()
+    print(f"sent {driver.sent} messages in {elapsed:.2f}s ({driver.sent / elapsed:.0f}/s), "
+          f"{driver.answered} answered, {len(crashes)} crashes", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="send generated capnp messages to targets")
+    parser.add_argument("schema", help="capnp schema file")
+    parser.add_argument("type", help="name of the root struct type")
+    parser.add_argument("seed", type=lambda s: int(s, 0), help="seed of the run")
+    parser.add_argument("--target", action="append", type=parse_target, required=True, help="unix:PATH or [host:]port, repeatable")
+    parser.add_argument("--count", type=int, default=None, help="number of messages (default: until interrupted)")
+    parser.add_argument("--start", type=int, default=0, help="index of the first message")
+    parser.add_argument("--connections", type=int, default=1, help="connections per target (default 1)")
+    parser.add_argument("--pipeline", type=int, default=1, help="messages in flight per connection (default 1)")
+    parser.add_argument("--rate", type=float, default=None, help="messages per second across all connections")
+    parser.add_argument("--response", choices=["frame"], default=None, help="the target answers each message with one message")
+    parser.add_argument("--max-reconnects", type=int, default=None, help="reconnects per connection before giving up (default: no limit)")
+    parser.add_argument("--crash-log", help="append crash records to this file as JSON lines")
+    parser.add_argument("--stand-in", action="store_true", help="serve an echo stand-in on each target (implies --response frame)")
+    parser.add_argument("--crash-after", type=int, default=None, help="the stand-in drops the connection every N messages")
+    parser.add_argument("--step", type=int, default=DEFAULT_STEP, help=f"messages between RNG checkpoints (default {DEFAULT_STEP})")
+    parser.add_argument("--backend", default="random", help="RNG backend (random, numpy, pcg64)")
+    parser.add_argument("--cache-dir", default=None, help="schema index cache directory")
+    parser.add_argument("--packed", action="store_true", help="send packed messages")
+    add_budget_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.stand_in and args.packed:
+        parser.error("the stand-in only reads unpacked messages")
+
+    root_node = _load_root(args.schema, args.cache_dir)
+    rng = RNG(args.seed, args.step, backend=args.backend)
+    node = StructNode(root_node.structs_by_name[args.type], root_node, rng, budget=budget_from_args(args))
+    crash_log = open(args.crash_log, "a") if args.crash_log else None
+    driver = TrafficDriver(
+        node, args.target, count=args.count, start=args.start, packed=args.packed,
+        connections=args.connections, pipeline=args.pipeline, rate=args.rate,
+        response="frame" if args.stand_in else args.response,
+        max_reconnects=args.max_reconnects, crash_log=crash_log
+    )
+    stand_ins = [(target, args.crash_after) for target in args.target] if args.stand_in else []
+    try:
+        asyncio.run(_main(driver, stand_ins))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if crash_log is not None:
+            crash_log.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -65,3 +65,72 @@ for i in range(0, 10):
 # From here act on the message as normal, send it wherever it's meant to go
 serialized = msg.to_bytes_packed()
 open("/tmp/test.out", "wb").write(serialized)
+
+# To produce a lot of messages, stream them instead. This writes 1000 packed,
+# framed messages into one file (or pipe, or any binary file object) in large
+# chunks, without keeping the messages around:
+# from stream import stream_messages
+# with open("/tmp/test.stream", "wb") as out:
+#     stream_messages(person_node, out, count=1000, packed=True)
+
+# To see which fields generation spends its time (and random draws) on,
+# instrument the node for a while. stats.write_flamegraph() writes folded
+# stacks for flamegraph.pl or speedscope:
+# from instrument import instrument
+# with instrument(person_node) as stats:
+#     for i in range(0, 1000):
+#         person_node.generate()
+# print(stats.report())
+
+# Numeric values are drawn from a weighted mix of sources (interesting values
+# like 0, 0x7f or 0xffffffff, and the whole range of the type). The weights
+# can be changed, and dictionaries of extra values added, for every field of
+# a type through the RNG or for single fields through the node:
+# rng.set_values("uint32", weights={"range": 4})
+# person_node = StructNode(root_node.structs_by_name[typeName], root_node, rng, values={
+#     "Person.c": {"weights": {"dictionary": 10}, "dictionary": [0xdeadbeef, 0xcafebabe]},
+# })
+
+# Every `step` messages (the second argument of RNG) the RNG is reseeded from
+# the seed and the message index, so any message of a run can be generated
+# again without the ones before it. With a step of 1 that takes no extra work:
+# msg = person_node.generate_at(3000000)
+# or from the command line:
+# python -m capnp_generator.replay example.capnp Person 0x1234 --step 1000 --range 3000000 --text
+
+# For schemas whose messages mostly differ in their values, not their shape,
+# a TemplateNode copies cached skeleton messages and only draws new values
+# for their fields, generating a new skeleton for 1% of the messages:
+# from template import TemplateNode
+# template_node = TemplateNode(person_node, templates=16, reshape_rate=0.01)
+# serialized = template_node.generate_bytes()
+
+# To skip loading the schema in every harness, keep a generator server
+# running (python -m capnp_generator.server example.capnp --unix /tmp/gen.sock)
+# and ask it for messages:
+# from server import Client
+# with Client("/tmp/gen.sock") as client:
+#     for serialized in client.messages("Person", seed=seed, count=1000):
+#         ...
+
+# To send messages straight to the program under test over a socket, with
+# several connections and messages in flight each, and a log of the messages
+# in flight whenever it drops a connection (replay them by index):
+# python -m capnp_generator.driver example.capnp Person 0x1234 --target unix:/tmp/target.sock \
+#     --connections 4 --pipeline 16 --response frame --crash-log crashes.jsonl
+
+# Params and results of the methods of an interface come from an
+# InterfaceNode, which compiles every method's structs once:
+# from rpc import InterfaceNode
+# interface_node = InterfaceNode(root_node.interfaces_by_name["TestInterface"], root_node, rng)
+# batch = interface_node.generate_batch("returnOpposite", 1000)
+# or are sent as calls to a running service (--stand-in serves a fake one):
+# python -m capnp_generator.rpc example.capnp TestInterface 0x1234 --call unix:/tmp/service.sock --count 1000
+
+# Small types make many messages of the same shape. A Deduplicator only lets
+# through messages whose union arms, bucketed list lengths, null pointers and
+# enum values haven't been seen before:
+# from dedup import deduplicator_for, iter_distinct
+# for index, serialized in iter_distinct(person_node, deduplicator_for(person_node), count=10000):
+#     ...
+# python -m capnp_generator.corpus example.capnp Person 0x1234 1000000 corpus/ --dedup
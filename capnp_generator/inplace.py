@@ -0,0 +1,277 @@
+import mmap
+import struct
+from .plan import compile_struct
+
+"""
+Schema-aware mutation of serialized messages in place, without building any
+pycapnp objects. A file (or any writable buffer) of segment framed, unpacked
+messages is walked directly: the root pointer is followed to the root
+struct, and from there every field is located from the slot offsets and
+union discriminants recorded in the generation plans (see plan.py).
+Primitive and enum values in data sections, the bytes of text and data
+blobs and the contents of primitive lists are mutated at their exact
+offsets through memoryview slices, and struct pointers, struct lists and
+lists of pointers are followed recursively. Pointers themselves and list
+lengths are never touched, so every message stays well formed.
+
+With mutate_file() the file is memory mapped, so a corpus much larger than
+memory can be mutated at roughly the speed the pages can be read and
+written. Packed messages can't be mutated in place and are not supported.
+
+See https://capnproto.org/encoding.html for the wire format.
+"""
+
+# data section size in bytes of each primitive type (bools are bits)
+PRIMITIVE_SIZES = {
+    "uint8": 1, "int8": 1,
+    "uint16": 2, "int16": 2,
+    "uint32": 4, "int32": 4, "float32": 4,
+    "uint64": 8, "int64": 8, "float64": 8,
+}
+
+# list pointer element size codes
+ELEMENT_BITS = {0: 0, 1: 1, 2: 8, 3: 16, 4: 32, 5: 64}
+ELEMENT_POINTER = 6
+ELEMENT_COMPOSITE = 7
+
+# pointers followed before a message is considered malicious, like the
+# nesting limit of the capnp readers
+MAX_DEPTH = 64
+
+_word = struct.Struct("<Q")
+_uint16 = struct.Struct("<H")
+
+
+class MalformedMessage(ValueError):
+    pass
+
+
+def iter_frames(buf):
+    # Yields the segments of every message in `buf` as memoryview slices
+    view = memoryview(buf)
+    pos = 0
+    end = len(view)
+    while pos < end:
+        if pos + 4 > end:
+            raise MalformedMessage(f"segment table of the message at offset {pos} is truncated")
+        count = struct.unpack_from("<I", view, pos)[0] + 1
+        header = (4 + 4 * count + 7) & ~7
+        if pos + header > end:
+            raise MalformedMessage(f"segment table of the message at offset {pos} is truncated")
+        sizes = struct.unpack_from(f"<{count}I", view, pos + 4)
+        start = pos + header
+        segments = []
+        for size in sizes:
+            segments.append(view[start:start + size * 8])
+            start += size * 8
+        if start > end:
+            raise MalformedMessage(f"message at offset {pos} is truncated")
+        yield segments
+        pos = start
+
+
+def _read_word(segments, seg, index):
+    try:
+        return _word.unpack_from(segments[seg], index * 8)[0]
+    except (IndexError, struct.error):
+        raise MalformedMessage(f"pointer to word {index} of segment {seg} is out of bounds")
+
+
+def resolve_pointer(segments, seg, index):
+    # Follows the pointer at word `index` of segment `seg`, including far
+    # pointers. Returns (segment, first word of the target, pointer word
+    # describing the target), or None for null and capability pointers.
+    word = _read_word(segments, seg, index)
+    if word == 0:
+        return None
+    kind = word & 3
+    if kind == 2:
+        pad_seg = word >> 32
+        pad = (word >> 3) & 0x1fffffff
+        if not (word >> 2) & 1:
+            # single far pointer: the landing pad is a normal pointer
+            seg, index = pad_seg, pad
+            word = _read_word(segments, seg, index)
+            kind = word & 3
+        else:
+            # double far: the pad points at the content, followed by a tag
+            far = _read_word(segments, pad_seg, pad)
+            tag = _read_word(segments, pad_seg, pad + 1)
+            if far >> 32 >= len(segments):
+                raise MalformedMessage(f"far pointer to missing segment {far >> 32}")
+            return _checked_target(segments, far >> 32, (far >> 3) & 0x1fffffff, tag)
+    if kind == 3:
+        return None
+    offset = (word >> 2) & 0x3fffffff
+    if offset & 0x20000000:
+        offset -= 0x40000000
+    return _checked_target(segments, seg, index + 1 + offset, word)
+
+
+def _target_words(tag):
+    # Words taken by the target of the struct or list pointer `tag`
+    kind = tag & 3
+    if kind == 0:
+        return ((tag >> 32) & 0xffff) + (tag >> 48)
+    if kind != 1:
+        return 0
+    element_size = (tag >> 32) & 7
+    count = tag >> 35
+    if element_size == ELEMENT_COMPOSITE:
+        # count is in words, not counting the tag word
+        return count + 1
+    if element_size == ELEMENT_POINTER:
+        return count
+    return (count * ELEMENT_BITS[element_size] + 63) // 64
+
+
+def _checked_target(segments, seg, start, tag):
+    # Without this a negative start would wrap around through negative
+    # slicing, and mutate bytes the pointer doesn't point at
+    if start < 0 or start + _target_words(tag) > len(segments[seg]) // 8:
+        raise MalformedMessage(f"pointer to word {start} of segment {seg} is out of bounds")
+    return seg, start, tag
+
+
+def composite_tag(segments, seg, start, words):
+    # (elements, data words, pointer words) of the composite list at word
+    # `start`, whose list pointer gives it `words` words after the tag
+    tag = _read_word(segments, seg, start)
+    elements = (tag >> 2) & 0x3fffffff
+    data_words = (tag >> 32) & 0xffff
+    pointer_words = tag >> 48
+    if elements * (data_words + pointer_words) > words:
+        raise MalformedMessage(f"composite list at word {start} of segment {seg} is larger than its pointer says")
+    return elements, data_words, pointer_words
+
+
+class InPlaceMutator:
+    def __init__(self, root_node, rng, prob_field=0.1):
+        self.root_node = root_node
+        self.rng = rng
+        self.prob_field = prob_field
+        # plan id -> { discriminant: FieldOp }
+        self.union_ops = {}
+
+    def mutate_file(self, path, type_name):
+        # Mutates every message in the file at `path` in place, returns the
+        # number of messages
+        with open(path, "r+b") as f:
+            with mmap.mmap(f.fileno(), 0) as mapped:
+                count = self.mutate_buffer(mapped, type_name)
+                mapped.flush()
+        return count
+
+    def mutate_buffer(self, buf, type_name):
+        # Same as mutate_file for any writable buffer (bytearray, mmap, ...)
+        plan = compile_struct(self.root_node.structs_by_name[type_name], self.root_node)
+        count = 0
+        for segments in iter_frames(buf):
+            self.mutate_message(segments, plan)
+            count += 1
+        return count
+
+    def mutate_message(self, segments, plan):
+        target = self.resolve(segments, 0, 0)
+        if target is not None:
+            seg, start, tag = target
+            self.mutate_struct(segments, seg, start, (tag >> 32) & 0xffff, tag >> 48, plan, 0)
+
+    def resolve(self, segments, seg, index):
+        return resolve_pointer(segments, seg, index)
+
+    def mutate_struct(self, segments, seg, start, data_words, pointer_words, plan, depth):
+        if depth > MAX_DEPTH:
+            raise MalformedMessage("pointer nesting too deep")
+        data = segments[seg][start * 8:(start + data_words) * 8]
+        self.mutate_sections(segments, seg, data, start + data_words, pointer_words, plan, depth)
+
+    def mutate_sections(self, segments, seg, data, pointers, pointer_words, plan, depth):
+        # Mutates the fields of `plan` given the struct's data section (as a
+        # memoryview) and the word index of its pointer section. Groups live
+        # in the sections of their parent, so they come through here directly.
+        for op in plan.fields:
+            self.mutate_field(segments, seg, data, pointers, pointer_words, op, depth)
+        if plan.union:
+            union_ops = self.union_ops.get(plan.id)
+            if union_ops is None:
+                union_ops = self.union_ops[plan.id] = {op.discriminant: op for op in plan.union}
+            offset = plan.discriminant_offset * 2
+            discriminant = _uint16.unpack_from(data, offset)[0] if offset + 2 <= len(data) else 0
+            op = union_ops.get(discriminant)
+            if op is not None:
+                self.mutate_field(segments, seg, data, pointers, pointer_words, op, depth)
+
+    def mutate_field(self, segments, seg, data, pointers, pointer_words, op, depth):
+        kind = op.kind
+        if kind == "primitive":
+            if self.rng.random.random() >= self.prob_field:
+                return
+            if op.typestring == "bool":
+                byte = op.offset >> 3
+                if byte < len(data):
+                    data[byte] ^= 1 << (op.offset & 7)
+                return
+            size = PRIMITIVE_SIZES[op.typestring]
+            offset = op.offset * size
+            if offset + size <= len(data):
+                self.rng.mutate_function_map[op.typestring](data[offset:offset + size])
+        elif kind == "enum":
+            # Values are stored XORed with the field default, which is almost
+            # always the first enumerant, so this writes a random enumerant
+            offset = op.offset * 2
+            if offset + 2 <= len(data) and self.rng.random.random() < self.prob_field:
+                _uint16.pack_into(data, offset, self.rng.getRandom(0, len(op.enumerants) - 1))
+        elif kind == "group":
+            self.mutate_sections(segments, seg, data, pointers, pointer_words, op.plan, depth)
+        elif kind in ("text", "data", "struct", "list"):
+            if op.offset >= pointer_words:
+                return
+            self.mutate_pointer(segments, seg, pointers + op.offset, op, depth + 1)
+
+    def mutate_pointer(self, segments, seg, index, op, depth):
+        # op describes what the pointer points at (a field or a list element)
+        if depth > MAX_DEPTH:
+            raise MalformedMessage("pointer nesting too deep")
+        target = self.resolve(segments, seg, index)
+        if target is None:
+            return
+        seg, start, tag = target
+        kind = op.kind
+        if kind == "struct":
+            if tag & 3 == 0:
+                self.mutate_struct(segments, seg, start, (tag >> 32) & 0xffff, tag >> 48, op.plan, depth)
+            return
+        if tag & 3 != 1:
+            return
+        element_size = (tag >> 32) & 7
+        count = tag >> 35
+        segment = segments[seg]
+        if kind in ("text", "data"):
+            if element_size == 2 and self.rng.random.random() < self.prob_field:
+                # leave the NUL terminator of text alone
+                length = count - 1 if kind == "text" else count
+                self.rng._mutate_bytes(segment[start * 8:start * 8 + max(length, 0)])
+        elif kind == "list":
+            self.mutate_list(segments, seg, start, element_size, count, op.element, depth)
+
+    def mutate_list(self, segments, seg, start, element_size, count, element, depth):
+        segment = segments[seg]
+        kind = element.kind
+        if kind in ("primitive", "enum"):
+            bits = ELEMENT_BITS.get(element_size)
+            if bits:
+                # every byte of the list is picked with probability prob_field
+                self.rng._mutate_bytes(segment[start * 8:start * 8 + (count * bits + 7) // 8], prob_byte=self.prob_field)
+        elif kind == "struct":
+            if element_size != ELEMENT_COMPOSITE:
+                return
+            elements, data_words, pointer_words = composite_tag(segments, seg, start, count)
+            step = data_words + pointer_words
+            for i in range(elements):
+                self.mutate_struct(segments, seg, start + 1 + i * step, data_words, pointer_words, element.plan, depth)
+        elif kind in ("text", "data", "list"):
+            if element_size != ELEMENT_POINTER:
+                return
+            for i in range(count):
+                self.mutate_pointer(segments, seg, start + i, element, depth + 1)
@@ -0,0 +1,340 @@
+import functools
+import math
+import time
+from contextlib import contextmanager
+
+"""
+Optional instrumentation of generation, to find out which fields and types
+a schema spends its time on. attach() wraps StructNode.generate,
+generate_field and generate_list and the value getters of the node's RNG on
+that one instance, and counts every draw made from the RNG's backend
+(including the array draws of the numpy backend, counted per element).
+detach() puts the original methods back. Nothing is wrapped unless attach()
+is called, so generation without instrumentation runs exactly the code it
+always did.
+
+    instrumentation = Instrumentation()
+    instrumentation.attach(node)
+    for _ in range(1000):
+        node.generate()
+    instrumentation.detach(node)
+    print(instrumentation.stats.report())
+    with open("generate.folded", "w") as f:
+        instrumentation.stats.write_flamegraph(f)
+
+Stats are kept per field path (root struct, then field names, with "[]" for
+list elements, e.g. ("Person", "phones", "[]", "number")), per field type
+and per RNG getter. Every counter is inclusive: the time, draws and bytes of
+a path include everything generated below it. A type nested in itself
+(a recursive type) is counted once, by its outermost field. Bytes are the
+size of the values the getters return (bools count as an eighth of a
+byte), not the size of the serialized message.
+
+write_flamegraph() writes the paths in the folded stack format read by
+flamegraph.pl, inferno and speedscope, weighted by exclusive time in
+microseconds (or exclusive draws or bytes).
+"""
+
+# RNG getters that are wrapped, besides the ones in RNG.type_function_map
+GETTERS = ("getText", "getTextBytes", "getTextsBytes", "getBlob", "getList", "getEnum")
+
+# bytes produced per call of the fixed size getters
+GETTER_SIZES = {
+    "getUInt8": 1, "getInt8": 1,
+    "getUInt16": 2, "getInt16": 2,
+    "getUInt32": 4, "getInt32": 4, "getFloat32": 4,
+    "getUInt64": 8, "getInt64": 8, "getFloat64": 8,
+    "getBool": 0.125,
+    "getEnum": 2,
+}
+
+# element sizes for getList
+ELEMENT_SIZES = {
+    "uint8": 1, "int8": 1,
+    "uint16": 2, "int16": 2,
+    "uint32": 4, "int32": 4, "float32": 4,
+    "uint64": 8, "int64": 8, "float64": 8,
+    "bool": 0.125,
+}
+
+METRICS = ("calls", "time", "draws", "bytes")
+
+
+class Counter:
+    __slots__ = METRICS
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+        self.draws = 0
+        self.bytes = 0
+
+    def add(self, elapsed, draws, nbytes):
+        self.calls += 1
+        self.time += elapsed
+        self.draws += draws
+        self.bytes += nbytes
+
+    def to_dict(self):
+        return {metric: getattr(self, metric) for metric in METRICS}
+
+
+class Stats:
+    def __init__(self):
+        self.messages = 0
+        # field path tuple -> Counter
+        self.paths = {}
+        # type name (see type_name()) -> Counter
+        self.types = {}
+        # RNG getter name -> Counter
+        self.getters = {}
+
+    def _counter(self, table, key):
+        counter = table.get(key)
+        if counter is None:
+            counter = table[key] = Counter()
+        return counter
+
+    def to_dict(self):
+        return {
+            "messages": self.messages,
+            "paths": {";".join(path): counter.to_dict() for path, counter in self.paths.items()},
+            "types": {name: counter.to_dict() for name, counter in self.types.items()},
+            "getters": {name: counter.to_dict() for name, counter in self.getters.items()},
+        }
+
+    def report(self, sort="time", limit=20):
+        # Plain text tables of the top `limit` entries of each kind
+        lines = [f"{self.messages} messages"]
+        for title, table in (("field path", self.paths), ("type", self.types), ("getter", self.getters)):
+            lines.append("")
+            lines.append(f"{title:<48} {'calls':>10} {'time (s)':>10} {'draws':>12} {'bytes':>12}")
+            entries = sorted(table.items(), key=lambda item: getattr(item[1], sort), reverse=True)
+            for key, counter in entries[:limit]:
+                name = ".".join(key) if isinstance(key, tuple) else key
+                lines.append(f"{name:<48} {counter.calls:>10} {counter.time:>10.4f} {counter.draws:>12} {counter.bytes:>12.0f}")
+        return "\n".join(lines)
+
+    def exclusive(self, metric="time"):
+        # path -> `metric` of the path itself, without its children
+        values = {path: getattr(counter, metric) for path, counter in self.paths.items()}
+        for path, counter in self.paths.items():
+            parent = path[:-1]
+            if parent in values:
+                values[parent] -= getattr(counter, metric)
+        return values
+
+    def write_flamegraph(self, out, metric="time"):
+        # Folded stacks, one "root;field;field value" line per path
+        scale = 1e6 if metric == "time" else 1
+        for path, value in self.exclusive(metric).items():
+            value = max(int(round(value * scale)), 0)
+            if value:
+                out.write(f"{';'.join(path)} {value}\n")
+
+
+def type_name(op):
+    # Name a field op is counted under in Stats.types
+    kind = op.kind
+    if kind == "primitive":
+        return op.typestring
+    if kind in ("struct", "group"):
+        return op.plan.name.partition(":")[2] or op.plan.name
+    if kind == "list":
+        return f"List({type_name(op.element)})"
+    return kind
+
+
+class _CountingGenerator:
+    # Stands in for numpy.random.Generator, counting every value drawn
+    def __init__(self, generator, instrumentation):
+        self._generator = generator
+        self._instrumentation = instrumentation
+
+    def integers(self, *args, size=None, **kwargs):
+        self._instrumentation.draws += 1 if size is None else math.prod(size) if isinstance(size, tuple) else size
+        return self._generator.integers(*args, size=size, **kwargs)
+
+    def choice(self, *args, size=None, **kwargs):
+        self._instrumentation.draws += 1 if size is None else math.prod(size) if isinstance(size, tuple) else size
+        return self._generator.choice(*args, size=size, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._generator, name)
+
+
+class _CountingBackend:
+    # Stands in for an RNG backend (see backends.py), counting every draw
+    def __init__(self, backend, instrumentation):
+        self._backend = backend
+        self._instrumentation = instrumentation
+
+    def randint(self, a, b):
+        self._instrumentation.draws += 1
+        return self._backend.randint(a, b)
+
+    def random(self):
+        self._instrumentation.draws += 1
+        return self._backend.random()
+
+    @property
+    def generator(self):
+        generator = getattr(self._backend, "generator", None)
+        if generator is None:
+            return None
+        return _CountingGenerator(generator, self._instrumentation)
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+
+class Instrumentation:
+    def __init__(self, stats=None):
+        self.stats = stats if stats is not None else Stats()
+        # running totals, the counters store differences of these
+        self.draws = 0
+        self.bytes = 0
+        # current field path, and (start time, draws, bytes) per entry
+        self.path = []
+        self.frames = []
+        # type name -> number of its fields being generated, only the
+        # outermost one counts a recursive type's time, draws and bytes
+        self.type_depth = {}
+        # nesting of getter calls (getText calls getTextBytes), bytes are
+        # only counted for the outermost one
+        self.getter_depth = 0
+
+    def attach(self, node):
+        # Instruments `node` (a StructNode) and its RNG. A node (or RNG) can
+        # only be attached to one Instrumentation at a time.
+        root = node.plan.name.partition(":")[2] or node.plan.name
+        node.generate = self._wrap_generate(node.generate, root)
+        node.generate_field = self._wrap_field(node.generate_field)
+        node.generate_list = self._wrap_list(node.generate_list)
+        self.attach_rng(node.rng)
+
+    def detach(self, node):
+        for name in ("generate", "generate_field", "generate_list"):
+            node.__dict__.pop(name, None)
+        self.detach_rng(node.rng)
+
+    def attach_rng(self, rng):
+        if isinstance(rng.random, _CountingBackend):
+            return
+        rng.random = _CountingBackend(rng.random, self)
+        if rng.vector is not None:
+            rng.vector.backend = rng.random
+        names = [fn.__name__ for fn in rng.type_function_map.values()] + list(GETTERS)
+        for name in names:
+            setattr(rng, name, self._wrap_getter(getattr(rng, name), name))
+        for typestring, fn in rng.type_function_map.items():
+            rng.type_function_map[typestring] = getattr(rng, fn.__name__)
+
+    def detach_rng(self, rng):
+        if not isinstance(rng.random, _CountingBackend):
+            return
+        rng.random = rng.random._backend
+        if rng.vector is not None:
+            rng.vector.backend = rng.random
+        for typestring, fn in rng.type_function_map.items():
+            rng.__dict__.pop(fn.__name__, None)
+            rng.type_function_map[typestring] = getattr(rng, fn.__name__)
+        for name in GETTERS:
+            rng.__dict__.pop(name, None)
+
+    def _push(self, name, type_key=None):
+        self.path.append(name)
+        if type_key is not None:
+            self.type_depth[type_key] = self.type_depth.get(type_key, 0) + 1
+        self.frames.append((time.perf_counter(), self.draws, self.bytes))
+
+    def _pop(self, type_key=None):
+        start, draws, nbytes = self.frames.pop()
+        elapsed = time.perf_counter() - start
+        draws = self.draws - draws
+        nbytes = self.bytes - nbytes
+        stats = self.stats
+        stats._counter(stats.paths, tuple(self.path)).add(elapsed, draws, nbytes)
+        if type_key is not None:
+            depth = self.type_depth[type_key] - 1
+            self.type_depth[type_key] = depth
+            counter = stats._counter(stats.types, type_key)
+            if depth:
+                # already counted by the enclosing field of the same type
+                counter.add(0.0, 0, 0)
+            else:
+                counter.add(elapsed, draws, nbytes)
+        self.path.pop()
+
+    def _wrap_generate(self, generate, root):
+        @functools.wraps(generate)
+        def wrapper():
+            self._push(root, root)
+            try:
+                return generate()
+            finally:
+                self._pop(root)
+                self.stats.messages += 1
+        return wrapper
+
+    def _wrap_field(self, generate_field):
+        @functools.wraps(generate_field)
+        def wrapper(msg, op):
+            type_key = type_name(op)
+            self._push(op.name, type_key)
+            try:
+                generate_field(msg, op)
+            finally:
+                self._pop(type_key)
+        return wrapper
+
+    def _wrap_list(self, generate_list):
+        @functools.wraps(generate_list)
+        def wrapper(msg, op, length):
+            self._push("[]")
+            try:
+                generate_list(msg, op, length)
+            finally:
+                self._pop()
+        return wrapper
+
+    def _wrap_getter(self, getter, name):
+        size = GETTER_SIZES.get(name)
+        counter = self.stats._counter(self.stats.getters, name)
+
+        @functools.wraps(getter)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            draws = self.draws
+            self.getter_depth += 1
+            try:
+                value = getter(*args, **kwargs)
+            finally:
+                self.getter_depth -= 1
+            if size is not None:
+                nbytes = size
+            elif name == "getList":
+                typestring = args[0] if args else kwargs["typestring"]
+                nbytes = len(value) * ELEMENT_SIZES[typestring]
+            elif name == "getTextsBytes":
+                nbytes = sum(len(text) for text in value)
+            elif name == "getText":
+                nbytes = len(value.encode("utf-8"))
+            else:
+                nbytes = len(value)
+            if not self.getter_depth:
+                self.bytes += nbytes
+            counter.add(time.perf_counter() - start, self.draws - draws, nbytes)
+            return value
+        return wrapper
+
+
+@contextmanager
+def instrument(node, stats=None):
+    # with instrument(node) as stats: ... generates with `node` instrumented
+    instrumentation = Instrumentation(stats)
+    instrumentation.attach(node)
+    try:
+        yield instrumentation.stats
+    finally:
+        instrumentation.detach(node)
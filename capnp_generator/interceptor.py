@@ -1,15 +1,143 @@
-from node import StructNode
-
+from .plan import compile_struct
+from .stream import MessageWriter, serialize, DEFAULT_BUFFER_SIZE
 
 
 class Interceptor:
     # This class should take input capnp serialized messages, deserialize them
     # fiddle the contents in a type-aware way, reserialize, and output that data.
-    def __init__(self, schema):
-        self.schema = schema
-        pass
+    #
+    # The walk over each message uses the same generation plans as StructNode
+    # (see plan.py), so no schema reflection happens per message. Every field
+    # present in the message is mutated with probability prob_field: numbers
+    # get bit flips through the RNG.mut* helpers, text and data go through
+    # RNG._mutate_bytes, enums are replaced by a random enumerant and structs,
+    # groups, union arms and lists are walked recursively.
+    def __init__(self, root_node, rng, packed=False, prob_field=0.1):
+        self.root_node = root_node
+        self.schema = root_node.node
+        self.rng = rng
+        self.packed = packed
+        self.prob_field = prob_field
+        # plan id -> { union member name: FieldOp }
+        self.union_ops = {}
 
     def tamper_serialized_bytes(self, type, data):
-        typeInfo = getattr(self.schema, type)
-        message = typeInfo.from_bytes(data)
-        typeNode = StructNode(typeInfo)
\ No newline at end of file
+        # One framed message in, one mutated framed message out
+        typeInfo = self.root_node.structs_by_name[type]
+        plan = compile_struct(typeInfo, self.root_node)
+        if self.packed:
+            message = self.tamper(typeInfo.from_bytes_packed(data), plan)
+        else:
+            with typeInfo.from_bytes(data) as reader:
+                message = self.tamper(reader, plan)
+        return serialize(message, self.packed)
+
+    def tamper_batch(self, type, data):
+        # Any number of concatenated framed messages in, the same number of
+        # mutated ones out
+        typeInfo = self.root_node.structs_by_name[type]
+        plan = compile_struct(typeInfo, self.root_node)
+        if self.packed:
+            readers = typeInfo.read_multiple_bytes_packed(data)
+        else:
+            readers = typeInfo.read_multiple_bytes(data)
+        return b"".join(serialize(self.tamper(reader, plan), self.packed) for reader in readers)
+
+    def tamper_stream(self, type, infile, outfile, buffer_size=DEFAULT_BUFFER_SIZE):
+        # Mutates every message read from `infile` into `outfile` until the
+        # input ends, returns the number of messages written
+        typeInfo = self.root_node.structs_by_name[type]
+        plan = compile_struct(typeInfo, self.root_node)
+        try:
+            infile.fileno()
+            if self.packed:
+                readers = typeInfo.read_multiple_packed(infile)
+            else:
+                readers = typeInfo.read_multiple(infile)
+        except (AttributeError, OSError):
+            # not backed by a file descriptor (BytesIO and the like)
+            if self.packed:
+                readers = typeInfo.read_multiple_bytes_packed(infile.read())
+            else:
+                readers = typeInfo.read_multiple_bytes(infile.read())
+        with MessageWriter(outfile, self.packed, buffer_size) as writer:
+            for reader in readers:
+                writer.write(self.tamper(reader, plan))
+        return writer.messages
+
+    def tamper(self, reader, plan):
+        message = reader.as_builder()
+        self.mutate_struct(message, plan)
+        return message
+
+    def mutate_struct(self, msg, plan):
+        for op in plan.fields:
+            self.mutate_field(msg, op)
+        if plan.union:
+            union_ops = self.union_ops.get(plan.id)
+            if union_ops is None:
+                union_ops = self.union_ops[plan.id] = {op.name: op for op in plan.union}
+            op = union_ops.get(str(msg.which))
+            if op is not None:
+                self.mutate_field(msg, op)
+
+    def mutate_field(self, msg, op):
+        kind = op.kind
+        fieldname = op.name
+        if kind == "primitive":
+            if self.rng.random.random() < self.prob_field:
+                setattr(msg, fieldname, self.rng.mutate_function_map[op.typestring](getattr(msg, fieldname)))
+        elif kind == "enum":
+            if self.rng.random.random() < self.prob_field:
+                setattr(msg, fieldname, self.rng.getEnum(op.enumerants))
+        elif kind == "text":
+            if msg._has(fieldname) and self.rng.random.random() < self.prob_field:
+                setattr(msg, fieldname, self.mutate_text(lambda: getattr(msg, fieldname)))
+        elif kind == "data":
+            if msg._has(fieldname) and self.rng.random.random() < self.prob_field:
+                setattr(msg, fieldname, self.rng._mutate_bytes(getattr(msg, fieldname)))
+        elif kind == "struct":
+            if msg._has(fieldname):
+                self.mutate_struct(getattr(msg, fieldname), op.plan)
+        elif kind == "group":
+            self.mutate_struct(getattr(msg, fieldname), op.plan)
+        elif kind == "list":
+            if msg._has(fieldname):
+                self.mutate_list(getattr(msg, fieldname), op.element)
+
+    def mutate_list(self, l, element):
+        kind = element.kind
+        random = self.rng.random.random
+        if kind == "primitive":
+            mutate = self.rng.mutate_function_map[element.typestring]
+            for i in range(len(l)):
+                if random() < self.prob_field:
+                    l[i] = mutate(l[i])
+        elif kind == "enum":
+            for i in range(len(l)):
+                if random() < self.prob_field:
+                    l[i] = self.rng.getEnum(element.enumerants)
+        elif kind == "text":
+            for i in range(len(l)):
+                if random() < self.prob_field:
+                    l[i] = self.mutate_text(lambda: l[i])
+        elif kind == "data":
+            for i in range(len(l)):
+                if random() < self.prob_field:
+                    l[i] = self.rng._mutate_bytes(l[i])
+        elif kind == "struct":
+            for item in l:
+                self.mutate_struct(item, element.plan)
+        elif kind == "list":
+            for item in l:
+                self.mutate_list(item, element.element)
+
+    def mutate_text(self, get):
+        # Mutated text is written back as raw bytes, so it may not be valid
+        # UTF-8 anymore, and pycapnp can only read text as str. Text that
+        # can't be decoded is replaced with fresh random text.
+        try:
+            data = get().encode()
+        except UnicodeDecodeError:
+            data = self.rng.getTextBytes()
+        return self.rng._mutate_bytes(data)
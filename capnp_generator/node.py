@@ -3,9 +3,12 @@ import pprint
 import os
 import sys
 import site
-import importlib
 import capnp.includes
-from .rng import RNG
+from types import MappingProxyType
+from .rng import RNG, make_sampler
+from .budget import Budget
+from .plan import FieldOp, StructPlan, compile_struct, dump_plans, load_plans
+from . import cache
 
 """
 For the top level schema, the list of all top-level defined structs, 
@@ -36,9 +39,12 @@ type.schema.enumerants, which is a python dict in the format
 { enumerant_name: enumerant_value }
 """
 
+# recursive structs generated per message at most, see StructNode
+MAX_EXPANSIONS = 64
+
 
 class Node:
-    def __init__(self, root_node):
+    def __init__(self, root_node, types=None):
         self.struct_names = []
         self.structs_by_name = {}
         self.structs_by_id = {}
@@ -50,6 +56,11 @@ class Node:
         self.interfaces_by_id = {}
 
         self.node = root_node
+
+        if types is not None:
+            # index previously produced by dump_types(), see cache.py
+            self.load_types(types)
+            return
         
         for node in self.node.schema.node.nestedNodes:
             nodeSchema = getattr(self.node, node.name)
@@ -57,44 +68,161 @@ class Node:
                 self.struct_names.append(node.name)
                 self.structs_by_name[node.name] = nodeSchema
                 self.structs_by_id[node.id] = nodeSchema
-
-                # Here we need to do recursive checking for scoped types within structs.
-                # Each type identified in that way should be added to the *_by_id object etc.
-                # for the parent, and bubbled up eventually to the root
-                nestedNode = Node(nodeSchema)
-                self.struct_names.extend(nestedNode.struct_names)
-                self.structs_by_name.update(nestedNode.structs_by_name)
-                self.structs_by_id.update(nestedNode.structs_by_id)
-
-                self.enum_names.extend(nestedNode.enum_names)
-                self.enums_by_name.update(nestedNode.enums_by_name)
-                self.enums_by_id.update(nestedNode.enums_by_id)
-
-                self.interface_names.extend(nestedNode.interface_names)
-                self.interfaces_by_name.update(nestedNode.interfaces_by_name)
-                self.interfaces_by_id.update(nestedNode.interfaces_by_id)
-
             elif type(nodeSchema) == capnp.lib.capnp._EnumModule:
                 self.enum_names.append(node.name)
                 self.enums_by_name[node.name] = nodeSchema
                 self.enums_by_id[node.id] = nodeSchema
+                continue
             elif type(nodeSchema) == capnp.lib.capnp._InterfaceModule:
                 self.interface_names.append(node.name)
                 self.interfaces_by_name[node.name] = nodeSchema
                 self.interfaces_by_id[node.id] = nodeSchema
             else: # primitive type, const or so
-                pass
+                continue
+
+            # Here we need to do recursive checking for scoped types within structs
+            # and interfaces. Each type identified in that way should be added to the
+            # *_by_id object etc. for the parent, and bubbled up eventually to the root
+            nestedNode = Node(nodeSchema)
+            self.struct_names.extend(nestedNode.struct_names)
+            self.structs_by_name.update(nestedNode.structs_by_name)
+            self.structs_by_id.update(nestedNode.structs_by_id)
+
+            self.enum_names.extend(nestedNode.enum_names)
+            self.enums_by_name.update(nestedNode.enums_by_name)
+            self.enums_by_id.update(nestedNode.enums_by_id)
+
+            self.interface_names.extend(nestedNode.interface_names)
+            self.interfaces_by_name.update(nestedNode.interfaces_by_name)
+            self.interfaces_by_id.update(nestedNode.interfaces_by_id)
+
+    def dump_types(self):
+        # JSON compatible form of the index, as [name, id, qualified name] per
+        # type in discovery order. The qualified name is the path of the type
+        # within its file, e.g. "Person.PhoneNumber".
+        return {
+            kind: [[name_of(module), id, qualified_name(module)] for id, module in types.items()]
+            for kind, types in (("struct", self.structs_by_id), ("enum", self.enums_by_id), ("interface", self.interfaces_by_id))
+        }
+
+    def load_types(self, types):
+        for name, id, qualname in types["struct"]:
+            nodeSchema = self.resolve(qualname)
+            self.struct_names.append(name)
+            self.structs_by_name[name] = nodeSchema
+            self.structs_by_id[id] = nodeSchema
+        for name, id, qualname in types["enum"]:
+            nodeSchema = self.resolve(qualname)
+            self.enum_names.append(name)
+            self.enums_by_name[name] = nodeSchema
+            self.enums_by_id[id] = nodeSchema
+        for name, id, qualname in types["interface"]:
+            nodeSchema = self.resolve(qualname)
+            self.interface_names.append(name)
+            self.interfaces_by_name[name] = nodeSchema
+            self.interfaces_by_id[id] = nodeSchema
+
+    def resolve(self, qualname):
+        nodeSchema = self.node
+        for name in qualname.split("."):
+            nodeSchema = getattr(nodeSchema, name)
+        return nodeSchema
 
     def __repr__(self):
         reprstr = ""
         reprstr += pprint.pformat(self.node.schema.node.to_dict())
         return reprstr
 
+# (canonical path, content digest) -> Node, for every file imported by any
+# RootNode so far, so each file is only loaded and indexed once per process
+# (and again if it was edited since)
+_imports_by_path = {}
+
+def name_of(module):
+    node = module.schema.node
+    return node.displayName[node.displayNamePrefixLength:]
+
+
+def qualified_name(module):
+    return module.schema.node.displayName.partition(":")[2]
+
+
+# field types that refer to another schema node
+_SCHEMA_TYPES = ("struct", "enum", "interface", "list")
+
+
+def _capnp_search_path():
+    USER_SITE_PACKAGES = [site.getusersitepackages()]
+    GLOBAL_SITE_PACKAGES = site.getsitepackages()
+    return USER_SITE_PACKAGES + GLOBAL_SITE_PACKAGES + sys.path + ["/usr/local/include"]
+
+
+def _resolve_import(import_name, base_dir, search_path):
+    for directory in [base_dir] + search_path:
+        path = os.path.join(directory, import_name)
+        if os.path.isfile(path):
+            return os.path.realpath(path)
+    raise FileNotFoundError(f"Import failed: {import_name} not found in {base_dir} or the capnp search path")
+
+
+def _load_import(path, search_path, types=None):
+    key = (path, cache.file_digest(path))
+    import_node = _imports_by_path.get(key)
+    if import_node is None:
+        # Every file gets a parser of its own, rather than the global one
+        # (where its IDs would stay registered and make any later
+        # capnp.load() of a file importing it fail with "Duplicate ID") or
+        # a shared one (where a copy of the file at another path would).
+        import_node = Node(capnp.SchemaParser().load(path, imports=search_path), types)
+        _imports_by_path[key] = import_node
+    return import_node
+
+
+def _collect_files(schema, seen, files):
+    # Adds the file `schema` (a struct, enum or interface schema) is declared in
+    # to `files`, and recurses into every type it refers to.
+    node = schema.node
+    if node.id in seen:
+        return
+    seen.add(node.id)
+    files.add(node.displayName.partition(":")[0])
+    which = node.which
+    if which == "struct":
+        for field in node.struct.fields:
+            if field.which == "group":
+                _collect_files(schema.fields[field.name].schema, seen, files)
+            elif field.slot.type.which in _SCHEMA_TYPES:
+                _collect_type_files(field.slot.type, schema.fields[field.name].schema, seen, files)
+    elif which == "interface":
+        for method in schema.methods.values():
+            _collect_files(method.param_type, seen, files)
+            _collect_files(method.result_type, seen, files)
+
+
+def _collect_type_files(fieldtype, schema, seen, files):
+    while fieldtype.which == "list":
+        fieldtype = fieldtype.list.elementType
+        if fieldtype.which not in _SCHEMA_TYPES:
+            return
+        schema = schema.elementType
+    _collect_files(schema, seen, files)
+
+
 class RootNode(Node):
-    def __init__(self, node):
-        super().__init__(node)
+    def __init__(self, node, cache_dir=None):
+        # With cache_dir set, the index, imports and generation plans are
+        # stored there after the first run and reused while none of the
+        # schema files change, see cache.py.
+        index = cache.load_index(cache_dir, node.__file__) if cache_dir is not None else None
+        super().__init__(node, index["types"] if index is not None else None)
+        own_types = self.dump_types() if cache_dir is not None and index is None else None
+        # generation plans of every struct reachable from this root, see plan.py
+        self.plans = {}
         capnp.lib.capnp.cleanup_global_schema_parser()
-        self.set_imports()
+        if index is not None:
+            self.load_imports(index["imports"])
+        else:
+            self.set_imports()
         for node in self.imports:
             self.struct_names.extend(node.struct_names)
             self.structs_by_name.update(node.structs_by_name)
@@ -107,49 +235,59 @@ class RootNode(Node):
             self.interface_names.extend(node.interface_names)
             self.interfaces_by_name.update(node.interfaces_by_name)
             self.interfaces_by_id.update(node.interfaces_by_id)
+        self.registry = TypeRegistry(self)
+        if index is not None:
+            self.plans = load_plans(index["plans"], self.registry.structs_by_id)
+        elif cache_dir is not None:
+            for module in self.registry.structs_by_id.values():
+                compile_struct(module, self)
+            cache.save_index(cache_dir, self.node.__file__, {
+                "types": own_types,
+                "imports": [[name, self.import_paths[name], self.imports_by_name[name].dump_types()] for name in self.imports_by_name],
+                "plans": dump_plans(self.plans),
+            })
 
     def set_imports(self):
+        # The files to import are taken from the compiled schema rather than from
+        # the `using ... import` lines: every type reachable from this file is
+        # walked, and whichever files they are declared in get loaded. Those
+        # display names are relative to this file's directory or to one of the
+        # import search paths. Each file is loaded and indexed only once per
+        # process (see _load_import), no matter how many roots import it.
         self.imports_by_name = {}
+        self.import_paths = {}
         self.imports = []
-        raw_data_file = open(self.node.__file__, "r")
-        raw_data = raw_data_file.readlines()
-        raw_data_file.close()
-        import_lines = [line for line in raw_data if line.startswith("using")]
-        for importline in import_lines:
-            # print(importline)
-            if "import" not in importline:
-                continue
-            import_name = importline.split(" ")[1]
-            import_path = importline.split("\"")[1]
-            if import_path.startswith("/capnp/"):
+        own_file = self.node.schema.node.displayName
+        base_dir = os.path.dirname(os.path.realpath(self.node.__file__))
+        search_path = _capnp_search_path()
+        for import_name in sorted(self._referenced_files()):
+            if import_name == own_file:
                 continue
-            if "/" in import_path:
-                import_path = import_path[1:]
-
-                import_path = import_path.replace("/", ".").replace(".capnp", "_capnp")
-                import_node = RootNode(importlib.import_module(import_path))
-            else:
-                import_path = os.path.join(os.path.dirname(self.node.__file__), import_path)
-                sys.path.append("/usr/local/include")
-                USER_SITE_PACKAGES = [site.getusersitepackages()]
-                GLOBAL_SITE_PACKAGES = site.getsitepackages()
-                CAPNP_LIBRARY_SEARCH_PATH = USER_SITE_PACKAGES + GLOBAL_SITE_PACKAGES + sys.path
-                import_node = RootNode(capnp.load(import_path, imports=CAPNP_LIBRARY_SEARCH_PATH))
-
-                # print(sys.path)
-                # import_path = os.path.join(sys.path, import_path)
-            # else:
-                # import_path = os.path.join(os.path.dirname(self.node.__file__), import_path)
-
-            # sys.path.append("/usr/local/include")
-            # USER_SITE_PACKAGES = [site.getusersitepackages()]
-            # GLOBAL_SITE_PACKAGES = site.getsitepackages()
-            # CAPNP_LIBRARY_SEARCH_PATH = USER_SITE_PACKAGES + GLOBAL_SITE_PACKAGES + sys.path
-            # import_node = RootNode(capnp.load(import_path, imports=CAPNP_LIBRARY_SEARCH_PATH))
+            path = _resolve_import(import_name, base_dir, search_path)
+            import_node = _load_import(path, search_path)
+            self.imports.append(import_node)
+            self.imports_by_name[import_name] = import_node
+            self.import_paths[import_name] = path
 
+    def load_imports(self, imports):
+        # set_imports() for a cached index: the import graph is already known
+        self.imports_by_name = {}
+        self.import_paths = {}
+        self.imports = []
+        search_path = _capnp_search_path()
+        for import_name, path, types in imports:
+            import_node = _load_import(path, search_path, types)
             self.imports.append(import_node)
             self.imports_by_name[import_name] = import_node
+            self.import_paths[import_name] = path
 
+    def _referenced_files(self):
+        files = set()
+        seen = set()
+        for types in (self.structs_by_id, self.enums_by_id, self.interfaces_by_id):
+            for module in types.values():
+                _collect_files(module.schema, seen, files)
+        return files
 
     def get_message_types(self):
         # The unit of communication in Cap'n Proto is a "message". A message is a tree of 
@@ -165,155 +303,309 @@ class RootNode(Node):
             print(enumname)
 
 
+class TypeRegistry:
+    # Read-only index of every type known to a RootNode, including nested and
+    # imported ones. Built once per RootNode and shared by every StructNode
+    # created from it, so that creating a StructNode doesn't have to walk the
+    # schema or copy any of the lookup tables.
+    __slots__ = (
+        "struct_names", "structs_by_name", "structs_by_id",
+        "enum_names", "enums_by_name", "enums_by_id",
+        "interface_names", "interfaces_by_name", "interfaces_by_id",
+    )
+
+    def __init__(self, root_node):
+        self.struct_names = tuple(root_node.struct_names)
+        self.structs_by_name = MappingProxyType(dict(root_node.structs_by_name))
+        self.structs_by_id = MappingProxyType(dict(root_node.structs_by_id))
+        self.enum_names = tuple(root_node.enum_names)
+        self.enums_by_name = MappingProxyType(dict(root_node.enums_by_name))
+        self.enums_by_id = MappingProxyType(dict(root_node.enums_by_id))
+        self.interface_names = tuple(root_node.interface_names)
+        self.interfaces_by_name = MappingProxyType(dict(root_node.interfaces_by_name))
+        self.interfaces_by_id = MappingProxyType(dict(root_node.interfaces_by_id))
+
+
 class StructNode(Node):
-    def __init__(self, node, root_node: RootNode, rng):
-        super().__init__(node)
+    def __init__(self, node, root_node: RootNode, rng, in_place=True, budget: Budget = None, max_recursion=8, recursion_decay=0.75, values=None, max_expansions=MAX_EXPANSIONS):
+        # Node.__init__ is deliberately not called: all type lookups go through
+        # the registry shared with the root node.
+        self.node = node
         self.root_node = root_node
-        self.enums_by_id.update(self.root_node.enums_by_id)
-        self.structs_by_id.update(self.root_node.structs_by_id)
+        self.registry: TypeRegistry = root_node.registry
+        self.struct_names = self.registry.struct_names
+        self.structs_by_name = self.registry.structs_by_name
+        self.structs_by_id = self.registry.structs_by_id
+        self.enum_names = self.registry.enum_names
+        self.enums_by_name = self.registry.enums_by_name
+        self.enums_by_id = self.registry.enums_by_id
+        self.interface_names = self.registry.interface_names
+        self.interfaces_by_name = self.registry.interfaces_by_name
+        self.interfaces_by_id = self.registry.interfaces_by_id
+        # Build nested structs directly inside the parent message. With
+        # in_place=False each nested struct is generated as a separate message
+        # and copied into its parent, which is much slower but kept around for
+        # schemas where writing through the parent builder misbehaves.
+        self.in_place = in_place
         self.rng: RNG = rng
+        # Limits on the size of every message, see budget.py. usage tracks
+        # the message being generated.
+        self.budget = budget
+        self.usage = None
+        # Recursive types (see plan.py) are expanded at most max_recursion
+        # levels deep, and at recursion level n only with probability
+        # recursion_decay ** n. recursion is the level of the struct being
+        # generated. The decay alone doesn't bound a message, since every
+        # element of a recursive list is expanded, so at most max_expansions
+        # recursive structs (fields and list elements) are generated per
+        # message; expansions counts them.
+        self.max_recursion = max_recursion
+        self.recursion_decay = recursion_decay
+        self.recursion = 0
+        self.max_expansions = max_expansions
+        self.expansions = 0
         self.types = { "struct": self.structs_by_id, "enum": self.enums_by_id }
-        # print(self.node.schema.node)
+        # The schema is only walked once per type, see plan.py
+        self.plan: StructPlan = compile_struct(self.node, self.root_node)
+        # values maps numeric fields, named "Struct.field" (groups included,
+        # e.g. "Person.employment.selfEmployed"), to {"weights": ..., "dictionary":
+        # ...} for make_sampler(). For list fields the elements are drawn from
+        # it. Other fields draw from the RNG's samplers.
+        self.field_samplers = self.resolve_values(values) if values else {}
+
+    def resolve_values(self, values):
+        # {FieldOp: WeightedSampler} for the values parameter, keyed on the op
+        # the values are drawn for (the innermost element op of lists)
+        ops = {}
+        plans = [self.plan]
+        seen = set()
+        while plans:
+            plan = plans.pop()
+            if plan.id in seen:
+                continue
+            seen.add(plan.id)
+            struct_name = plan.name.partition(":")[2] or plan.name
+            for op in plan.fields + plan.union:
+                ops[f"{struct_name}.{op.name}"] = op
+                while op.kind == "list":
+                    op = op.element
+                if op.plan is not None:
+                    plans.append(op.plan)
+        samplers = {}
+        for name, spec in values.items():
+            op = ops.get(name)
+            if op is None:
+                raise ValueError(f"no field {name!r} in {self.plan.name} or the types it contains")
+            while op.kind == "list":
+                op = op.element
+            if op.kind != "primitive" or op.typestring == "bool":
+                raise ValueError(f"field {name!r} is not numeric, or a list of numbers")
+            samplers[op] = make_sampler(op.typestring, spec.get("weights"), spec.get("dictionary"))
+        return samplers
 
     def enumerate_fields(self):
         return [field for field in self.node.schema.node.struct.fields]
 
-    def _is_primitive_numerial_type(self, typestring):
-        primtypes = [
-            "uint8",
-            "uint16",
-            "uint32",
-            "uint64",
-            "int8",
-            "int16",
-            "int32",
-            "int64",
-            "float32",
-            "float64",
-            "bool"
-        ]
-        return typestring in primtypes
-
     def generate(self):
-        msg = self.node.new_message()
-        for field in self.enumerate_fields():
-            self.generate_field(msg, field)
+        return self.generate_into(self.node.new_message())
+
+    def generate_into(self, msg):
+        # generate() into `msg`, an empty builder of this node's struct type
+        # made elsewhere (an RPC request or the results of a call)
+        if self.budget is not None:
+            self.usage = self.budget.start(self.plan)
+        self.recursion = 0
+        self.expansions = 0
+        self.fill(msg, self.plan)
+        self.rng.advance()
         return msg
 
-    def generate_field(self, msg, field, original_field=None):
-        fieldname = field.name
-        if self.is_union_field(field):
-            original_field = field
-            field = self.choose_union_type(field)
-            # TODO: figure out why this fails with some unions
-            try:
-                getattr(msg, fieldname)
-            except Exception as e:
+    def generate_at(self, index):
+        # Message `index` of the run, the same as the index+1th generate()
+        # after creating the RNG. Only the messages since the last RNG
+        # checkpoint (see RNG.advance) are generated to get there.
+        for _ in range(index - self.rng.seek(index)):
+            self.generate()
+        return self.generate()
+
+    def fill(self, msg, plan: StructPlan):
+        for op in plan.fields:
+            self.generate_field(msg, op)
+        if plan.union:
+            self.generate_field(msg, plan.union[self.rng.getRandom(0, len(plan.union) - 1)])
+
+    def generate_field(self, msg, op: FieldOp):
+        kind = op.kind
+        fieldname = op.name
+        if kind == "primitive":
+            if self.field_samplers and op in self.field_samplers:
+                setattr(msg, fieldname, self.field_samplers[op].sample(self.rng.random))
+            else:
+                setattr(msg, fieldname, self.rng.type_function_map[op.typestring]())
+        elif kind == "text":
+            text = self.generate_text()
+            if text is not None:
+                setattr(msg, fieldname, text)
+        elif kind == "data":
+            setattr(msg, fieldname, self.rng.getBlob(10 if self.usage is None else self.usage.blob(10)))
+        elif kind == "enum":
+            setattr(msg, fieldname, self.rng.getEnum(op.enumerants))
+        elif kind == "list":
+            length = self.list_length(op)
+            if length is None:
                 return
-            self.generate_field(getattr(msg, fieldname), field, original_field)
+            if op.element.recursive:
+                self.recursion += 1
+                self.generate_list(msg, op, length)
+                self.recursion -= 1
+            else:
+                self.generate_list(msg, op, length)
+        elif kind == "group":
+            # init() also selects the group when it is a member of a union
+            self.fill(msg.init(fieldname), op.plan)
+        elif kind == "void":
+            setattr(msg, fieldname, None)
+        elif kind == "struct":
+            if self.expand_struct(op):
+                self.generate_struct(msg, op)
+                self.leave_struct(op)
+            elif op.discriminant is not None:
+                # not expanded, but the union member still has to be selected
+                if self.usage is not None:
+                    self.usage.empty_struct(op.plan)
+                msg.init(fieldname)
+
+    def generate_text(self):
+        # Random text, or None if it doesn't fit the budget
+        if self.usage is None:
+            return self.rng.getTextBytes()
+        length = self.usage.text(self.rng.getRandom(0, 10))
+        return self.rng.getTextBytes(length) if length is not None else None
+
+    def list_length(self, op: FieldOp):
+        # Length of a new list for the list op `op`, or None if it stays null
+        recursive = op.element.recursive
+        if recursive and not self.expand_recursive():
+            return None
+        length = self.rng.getRandom(0, 10)
+        if recursive:
+            length = min(length, self.max_expansions - self.expansions)
+        if self.usage is not None:
+            length = self.usage.list(op.element, length)
+        if recursive and length is not None:
+            self.expansions += length
+        return length
+
+    def expand_recursive(self):
+        # Whether to generate one more level of a recursive type
+        if self.recursion >= self.max_recursion or self.expansions >= self.max_expansions:
+            return False
+        return self.rng.random.random() < self.recursion_decay ** self.recursion
+
+    def expand_struct(self, op: FieldOp):
+        # Whether the struct field `op` is generated, given the recursion
+        # limits and the budget. If it is, leave_struct() has to follow.
+        if op.recursive and not self.expand_recursive():
+            return False
+        usage = self.usage
+        if usage is not None:
+            if not usage.struct(op.plan):
+                return False
+            usage.depth += 1
+        if op.recursive:
+            self.recursion += 1
+            self.expansions += 1
+        return True
+
+    def leave_struct(self, op: FieldOp):
+        if op.recursive:
+            self.recursion -= 1
+        if self.usage is not None:
+            self.usage.depth -= 1
+
+    def generate_struct(self, msg, op: FieldOp):
+        fieldname = op.name
+        if self.in_place:
+            self.fill(msg.init(fieldname), op.plan)
             return
-        typestring = self.get_type_for_field(field)
-        if self._is_primitive_numerial_type(typestring):
-            setattr(msg, fieldname, self.rng.type_function_map[typestring]())
-        elif typestring == "text":
-            setattr(msg, fieldname, self.rng.getText())
-        elif typestring == "data":
-            setattr(msg, fieldname, self.rng.getBlob(10))
-        elif typestring == "struct":
-            nodeId = self.node.schema.node.id
-            id = field.slot.type.struct.typeId
-            if nodeId == id:
-                # print("recursive structure - bailing on generation of field to avoid infinite loop")
-                return
-
-            # for s in self.structs_by_id:
-                # print(self.structs_by_id[s].schema.node)
-            typedef = self.structs_by_id[id]
-            innerStruct = StructNode(typedef, self.root_node, self.rng)
-            inner_msg = innerStruct.generate()
-            # Extreme jank below, this is here to accomodate imported structs, unions, and unions 
-            # that contain imported structs. I do not know why the second try is necessary, or why
-            # the redundant except that just does the original thing makes it work, reading this code,
-            # the second except should never be reached (as it would have worked the first time), but
-            # you can remove it and try it yourself if you don't believe me, it breaks unless its
-            # there.
-            try:
-                setattr(msg, fieldname, inner_msg.to_dict())
-            except capnp.lib.capnp.KjException as e:
-                if "isSetInUnion" in e.message:
-                    try:
-                        setattr(msg, fieldname, inner_msg)
-                    except capnp.lib.capnp.KjException as e:
-                        setattr(msg, fieldname, inner_msg.to_dict())
-                else:
-                    raise e
-        elif typestring == "list":
-            length = self.rng.getRandom(0, 10)
-            # msg.init(fieldname, length)
-            self.generate_list(msg, field, length)
-            pass
-        elif typestring == "enum":
-            id = field.slot.type.enum.typeId
-            typedef = self.enums_by_id[id]
-            enumerants = list(typedef.schema.enumerants.keys())
-            setattr(msg, fieldname, self.rng.getEnum(enumerants))
-
-    def generate_list(self, msg, field, length):
-        memberType = field.slot.type
-        innerTypeString = list(memberType.list.elementType.to_dict().keys())[0]
-        if self._is_primitive_numerial_type(innerTypeString):
-            setattr(msg, field.name, self.rng.getList(innerTypeString, length))
-        if innerTypeString == "struct" or innerTypeString == "enum":
-            innerTypeId = getattr(memberType.list.elementType, innerTypeString).typeId
-            innerType = self.types[innerTypeString][innerTypeId]
-            if innerTypeString == "struct":
-                l = msg.init(field.name, length)
-                structs = [StructNode(innerType, self.root_node, self.rng).generate() for _ in range(0, length)]
-                self.set_structs_in_array(l, structs, length)
-                # IF it is a list of structs, and the struct type that makes up the elements
-                # contains a list as one of its fields, then those list fields must be
-                # manually initialized. This must be recursive.
-                for i, elem in enumerate(l):
-                    for f in elem.schema.node.struct.fields:
-                        nested_struct_field_type = self.get_type_for_field(f)
-                        if nested_struct_field_type == "list":
-                            innerLength = len(getattr(structs[i], f.name))
-                            inner_l = elem.init(f.name, innerLength)
-                            self.set_structs_in_array(inner_l, getattr(structs[i], f.name), innerLength)
-
-
-            elif innerTypeString == "enum":
-                setattr(msg, field.name, [self.rng.getEnum(list(innerType.schema.enumerants.keys())) for _ in range(0, length)])
-        if innerTypeString == "list":
-            innerLength = self.rng.getRandom(0, 10)
-            # TODO
-            # setattr(msg, field.name, [self.generate_list(msg, field, innerLength) for _ in range(0, length)])
-            setattr(msg, field.name, [])
-        if innerTypeString == "text":
-            setattr(msg, field.name, [self.rng.getText() for _ in range(0, length)])
-        if innerTypeString == "data":
-            setattr(msg, field.name, [self.rng.getBlob(self.rng.getRandom(0, 10)) for _ in range(0, length)])
-
-    def set_structs_in_array(self, d, s, length):
-        for i in range(length):
-            for key in d[i].to_dict().keys():
-                setattr(d[i], key, getattr(s[i], key))
-
-
-    def is_union_field(self, field):
+        inner_msg = op.plan.module.new_message()
+        self.fill(inner_msg, op.plan)
+        # Extreme jank below, this is here to accomodate imported structs, unions, and unions 
+        # that contain imported structs. I do not know why the second try is necessary, or why
+        # the redundant except that just does the original thing makes it work, reading this code,
+        # the second except should never be reached (as it would have worked the first time), but
+        # you can remove it and try it yourself if you don't believe me, it breaks unless its
+        # there.
         try:
-            field.slot.type
+            setattr(msg, fieldname, inner_msg.to_dict())
         except capnp.lib.capnp.KjException as e:
             if "isSetInUnion" in e.message:
-                return True 
+                try:
+                    setattr(msg, fieldname, inner_msg)
+                except capnp.lib.capnp.KjException as e:
+                    setattr(msg, fieldname, inner_msg.to_dict())
             else:
                 raise e
-        return False
 
-    def choose_union_type(self, field):
-        options = self.node.schema.fields[field.name].schema.node.struct.fields
-        return options[self.rng.getRandom(0, len(options) - 1)]
+    def generate_list(self, msg, op: FieldOp, length):
+        element = op.element
+        kind = element.kind
+        if kind == "primitive":
+            setattr(msg, op.name, self.rng.getList(element.typestring, length, self.field_samplers.get(element)))
+        elif kind == "struct":
+            # Elements are filled directly in the list, like nested lists
+            self.fill_list(msg.init(op.name, length), element, length)
+        elif kind == "enum":
+            setattr(msg, op.name, [self.rng.getEnum(element.enumerants) for _ in range(0, length)])
+        elif kind == "list":
+            # Nested lists are built through the list builders themselves,
+            # without going through python lists
+            self.fill_list(msg.init(op.name, length), element, length)
+        elif kind == "text":
+            if self.usage is None:
+                setattr(msg, op.name, self.rng.getTextsBytes(length))
+            else:
+                self.fill_list(msg.init(op.name, length), element, length)
+        elif kind == "data":
+            if self.usage is None:
+                setattr(msg, op.name, [self.rng.getBlob(self.rng.getRandom(0, 10)) for _ in range(0, length)])
+            else:
+                setattr(msg, op.name, [self.rng.getBlob(self.usage.blob(self.rng.getRandom(0, 10))) for _ in range(0, length)])
+
+    def fill_list(self, l, element: FieldOp, length):
+        # Fills the list builder `l` of `length` elements of type `element`
+        # in place
+        kind = element.kind
+        if kind == "primitive":
+            for i, value in enumerate(self.rng.getList(element.typestring, length, self.field_samplers.get(element))):
+                l[i] = value
+        elif kind == "enum":
+            for i in range(length):
+                l[i] = self.rng.getEnum(element.enumerants)
+        elif kind == "text":
+            for i in range(length):
+                text = self.generate_text()
+                if text is not None:
+                    l[i] = text
+        elif kind == "data":
+            for i in range(length):
+                size = self.rng.getRandom(0, 10)
+                l[i] = self.rng.getBlob(size if self.usage is None else self.usage.blob(size))
+        elif kind == "struct":
+            if self.usage is not None:
+                self.usage.depth += 1
+            for i in range(length):
+                self.fill(l[i], element.plan)
+            if self.usage is not None:
+                self.usage.depth -= 1
+        elif kind == "list":
+            for i in range(length):
+                inner_length = self.list_length(element)
+                if inner_length is None:
+                    continue
+                if element.element.recursive:
+                    self.recursion += 1
+                self.fill_list(l.init(i, inner_length), element.element, inner_length)
+                if element.element.recursive:
+                    self.recursion -= 1
 
-    def get_type_for_field(self, field) -> str:
-        typestring = list(field.slot.type.to_dict().keys())[0]
-        return typestring
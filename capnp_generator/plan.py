@@ -0,0 +1,254 @@
+"""
+Generation plans. Working out what each field of a struct is (slot or group,
+union member or not, which type, which enum it refers to, ...) takes a fair
+amount of schema reflection through pycapnp, and none of it changes between
+messages. compile_struct() does that work once per struct type and returns a
+StructPlan, a flat list of FieldOps with everything the generator needs
+already resolved. StructNode.generate() then only has to run the plan.
+
+Plans are cached per RootNode (in root_node.plans), keyed by node id. A plan
+is registered in the cache before its fields are compiled, so a struct that
+refers to itself, directly or through other structs, compiles to a plan that
+points back at itself instead of recursing forever.
+
+Once a struct and everything reachable from it is compiled, the plan graph
+is searched for cycles (strongly connected components), and every struct
+field or list element that leads back into its own component is marked
+recursive. Those are the only places the generator has to decide whether to
+stop expanding, see StructNode.expand_recursive().
+"""
+
+PRIMITIVE_TYPES = frozenset([
+    "uint8",
+    "uint16",
+    "uint32",
+    "uint64",
+    "int8",
+    "int16",
+    "int32",
+    "int64",
+    "float32",
+    "float64",
+    "bool"
+])
+
+# discriminantValue of fields that aren't part of a union
+NO_DISCRIMINANT = 0xffff
+
+
+class FieldOp:
+    # A single resolved generation step. For list element types the same
+    # class is used with name set to None.
+    #
+    # kind is one of:
+    #   "primitive" - typestring is the key into RNG.type_function_map
+    #   "text", "data", "void"
+    #   "enum"      - enumerants is the tuple of enumerant names
+    #   "struct"    - plan is the StructPlan of the field type, recursive is
+    #                 set if that type can (indirectly) contain this field
+    #   "group"     - plan is the StructPlan of the group
+    #   "list"      - element is the FieldOp of the element type
+    #   "skip"      - nothing is generated for this field
+    #
+    # offset is the slot offset of the field (in multiples of its own size in
+    # the data section, or the index in the pointer section for pointer
+    # types) and discriminant its value in the enclosing union, if any.
+    __slots__ = ("name", "kind", "typestring", "type_id", "enumerants", "plan", "element", "offset", "discriminant", "recursive")
+
+    def __init__(self, name, kind, typestring=None, type_id=None, enumerants=None, plan=None, element=None, offset=None, discriminant=None, recursive=False):
+        self.name = name
+        self.kind = kind
+        self.typestring = typestring
+        self.type_id = type_id
+        self.enumerants = enumerants
+        self.plan = plan
+        self.element = element
+        self.offset = offset
+        self.discriminant = discriminant
+        self.recursive = recursive
+
+    def __repr__(self):
+        return f"FieldOp({self.name!r}, {self.kind!r}, {self.typestring!r})"
+
+
+class StructPlan:
+    # fields are always generated, exactly one of union is chosen per message.
+    # module is the _StructModule for real structs and None for groups, which
+    # can't be instantiated on their own. The union discriminant is stored at
+    # discriminant_offset (in 16 bit units) in the data section. data_words
+    # and pointer_words are the size of the struct's sections (those of the
+    # enclosing struct for groups).
+    __slots__ = ("id", "name", "module", "fields", "union", "discriminant_offset", "data_words", "pointer_words")
+
+    def __init__(self, id, name, module, discriminant_offset=None, data_words=0, pointer_words=0):
+        self.id = id
+        self.name = name
+        self.module = module
+        self.fields = []
+        self.union = []
+        self.discriminant_offset = discriminant_offset
+        self.data_words = data_words
+        self.pointer_words = pointer_words
+
+    def __repr__(self):
+        return f"StructPlan({self.name!r}, fields={self.fields!r}, union={self.union!r})"
+
+
+def compile_struct(module, root_node):
+    # Return the plan for the struct type `module`, compiling it on first use.
+    plan = root_node.plans.get(module.schema.node.id)
+    if plan is None:
+        plan = _compile_struct(module, root_node)
+        mark_recursion(plan)
+    return plan
+
+
+def _compile_struct(module, root_node):
+    node = module.schema.node
+    plan = root_node.plans.get(node.id)
+    if plan is None:
+        plan = StructPlan(node.id, node.displayName, module, node.struct.discriminantOffset, node.struct.dataWordCount, node.struct.pointerCount)
+        root_node.plans[node.id] = plan
+        _compile_fields(plan, module.schema, root_node)
+    return plan
+
+
+def _compile_group(schema, root_node):
+    node = schema.node
+    plan = root_node.plans.get(node.id)
+    if plan is None:
+        plan = StructPlan(node.id, node.displayName, None, node.struct.discriminantOffset, node.struct.dataWordCount, node.struct.pointerCount)
+        root_node.plans[node.id] = plan
+        _compile_fields(plan, schema, root_node)
+    return plan
+
+
+def _compile_fields(plan, schema, root_node):
+    for field in schema.node.struct.fields:
+        if field.which == "group":
+            op = FieldOp(field.name, "group", plan=_compile_group(schema.fields[field.name].schema, root_node))
+        else:
+            op = _compile_type(field.slot.type, root_node, field.name)
+            op.offset = field.slot.offset
+        if field.discriminantValue == NO_DISCRIMINANT:
+            plan.fields.append(op)
+        else:
+            op.discriminant = field.discriminantValue
+            plan.union.append(op)
+
+
+def _compile_type(fieldtype, root_node, name=None):
+    typestring = str(fieldtype.which)
+    if typestring in PRIMITIVE_TYPES:
+        return FieldOp(name, "primitive", typestring)
+    if typestring in ("text", "data", "void"):
+        return FieldOp(name, typestring, typestring)
+    if typestring == "enum":
+        id = fieldtype.enum.typeId
+        enumerants = tuple(root_node.registry.enums_by_id[id].schema.enumerants.keys())
+        return FieldOp(name, "enum", typestring, id, enumerants=enumerants)
+    if typestring == "struct":
+        id = fieldtype.struct.typeId
+        return FieldOp(name, "struct", typestring, id, plan=_compile_struct(root_node.registry.structs_by_id[id], root_node))
+    if typestring == "list":
+        element = _compile_type(fieldtype.list.elementType, root_node)
+        return FieldOp(name, "list", typestring, element=element)
+    # interfaces and anyPointer can't be generated
+    return FieldOp(name, "skip", typestring)
+
+
+def _edges(plan):
+    # (op, target plan) for every struct or group field of `plan`, looking
+    # through lists to their element type
+    for op in plan.fields + plan.union:
+        while op.kind == "list":
+            op = op.element
+        if op.kind in ("struct", "group"):
+            yield op, op.plan
+
+
+def mark_recursion(root):
+    # Marks every struct op reachable from the plan `root` that is part of a
+    # cycle in the plan graph as recursive (Tarjan's algorithm). Groups are
+    # never marked, they are part of the struct that holds them.
+    index = {}
+    lowlink = {}
+    component = {}
+    plans = []
+    stack = []
+    on_stack = set()
+
+    def visit(plan):
+        index[plan.id] = lowlink[plan.id] = len(index)
+        plans.append(plan)
+        stack.append(plan)
+        on_stack.add(plan.id)
+        for _, target in _edges(plan):
+            if target.id not in index:
+                visit(target)
+                lowlink[plan.id] = min(lowlink[plan.id], lowlink[target.id])
+            elif target.id in on_stack:
+                lowlink[plan.id] = min(lowlink[plan.id], index[target.id])
+        if lowlink[plan.id] == index[plan.id]:
+            while True:
+                member = stack.pop()
+                on_stack.discard(member.id)
+                component[member.id] = plan.id
+                if member is plan:
+                    break
+
+    visit(root)
+    for plan in plans:
+        for op, target in _edges(plan):
+            if op.kind == "struct":
+                op.recursive = component[target.id] == component[plan.id]
+
+def dump_plans(plans):
+    # JSON compatible form of a plan cache, see load_plans()
+    return [
+        [plan.id, plan.name, plan.module is not None, [_dump_op(op) for op in plan.fields], [_dump_op(op) for op in plan.union], plan.discriminant_offset, plan.data_words, plan.pointer_words]
+        for plan in plans.values()
+    ]
+
+
+def load_plans(data, structs_by_id):
+    # Rebuild a plan cache from dump_plans() output. All plans are created
+    # before any fields so references between them (including cycles) resolve.
+    plans = {}
+    for id, name, is_struct, _, _, discriminant_offset, data_words, pointer_words in data:
+        plans[id] = StructPlan(id, name, structs_by_id[id] if is_struct else None, discriminant_offset, data_words, pointer_words)
+    for id, _, _, fields, union, _, _, _ in data:
+        plans[id].fields = [_load_op(op, plans) for op in fields]
+        plans[id].union = [_load_op(op, plans) for op in union]
+    return plans
+
+
+def _dump_op(op):
+    return [
+        op.name,
+        op.kind,
+        op.typestring,
+        op.type_id,
+        list(op.enumerants) if op.enumerants is not None else None,
+        op.plan.id if op.plan is not None else None,
+        _dump_op(op.element) if op.element is not None else None,
+        op.offset,
+        op.discriminant,
+        op.recursive
+    ]
+
+
+def _load_op(data, plans):
+    name, kind, typestring, type_id, enumerants, plan_id, element, offset, discriminant, recursive = data
+    return FieldOp(
+        name,
+        kind,
+        typestring,
+        type_id,
+        enumerants=tuple(enumerants) if enumerants is not None else None,
+        plan=plans[plan_id] if plan_id is not None else None,
+        element=_load_op(element, plans) if element is not None else None,
+        offset=offset,
+        discriminant=discriminant,
+        recursive=recursive
+    )
@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import sys
+from .corpus import DEFAULT_STEP, MANIFEST_NAME, _load_root, add_budget_arguments, budget_from_args, regenerate_messages
+from .node import StructNode
+from .rng import RNG
+from .stream import MessageWriter
+
+"""
+Replays messages of a run by index. A run is identified by its schema, root
+type, seed, RNG backend, checkpoint step and budget: with those,
+StructNode.generate_at() gets to any message after at most `step` - 1 others
+(see RNG.advance), so a crashing message can be regenerated from its index
+alone.
+
+    python -m capnp_generator.replay schema.capnp Person 0x1234 --range 3000000
+    python -m capnp_generator.replay --manifest corpus/ --range 100:200 --text
+
+Messages are written framed (packed with --packed) to --output or stdout,
+or printed with their index with --text.
+"""
+
+
+def parse_range(text):
+    # "N" is message N, "A:B" messages A to B-1
+    start, sep, stop = text.partition(":")
+    start = int(start, 0)
+    stop = int(stop, 0) if sep else start + 1
+    if stop <= start:
+        raise argparse.ArgumentTypeError(f"empty range {text!r}")
+    return start, stop
+
+
+def replay_messages(node, start, stop):
+    # Yields messages start..stop-1 of the run `node` (a StructNode with a
+    # fresh or any other RNG of that run) generates
+    if start >= stop:
+        return
+    yield node.generate_at(start)
+    for _ in range(start + 1, stop):
+        yield node.generate()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="regenerate messages of a run or corpus by index")
+    parser.add_argument("schema", nargs="?", help="capnp schema file")
+    parser.add_argument("type", nargs="?", help="name of the root struct type")
+    parser.add_argument("seed", nargs="?", type=lambda s: int(s, 0), help="seed of the run")
+    parser.add_argument("--manifest", help="replay a corpus, given its directory or manifest.json, instead")
+    parser.add_argument("--range", action="append", type=parse_range, required=True, help="message index N or range A:B (end excluded), repeatable")
+    parser.add_argument("--step", type=int, default=DEFAULT_STEP, help=f"messages between RNG checkpoints of the run (default {DEFAULT_STEP})")
+    parser.add_argument("--backend", default="random", help="RNG backend (random, numpy, pcg64)")
+    parser.add_argument("--cache-dir", default=None, help="schema index cache directory")
+    parser.add_argument("--packed", action="store_true", help="write packed messages")
+    parser.add_argument("--output", help="file to write the messages to (default stdout)")
+    parser.add_argument("--text", action="store_true", help="print the messages instead of writing them framed")
+    add_budget_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.manifest:
+        path = args.manifest
+        if os.path.isdir(path):
+            path = os.path.join(path, MANIFEST_NAME)
+        with open(path) as f:
+            manifest = json.load(f)
+        batches = (regenerate_messages(manifest, start, stop, args.cache_dir) for start, stop in args.range)
+        packed = manifest["packed"]
+    else:
+        if args.seed is None:
+            parser.error("schema, type and seed are required without --manifest")
+        root_node = _load_root(args.schema, args.cache_dir)
+        rng = RNG(args.seed, args.step, backend=args.backend)
+        node = StructNode(root_node.structs_by_name[args.type], root_node, rng, budget=budget_from_args(args))
+        batches = (replay_messages(node, start, stop) for start, stop in args.range)
+        packed = args.packed
+
+    if args.text:
+        for (start, _), batch in zip(args.range, batches):
+            for index, msg in enumerate(batch, start):
+                print(f"message {index}:\n{msg}")
+        return
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        with MessageWriter(out, packed) as writer:
+            for batch in batches:
+                for msg in batch:
+                    writer.write(msg)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
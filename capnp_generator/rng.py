@@ -1,7 +1,10 @@
-import random
 import struct
 import sys
 import math
+import functools
+from bisect import bisect_right
+from fractions import Fraction
+from .backends import derive_seed, make_backend
 
 special_values = [ '<','>', '?', '>', ')', '(', '*', '&', '^', '%', '$', '#', '@', '/', '-', '+', '?', '~', '`', '|', '\\' ]
 chars = [ 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 0x3d, 0x3f, 0x40, 0x41, 0x7f, 0x80, 0x81, 0xfe, 0xff ]
@@ -13,15 +16,199 @@ try:
 except AttributeError:
     floats = [float('inf'), float('-inf'), float('nan'), 0.0, -0.0, sys.float_info.min, -sys.float_info.min, sys.float_info.max, -sys.float_info.max]
 
+# UTF-8 encoded size -> (number of codepoints, [(first codepoint, count)])
+# for the codepoints RNG.getText draws from. UTF-16 surrogates aren't valid
+# in UTF-8 and are left out; None is any size.
+def _ranges(*bounds):
+    ranges = [(start, end - start + 1) for start, end in bounds]
+    return sum(count for _, count in ranges), ranges
+
+codepoint_ranges = {
+    1: _ranges((0x0, 0x7f)),
+    2: _ranges((0x80, 0x7ff)),
+    3: _ranges((0x800, 0xd7ff), (0xe000, 0xffff)),
+    4: _ranges((0x10000, 0x10fffe)),
+    None: _ranges((0x0, 0xd7ff), (0xe000, 0x10fffe)),
+}
+
+
+# typestring -> (bits, signed) of the integer types
+INT_TYPES = {
+    "uint8": (8, False), "int8": (8, True),
+    "uint16": (16, False), "int16": (16, True),
+    "uint32": (32, False), "int32": (32, True),
+    "uint64": (64, False), "int64": (64, True),
+}
+
+# float typestring -> the integer type its "int" source draws from
+FLOAT_TYPES = {
+    "float32": "int32",
+    "float64": "int64",
+}
+
+
+def _to_int(value, bits, signed):
+    # `value` truncated to `bits`, as two's complement if signed
+    value &= (1 << bits) - 1
+    if signed and value & (1 << (bits - 1)):
+        value -= 1 << bits
+    return value
+
+
+def _size(values):
+    # len() doesn't work on ranges of more than sys.maxsize values
+    if isinstance(values, range):
+        return values.stop - values.start
+    return len(values)
+
+
+class WeightedSampler:
+    # Picks a value from a weighted mix of sources with a single randint().
+    # A source is a tuple of values, a range of integers or another sampler
+    # (whose sources are merged in, scaled by its weight). Values within a
+    # source are equally likely.
+    #
+    # All sources are laid out back to back in one integer range [0, total),
+    # each taking a span proportional to its weight that is also a multiple
+    # of its size. One draw from that range picks the source (by a bisect
+    # over the span starts) and the value within it (the offset into the
+    # span modulo the source size).
+    __slots__ = ("sources", "starts", "values", "sizes", "total", "probabilities", "uniform", "arrays")
+
+    def __init__(self, sources):
+        # sources is [(name, weight, values)]; weights can be any non
+        # negative number, only their ratios matter
+        flat = []
+        for name, weight, values in sources:
+            weight = Fraction(weight).limit_denominator(1 << 20)
+            if isinstance(values, WeightedSampler):
+                inner_total = sum(w for _, w, _ in values.sources)
+                flat.extend((f"{name}.{n}", weight * w / inner_total, v) for n, w, v in values.sources)
+            else:
+                flat.append((name, weight, values))
+        flat = [(name, weight, values) for name, weight, values in flat if weight > 0 and _size(values)]
+        if not flat:
+            raise ValueError("a sampler needs at least one non-empty source with a weight above 0")
+        denominator = math.lcm(*(weight.denominator for _, weight, _ in flat))
+        unit = math.lcm(*(_size(values) for _, _, values in flat))
+        self.sources = flat
+        self.values = [values for _, _, values in flat]
+        self.sizes = [_size(values) for values in self.values]
+        self.starts = []
+        start = 0
+        for _, weight, _ in flat:
+            self.starts.append(start)
+            start += int(weight * denominator) * unit
+        self.total = start
+        weight_total = sum(weight for _, weight, _ in flat)
+        self.probabilities = [float(weight / weight_total) for _, weight, _ in flat]
+        self.uniform = len(set(weight for _, weight, _ in flat)) == 1
+        # per source numpy arrays, filled in by vector.py when needed
+        self.arrays = None
+
+    def sample(self, backend):
+        r = backend.randint(0, self.total - 1)
+        i = bisect_right(self.starts, r) - 1
+        return self.values[i][(r - self.starts[i]) % self.sizes[i]]
+
+
+def default_sources(typestring):
+    # [(name, values)] the getter for `typestring` draws from by default.
+    # Every source has the same weight.
+    if typestring in FLOAT_TYPES:
+        bits = INT_TYPES[FLOAT_TYPES[typestring]][0]
+        return [
+            ("floats", tuple(floats)),
+            ("int", DEFAULT_SAMPLERS[FLOAT_TYPES[typestring]]),
+            ("range", range(0, 1 << bits)),
+        ]
+    bits, signed = INT_TYPES[typestring]
+    tables = [("special", [ord(c) for c in special_values]), ("chars", chars)]
+    if bits >= 16:
+        tables.append(("shorts", shorts))
+    if bits >= 32:
+        tables.append(("ints", ints))
+    if bits >= 64:
+        tables.append(("qwords", qwords))
+    sources = [(name, tuple(_to_int(value, bits, signed) for value in table)) for name, table in tables]
+    if signed:
+        sources.append(("range", range(-(1 << (bits - 1)), 1 << (bits - 1))))
+    else:
+        sources.append(("range", range(0, 1 << bits)))
+    return sources
+
+
+def make_sampler(typestring, weights=None, dictionary=None):
+    # Sampler for the numeric type `typestring`. weights maps source names
+    # (see default_sources(), plus "dictionary") to weights, missing ones
+    # are 1. dictionary is a list of extra values to draw from, e.g. magic
+    # numbers of the protocol under test.
+    weights = weights or {}
+    sources = default_sources(typestring)
+    unknown = set(weights) - {name for name, _ in sources} - {"dictionary"}
+    if unknown:
+        raise ValueError(f"unknown value sources {sorted(unknown)} for {typestring}, expected {[name for name, _ in sources] + ['dictionary']}")
+    sources = [(name, weights.get(name, 1), values) for name, values in sources]
+    if dictionary:
+        if typestring in INT_TYPES:
+            dictionary = tuple(_to_int(value, *INT_TYPES[typestring]) for value in dictionary)
+        sources.append(("dictionary", weights.get("dictionary", 1), tuple(dictionary)))
+    return WeightedSampler(sources)
+
+
+DEFAULT_SAMPLERS = {}
+for _typestring in list(INT_TYPES) + list(FLOAT_TYPES):
+    DEFAULT_SAMPLERS[_typestring] = make_sampler(_typestring)
+
+
+def checkpoint_seed(run_seed, index):
+    # Seed of the RNG at the start of message `index` of the run seeded with
+    # `run_seed`, if a checkpoint falls on that message (see RNG.advance)
+    if index == 0:
+        return run_seed
+    return derive_seed(run_seed, f"message:{index}")
+
+
+class ReseedLog:
+    # reseed_cb that records every reseed as (message index, seed), e.g. to
+    # find the seed a crashing message was generated from without keeping
+    # every message around. Only reseeds are stored, one per `step` messages.
+    def __init__(self):
+        self.entries = []
+
+    def __call__(self, rng):
+        self.entries.append((rng.message, rng.seed))
+
+    def write(self, out):
+        for index, seed in self.entries:
+            out.write(f"{index} {seed:#x}\n")
+
 
 class RNG:
-    def __init__(self, seed, step, reseed_cb=None, logger=None):
+    def __init__(self, seed, step, reseed_cb=None, logger=None, backend="random", max_length=None):
         self.seed = seed
         self.iterations = 0
         self.step = step
-        random.seed(seed)
+        # The seed the run started from, which the RNG state at every
+        # checkpoint is derived from, and the index of the current message
+        self.run_seed = seed
+        self.message = 0
+        # Each RNG owns its generator state, see backends.py
+        self.backend = backend
+        self.random = make_backend(backend, seed)
+        # Backends built on numpy generate lists and blobs in bulk, see vector.py
+        self.vector = None
+        if getattr(self.random, "generator", None) is not None:
+            from .vector import VectorSampler
+            self.vector = VectorSampler(self.random)
         self.reseed_cb = reseed_cb
         self.logger = logger
+        # Largest length getList and getBlob draw when none is given. By
+        # default that is the largest a list pointer can encode.
+        self.max_length = max_length if max_length is not None else int((2**29)) - 1
+        # typestring -> WeightedSampler the numeric getters draw from, see
+        # set_values()
+        self.samplers = dict(DEFAULT_SAMPLERS)
         self.type_function_map = {
             "uint8":   self.getUInt8,
             "uint16":  self.getUInt16,
@@ -35,6 +222,19 @@ class RNG:
             "float64": self.getFloat64,
             "bool":    self.getBool
         }
+        self.mutate_function_map = {
+            "uint8":   self.mutInt8,
+            "uint16":  self.mutInt16,
+            "uint32":  self.mutInt32,
+            "uint64":  self.mutInt64,
+            "int8":    functools.partial(self.mutInt8, signed=True),
+            "int16":   functools.partial(self.mutInt16, signed=True),
+            "int32":   functools.partial(self.mutInt32, signed=True),
+            "int64":   functools.partial(self.mutInt64, signed=True),
+            "float32": self.mutFloat32,
+            "float64": self.mutFloat64,
+            "bool":    self.mutBool
+        }
         self.typestring_to_elem_size = {
             "uint8":   1,
             "uint16":  2,
@@ -52,7 +252,20 @@ class RNG:
     def set_seed(self, seed):
         self.seed = seed
         self.iterations = 0
-        random.seed(seed)
+        self.random.seed(seed)
+
+    def fork(self, stream_id):
+        # Independent RNG for substream `stream_id`, e.g. one per worker or
+        # thread. The same (seed, stream_id) always gives the same sequence.
+        rng = RNG(derive_seed(self.run_seed, stream_id), self.step, self.reseed_cb, self.logger, self.backend, self.max_length)
+        rng.samplers = dict(self.samplers)
+        return rng
+
+    def set_values(self, typestring, weights=None, dictionary=None):
+        # Changes what get<Type>() (and getList(typestring)) draw from: the
+        # weights of the value sources and a dictionary of extra values, see
+        # make_sampler()
+        self.samplers[typestring] = make_sampler(typestring, weights, dictionary)
 
     def reset(self, seed):
         if self.logger is not None:
@@ -69,166 +282,103 @@ class RNG:
             return val
 
     def advance(self):
+        # Called after every message. Every `step` messages the RNG is
+        # reseeded from (run seed, message index), so the state at each of
+        # these checkpoints is known without generating what came before.
+        self.message += 1
         self.iterations += 1
         if self.iterations >= self.step:
-            self.reset(self.getRandom(0, 0xffffffffffffffff))
-            # print here maybe, to notify of the iteration count and new seed
+            self.reset(checkpoint_seed(self.run_seed, self.message))
+
+    def seek(self, index):
+        # Moves to the last checkpoint at or before message `index` and
+        # returns its index. Generating index - seek(index) messages from
+        # there gets to message `index`, none with step=1.
+        checkpoint = index - index % self.step
+        self.set_seed(checkpoint_seed(self.run_seed, checkpoint))
+        self.message = checkpoint
+        return checkpoint
 
     def getBool(self):
-        return True if random.randint(0, 1) == 1 else False
+        return True if self.random.randint(0, 1) == 1 else False
 
     def getInt8(self):
-        switch = self.getRandom(0, 2)
-        if switch == 0:
-            val = ord(special_values[self.getRandom(0, len(special_values) - 1)])
-        elif switch == 1:
-            val = chars[self.getRandom(0, len(chars) - 1)]
-        else:
-            val = self.getRandom(0, 0xff)
-        return self._twos_comp(val, 0xff, 8)
+        return self.samplers["int8"].sample(self.random)
 
     def getUInt8(self):
-        switch = self.getRandom(0, 2)
-        if switch == 0:
-            val = ord(special_values[self.getRandom(0, len(special_values) - 1)])
-        elif switch == 1:
-            val = chars[self.getRandom(0, len(chars) - 1)]
-        else:
-            val = self.getRandom(0, 0xff)
-        return val
+        return self.samplers["uint8"].sample(self.random)
 
     def getInt16(self):
-        switch = self.getRandom(0, 3)
-        if switch == 0:
-            val = ord(special_values[self.getRandom(0, len(special_values) - 1)])
-        elif switch == 1:
-            val = chars[self.getRandom(0, len(chars) - 1)]
-        elif switch == 2:
-            val = shorts[self.getRandom(0, len(chars) - 1)]
-        else:
-            val = self.getRandom(0, 0xffff)
-        return self._twos_comp(val, 0xffff, 16)
+        return self.samplers["int16"].sample(self.random)
 
     def getUInt16(self):
-        switch = self.getRandom(0, 3)
-        if switch == 0:
-            val = ord(special_values[self.getRandom(0, len(special_values) - 1)])
-        elif switch == 1:
-            val = chars[self.getRandom(0, len(chars) - 1)]
-        elif switch == 2:
-            val = shorts[self.getRandom(0, len(shorts) - 1)]
-        else:
-            val = self.getRandom(0, 0xffff)
-        return val
+        return self.samplers["uint16"].sample(self.random)
 
     def getInt32(self):
-        switch = self.getRandom(0, 4)
-        if switch == 0:
-            val = ord(special_values[self.getRandom(0, len(special_values) - 1)])
-        elif switch == 1:
-            val = chars[self.getRandom(0, len(chars) - 1)]
-        elif switch == 2:
-            val = shorts[self.getRandom(0, len(shorts) - 1)]
-        elif switch == 3:
-            val = ints[self.getRandom(0, len(ints) - 1)]
-        else:
-            val = self.getRandom(0, 0xffffffff)
-        return self._twos_comp(val, 0xffffffff, 32)
+        return self.samplers["int32"].sample(self.random)
 
     def getUInt32(self):
-        switch = self.getRandom(0, 4)
-        if switch == 0:
-            val = ord(special_values[self.getRandom(0, len(special_values) - 1)])
-        elif switch == 1:
-            val = chars[self.getRandom(0, len(chars) - 1)]
-        elif switch == 2:
-            val = shorts[self.getRandom(0, len(shorts) - 1)]
-        elif switch == 3:
-            val = ints[self.getRandom(0, len(ints) - 1)]
-        else:
-            val = self.getRandom(0, 0xffffffff)
-        return val
+        return self.samplers["uint32"].sample(self.random)
 
     def getInt64(self):
-        switch = self.getRandom(0, 5)
-        if switch == 0:
-            val = ord(special_values[self.getRandom(0, len(special_values) - 1)])
-        elif switch == 1:
-            val = chars[self.getRandom(0, len(chars) - 1)]
-        elif switch == 2:
-            val = shorts[self.getRandom(0, len(shorts) - 1)]
-        elif switch == 3:
-            val = ints[self.getRandom(0, len(ints) - 1)]
-        elif switch == 4:
-            val = qwords[self.getRandom(0, len(qwords) - 1)]
-        else:
-            val = self.getRandom(0, 0xffffffffffffffff)
-        return self._twos_comp(val, 0xffffffffffffffff, 64)
+        return self.samplers["int64"].sample(self.random)
 
     def getUInt64(self):
-        switch = self.getRandom(0, 5)
-        if switch == 0:
-            val = ord(special_values[self.getRandom(0, len(special_values) - 1)])
-        elif switch == 1:
-            val = chars[self.getRandom(0, len(chars) - 1)]
-        elif switch == 2:
-            val = shorts[self.getRandom(0, len(shorts) - 1)]
-        elif switch == 3:
-            val = ints[self.getRandom(0, len(ints) - 1)]
-        elif switch == 4:
-            val = qwords[self.getRandom(0, len(qwords) - 1)]
-        else:
-            val = self.getRandom(0, 0xffffffffffffffff)
-        return val
+        return self.samplers["uint64"].sample(self.random)
 
     def getFloat32(self):
-        switch = self.getRandom(0, 2)
-        if switch == 0:
-            val = floats[self.getRandom(0, len(floats) - 1)]
-        elif switch == 1:
-            val = self.getInt32()
-        else:
-            val = self.getRandom(0, 0xffffffff)
-        return val
+        return self.samplers["float32"].sample(self.random)
 
     def getFloat64(self):
-        switch = self.getRandom(0, 2)
-        if switch == 0:
-            val = floats[self.getRandom(0, len(floats) - 1)]
-        elif switch == 1:
-            val = self.getInt64()
-        else:
-            val = self.getRandom(0, 0xffffffffffffffff)
-        return val
+        return self.samplers["float64"].sample(self.random)
 
     def getRandom(self, minimum: int, maximum: int):
-        return random.randint(minimum, maximum)
+        return self.random.randint(minimum, maximum)
 
     def getEnum(self, options):
-        return options[random.randint(0, len(options) - 1)]
+        return options[self.random.randint(0, len(options) - 1)]
 
-    def mutBool(self):
+    def mutBool(self, d=None):
         return self.getBool()
 
-    def mutInt8(self, d):
-        return struct.unpack("B", self._mutate_bytes(struct.pack("B", d))[0])
+    # The mutInt*/mutFloat* helpers take a value and return the mutated value,
+    # or take a writable memoryview over the value's little endian bytes (e.g.
+    # a slice of a message buffer) and mutate it in place.
+    def mutInt8(self, d, signed=False):
+        if isinstance(d, memoryview):
+            return self._mutate_bytes(d)
+        fmt = "b" if signed else "B"
+        return struct.unpack(fmt, self._mutate_bytes(struct.pack(fmt, d)))[0]
     
-    def mutInt16(self, d):
-        return struct.unpack("<H", self._mutate_bytes(struct.pack("<H", d))[0])
+    def mutInt16(self, d, signed=False):
+        if isinstance(d, memoryview):
+            return self._mutate_bytes(d)
+        fmt = "<h" if signed else "<H"
+        return struct.unpack(fmt, self._mutate_bytes(struct.pack(fmt, d)))[0]
     
-    def mutInt32(self, d):
-        return struct.unpack("<I", self._mutate_bytes(struct.pack("<I", d))[0])
+    def mutInt32(self, d, signed=False):
+        if isinstance(d, memoryview):
+            return self._mutate_bytes(d)
+        fmt = "<i" if signed else "<I"
+        return struct.unpack(fmt, self._mutate_bytes(struct.pack(fmt, d)))[0]
     
-    def mutInt64(self, d):
-        return struct.unpack("<Q", self._mutate_bytes(struct.pack("<Q", d))[0])
+    def mutInt64(self, d, signed=False):
+        if isinstance(d, memoryview):
+            return self._mutate_bytes(d)
+        fmt = "<q" if signed else "<Q"
+        return struct.unpack(fmt, self._mutate_bytes(struct.pack(fmt, d)))[0]
 
     def mutFloat32(self, d):
-        return self.mutInt32(d)
+        if isinstance(d, memoryview):
+            return self._mutate_bytes(d)
+        return struct.unpack("<f", self._mutate_bytes(struct.pack("<f", d)))[0]
 
     def mutFloat64(self, d):
-        return self.mutInt64(d)
+        if isinstance(d, memoryview):
+            return self._mutate_bytes(d)
+        return struct.unpack("<d", self._mutate_bytes(struct.pack("<d", d)))[0]
     
-    def getList(self, typestring, length=None):
+    def getList(self, typestring, length=None, sampler=None):
         # maximum length for lists is encoded in a 29 bit field.
         # the length is interpreted differently depending on the
         # list pointer pointing at the list, but the largest
@@ -237,84 +387,132 @@ class RNG:
         # in bits for bools and other 1 bit types).
         # 
         # Default elem size is 1 for simplicity.
+        #
+        # sampler overrides the WeightedSampler the elements are drawn from.
+
+        if length is None:
+            length = self.random.randint(0, self.max_length)
+
+        if self.vector is not None:
+            return self.vector.getArray(typestring, length, sampler or self.samplers.get(typestring)).tolist()
+
+        if sampler is not None:
+            return [sampler.sample(self.random) for i in range(0, length)]
 
         output = []
         getFunc = self.type_function_map[typestring]
 
-        if length is None:
-            length = random.randint(0, int((2**29)) - 1)
-
         for i in range(0, length):
             output.append(getFunc())
 
         return output
 
+    def getArray(self, typestring, length):
+        # Like getList, as a numpy array. Only available with the numpy backend.
+        if self.vector is None:
+            raise TypeError(f"getArray needs a vectorized RNG backend, not {self.backend!r}")
+        return self.vector.getArray(typestring, length, self.samplers.get(typestring))
+
     def getBlob(self, length=None):
+        if self.vector is not None:
+            if length is None:
+                length = self.random.randint(0, self.max_length)
+            return self.vector.getArray("uint8", length, self.samplers["uint8"]).tobytes()
         return bytes(self.getList("uint8", length=length))
     
     def getText(self, length=None, byte_list=None):
-        count = 0
-        output = b""
+        # Random text of `length` UTF-8 bytes, the last of which is a NUL,
+        # as a str. See getTextBytes.
+        return self.getTextBytes(length).decode("utf-8")
+
+    def getTextBytes(self, length=None):
+        # getText() as the encoded bytes, which pycapnp takes as is for Text
+        # fields, without a decode/encode round trip. What the generators use.
         if length == None:
-            length = random.randint(0, 10)
+            length = self.random.randint(0, 10)
 
         if length == 0:
             return b""
 
-        length = length - 1
+        if self.vector is not None:
+            return self.vector.getUTF8(length - 1) + b"\x00"
+        return self._random_utf8_text(length - 1) + b"\x00"
+
+    def getTextsBytes(self, count, length=None):
+        # `count` texts as bytes (see getTextBytes), each of a random length
+        # unless one is given
+        return [self.getTextBytes(length) for _ in range(0, count)]
+
+    def _random_utf8_text(self, length):
+        # Fills a buffer of exactly `length` bytes with UTF-8 codepoints of
+        # random encoded size (1-4 bytes, shrunk at the end of the buffer).
+        output = bytearray(length)
+        count = 0
+        randint = self.random.randint
         while count < length:
             if length - count < 4:
-                codepoint = self._random_utf8(length - count)
+                size = length - count
             else:
-                codepoint = self._random_utf8(random.randint(1, 4))
-            output += codepoint
-            count += len(codepoint)
-        
-        output += b"\x00"
-        return output.decode("utf-8")
+                size = randint(1, 4)
+            val = self._random_codepoint(size)
+            if size == 1:
+                output[count] = val
+            elif size == 2:
+                output[count]     = ((val & 0x07c0) >> 6) | 0xc0
+                output[count + 1] =  (val & 0x003f)       | 0x80
+            elif size == 3:
+                output[count]     = ((val & 0xf000) >> 12) | 0xe0
+                output[count + 1] = ((val & 0x0fc0) >> 6)  | 0x80
+                output[count + 2] =  (val & 0x003f)        | 0x80
+            else:
+                output[count]     = ((val & 0x1c0000) >> 18) | 0xf0
+                output[count + 1] = ((val & 0x03f000) >> 12) | 0x80
+                output[count + 2] = ((val & 0x000fc0) >> 6)  | 0x80
+                output[count + 3] =  (val & 0x00003f)        | 0x80
+            count += size
+        return bytes(output)
+
+    def _random_codepoint(self, size):
+        # One draw over the precomputed ranges of codepoints with a UTF-8
+        # encoding of `size` bytes (surrogates excluded)
+        total, ranges = codepoint_ranges.get(size, codepoint_ranges[None])
+        val = self.random.randint(0, total - 1)
+        for start, count in ranges:
+            if val < count:
+                return start + val
+            val -= count
 
     def _random_utf8(self, size=4):
-        if size == 1:
-            val = random.randint(0, 0x7f)
-        elif size == 2:
-            val = random.randint(0x80, 0x7ff)
-        elif size == 3:
-            val = random.randint(0x800, 0xffff)
-            # Account for utf-16 surrogate ranges. Should we bother? or just let it happen
-            while ((0xd800 <= val) and (val <= 0xdfff)):
-                val = random.randint(0x800, 0xffff)
-        elif size == 4:
-            val = random.randint(0x10000, 0x10fffe)
-        else:
-            val = random.randint(0x0, 0x10fffe) 
-
-        if val < 0x80:
-            return bytes([val])
-        elif val < 0x0800:
-            byte1 = ((val & 0x07c0) >> 6) | 0xC0
-            byte2 =  (val & 0x003f)       | 0x80
-            return bytes([byte1, byte2])
-        elif val < 0x10000:
-            byte1 = ((val & 0xf000) >> 12) | 0xe0
-            byte2 = ((val & 0x0fc0) >> 6)  | 0x80
-            byte3 =  (val & 0x003f)        | 0x80
-            return bytes([byte1, byte2, byte3])
-        elif val < 0x10ffff:
-            byte1 = ((val & 0x1c0000) >> 18) | 0xf0
-            byte2 = ((val & 0x03f000) >> 12) | 0x80
-            byte3 = ((val & 0x000fc0) >> 6)  | 0x80
-            byte4 =  (val & 0x00003f)        | 0x80
-            return bytes([byte1, byte2, byte3, byte4])
+        return chr(self._random_codepoint(size)).encode("utf-8")
 
     def _mutate_bytes(self, data, prob_byte=0.1, prob_bit=1):
-        data = list(data)
-        out = []
-        for b in data:
-            if random.random() < prob_byte:
-                mask = 0
-                for p in range(0, 8):
-                    if random.randint(1, 8) < prob_bit:
-                        mask |= 1 << p
-                b ^= mask 
-            out.append(b)
-        return bytes(out)
+        # Each byte is picked with probability prob_byte, and each bit of a
+        # picked byte is flipped with probability prob_bit / 8. A memoryview
+        # is mutated in place and returned, anything else is copied and the
+        # mutated bytes are returned.
+        #
+        # Rather than drawing once per byte, the gap to the next picked byte
+        # is drawn from the matching geometric distribution, so the cost
+        # depends on the number of bytes mutated, not the size of the data.
+        if isinstance(data, memoryview):
+            view = data
+        else:
+            view = memoryview(bytearray(data))
+        if prob_byte <= 0:
+            return data if view is data else bytes(view)
+        log_keep = math.log1p(-prob_byte) if prob_byte < 1 else None
+        size = len(view)
+        i = -1
+        while True:
+            if log_keep is None:
+                i += 1
+            else:
+                i += 1 + int(math.log(1.0 - self.random.random()) / log_keep)
+            if i >= size:
+                break
+            mask = 0
+            for p in range(0, 8):
+                if self.random.randint(1, 8) <= prob_bit:
+                    mask |= 1 << p
+            view[i] ^= mask
+        return data if view is data else bytes(view)
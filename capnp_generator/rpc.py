@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import sys
+import time
+import capnp
+from .corpus import DEFAULT_STEP, _load_root, add_budget_arguments, budget_from_args
+from .driver import format_target, parse_target
+from .node import StructNode
+from .rng import RNG
+from .stream import MessageWriter
+
+"""
+Parameters and results of RPC methods. Every method of an interface takes a
+params struct and returns a results struct, usually the implicit
+"method$Params" / "method$Results" structs capnp declares for a parameter
+list, which are not among the structs a RootNode indexes. An InterfaceNode
+builds a StructNode (and so a compiled plan, see plan.py) for the params and
+the results of every method of an interface, inherited ones included, once,
+and then generates either in batches:
+
+    interface_node = InterfaceNode(root_node.interfaces_by_name["TestInterface"], root_node, rng)
+    batch = interface_node.generate_batch("returnOpposite", 100000)
+
+All the StructNodes share the one RNG, so the structs an InterfaceNode
+generates, params and results of whichever methods, are the messages of one
+run, numbered in the order they were generated. A message can be generated
+again by its index (see RNG.advance) as long as the run is a sequence of
+generate_call()s, or of generate_batch()es for a single method, which
+generate_call_at() and StructNode.generate_at() replay.
+
+For fuzzing a service through a real RPC connection, call_batch() sends
+generated calls over a pycapnp TwoPartyClient with up to `pipeline` calls in
+flight, filling each request builder in place, and stand_in() serves an
+implementation of the interface that answers every call with generated
+results. pycapnp's RPC runs on asyncio, wrapped in capnp.run():
+
+    python -m capnp_generator.rpc example.capnp TestInterface 0x1234 \\
+        --call unix:/tmp/service.sock --count 100000 --pipeline 64
+"""
+
+
+def struct_module(schema, root_node):
+    # The _StructModule of a params or results struct schema. The implicit
+    # "method$Params" / "method$Results" structs aren't reachable as
+    # attributes of any module, and pycapnp has no public way to make a
+    # module of a bare _StructSchema, so this is the one place a private
+    # constructor is used (checked against pycapnp 2.2.4).
+    module = root_node.registry.structs_by_id.get(schema.node.id)
+    if module is None:
+        module = capnp.lib.capnp._StructModule(schema, schema.node.displayName.rpartition(".")[2])
+    return module
+
+
+class MethodGenerator:
+    # The generators of one method: params and results are StructNodes of
+    # its params and results structs
+    __slots__ = ("name", "params", "results")
+
+    def __init__(self, name, params, results):
+        self.name = name
+        self.params = params
+        self.results = results
+
+    def __repr__(self):
+        return f"MethodGenerator({self.name!r})"
+
+
+class InterfaceNode:
+    def __init__(self, interface, root_node, rng, **options):
+        # interface is the _InterfaceModule, options are passed on to every
+        # StructNode (budget, in_place, max_recursion, ...)
+        self.interface = interface
+        self.root_node = root_node
+        self.rng = rng
+        self.name = interface.schema.node.displayName
+        # method name -> MethodGenerator, in declaration order
+        self.methods = {}
+        for name, method in interface.schema.methods_inherited.items():
+            self.methods[name] = MethodGenerator(
+                name,
+                StructNode(struct_module(method.param_type, root_node), root_node, rng, **options),
+                StructNode(struct_module(method.result_type, root_node), root_node, rng, **options),
+            )
+        self.method_names = list(self.methods)
+
+    def method(self, name):
+        method = self.methods.get(name)
+        if method is None:
+            raise ValueError(f"no method {name!r} in {self.name}, expected one of {self.method_names}")
+        return method
+
+    def random_method(self):
+        return self.methods[self.method_names[self.rng.getRandom(0, len(self.method_names) - 1)]]
+
+    def generate_params(self, name):
+        return self.method(name).params.generate()
+
+    def generate_results(self, name):
+        return self.method(name).results.generate()
+
+    def generate_batch(self, name, count, results=False, packed=False):
+        # `count` serialized params (or results) structs of method `name`
+        node = self.method(name).results if results else self.method(name).params
+        generate = node.generate
+        if packed:
+            return [generate().to_bytes_packed() for _ in range(count)]
+        return [generate().to_bytes() for _ in range(count)]
+
+    def generate_call(self, method=None, results=False):
+        # (method name, params builder) of a call to `method`, or a method
+        # picked at random, or its results with results set. Every call is
+        # one message of the run, see generate_call_at().
+        generator = self.method(method) if method else self.random_method()
+        node = generator.results if results else generator.params
+        return generator.name, node.generate()
+
+    def generate_calls(self, count, method=None, results=False):
+        for _ in range(count):
+            yield self.generate_call(method, results)
+
+    def generate_call_at(self, index, method=None, results=False):
+        # Call `index` of a run of generate_call()s (or of call_batch(), with
+        # results False) with the same arguments, see StructNode.generate_at
+        for _ in range(index - self.rng.seek(index)):
+            self.generate_call(method, results)
+        return self.generate_call(method, results)
+
+
+async def connect(target, interface):
+    # A client capability for `interface`, bootstrapped from the server at
+    # `target` (a driver.parse_target() tuple)
+    if target[0] == "unix":
+        stream = await capnp.AsyncIoStream.create_unix_connection(target[1])
+    else:
+        stream = await capnp.AsyncIoStream.create_connection(host=target[1], port=target[2])
+    return capnp.TwoPartyClient(stream).bootstrap().cast_as(interface)
+
+
+async def call_batch(client, interface_node, count, pipeline=64, method=None):
+    # Sends `count` calls of `method` (or methods picked at random) on
+    # `client`, each request filled in place by the method's params node,
+    # keeping up to `pipeline` calls in flight. Returns the failed calls as
+    # (method name, message index of the params, error) tuples, the index
+    # being what generate_call_at() takes to regenerate the params.
+    in_flight = collections.deque()
+    failures = []
+    rng = interface_node.rng
+
+    async def finish():
+        name, index, promise = in_flight.popleft()
+        try:
+            await promise
+        except capnp.KjException as e:
+            failures.append((name, index, str(e)))
+
+    for _ in range(count):
+        # the same draws as generate_call()
+        index = rng.message
+        generator = interface_node.method(method) if method else interface_node.random_method()
+        request = getattr(client, generator.name + "_request")()
+        generator.params.generate_into(request)
+        in_flight.append((generator.name, index, request.send()))
+        if len(in_flight) >= pipeline:
+            await finish()
+    while in_flight:
+        await finish()
+    return failures
+
+
+def stand_in_class(interface_node):
+    # A Server class of the interface answering every call with generated
+    # results (and ignoring the params)
+    def handler(results):
+        async def call(self, context, **kwargs):
+            results.generate_into(context.results)
+        return call
+
+    methods = {f"{name}_context": handler(method.results) for name, method in interface_node.methods.items()}
+    return type(f"{interface_node.name.rpartition('.')[2]}StandIn", (interface_node.interface.Server,), methods)
+
+
+async def stand_in(interface_node, target):
+    # Serves stand_in_class() at `target`. Returns the server.
+    server_class = stand_in_class(interface_node)
+
+    async def new_connection(stream):
+        await capnp.TwoPartyServer(stream, bootstrap=server_class()).on_disconnect()
+
+    if target[0] == "unix":
+        if os.path.exists(target[1]):
+            os.unlink(target[1])
+        return await capnp.AsyncIoStream.create_unix_server(new_connection, target[1])
+    return await capnp.AsyncIoStream.create_server(new_connection, target[1], target[2])
+
+
+async def _call(interface_node, args):
+    server = None
+    if args.stand_in:
+        # results come from a separate run, so the calls stay those of the seed
+        results_node = InterfaceNode(interface_node.interface, interface_node.root_node, RNG(args.seed ^ 1, args.step, backend=args.backend))
+        server = await stand_in(results_node, args.call)
+    try:
+        client = await connect(args.call, interface_node.interface)
+        started = time.perf_counter()
+        failures = await call_batch(client, interface_node, args.count, args.pipeline, args.method)
+        elapsed = time.perf_counter() - started
+    finally:
+        if server is not None:
+            server.close()
+    for name, index, error in failures:
+        print(json.dumps({"method": name, "index": index, "seed": args.seed, "step": args.step, "error": error}))
+    print(f"{args.count} calls to {format_target(args.call)} in {elapsed:.2f}s ({args.count / elapsed:.0f}/s), "
+          f"{len(failures)} failed", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="generate params and results of RPC methods, or call a service with them")
+    parser.add_argument("schema", help="capnp schema file")
+    parser.add_argument("interface", help="name of the interface")
+    parser.add_argument("seed", type=lambda s: int(s, 0), nargs="?", default=0, help="seed of the run")
+    parser.add_argument("--list", action="store_true", help="list the methods of the interface")
+    parser.add_argument("--method", help="only generate for this method (default: methods picked at random)")
+    parser.add_argument("--count", type=int, default=1000, help="number of structs or calls (default 1000)")
+    parser.add_argument("--results", action="store_true", help="generate results instead of params")
+    parser.add_argument("--at", type=lambda s: int(s, 0), help="print call INDEX of the run (the index of a failed call)")
+    parser.add_argument("--call", type=parse_target, help="call the service at unix:PATH or [host:]port")
+    parser.add_argument("--pipeline", type=int, default=64, help="calls in flight (default 64)")
+    parser.add_argument("--stand-in", action="store_true", help="serve a stand-in of the interface at the --call address")
+    parser.add_argument("--step", type=int, default=DEFAULT_STEP, help=f"messages between RNG checkpoints (default {DEFAULT_STEP})")
+    parser.add_argument("--backend", default="random", help="RNG backend (random, numpy, pcg64)")
+    parser.add_argument("--cache-dir", default=None, help="schema index cache directory")
+    parser.add_argument("--packed", action="store_true", help="write packed messages")
+    parser.add_argument("--output", help="file to write the structs to (default stdout)")
+    add_budget_arguments(parser)
+    args = parser.parse_args(argv)
+
+    root_node = _load_root(args.schema, args.cache_dir)
+    interface = root_node.interfaces_by_name.get(args.interface)
+    if interface is None:
+        parser.error(f"unknown interface {args.interface!r}, expected one of {sorted(root_node.interfaces_by_name)}")
+    rng = RNG(args.seed, args.step, backend=args.backend)
+    interface_node = InterfaceNode(interface, root_node, rng, budget=budget_from_args(args))
+    if args.method:
+        try:
+            interface_node.method(args.method)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.list:
+        for name, method in interface_node.methods.items():
+            print(f"{name} {method.params.plan.name} -> {method.results.plan.name}")
+        return
+    if args.at is not None:
+        name, msg = interface_node.generate_call_at(args.at, args.method, args.results)
+        print(f"call {args.at}: {name}\n{msg}")
+        return
+    if args.call:
+        asyncio.run(capnp.run(_call(interface_node, args)))
+        return
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        with MessageWriter(out, args.packed) as writer:
+            for _, msg in interface_node.generate_calls(args.count, args.method, args.results):
+                writer.write(msg)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import struct
+from .budget import Budget
+from .corpus import DEFAULT_STEP, _load_root
+from .node import StructNode
+from .rng import RNG
+from .stream import iter_messages
+from .template import TemplateNode
+
+"""
+A resident generator. Loading schemas and building RootNodes takes far longer
+than generating a message, so instead of every fuzz harness doing it, a
+GeneratorServer loads a set of schemas once and serves messages over a Unix
+or TCP socket to any number of clients, handled concurrently with asyncio.
+
+    python -m capnp_generator.server example.capnp other.capnp --unix /tmp/capnp_generator.sock
+
+A client sends one request per line, as a JSON object:
+
+    {"type": "Person", "seed": 1234, "count": 1000}
+
+with the optional keys
+    schema         the schema file, by path or file name (needed when the
+                   server has more than one)
+    start          index of the first message of the run (default 0)
+    count          null streams messages until the client disconnects
+    framing        "stream" (default) or "packed", the standard capnp
+                   stream framing, unpacked or packed
+    length_prefix  put the length of each message in front of it as a
+                   little endian uint32
+    step, backend  the RNG parameters (see RNG), budget (see Budget) and
+    budget,        templates (TemplateNode parameters)
+    templates
+
+and gets back a JSON line, {"count": 1000} or {"error": "..."}, followed by
+the messages. The first message is generated before the count line is sent,
+so a request that can't be generated at all is answered with an error. The same (schema, type, seed, step, backend, budget) always
+gives the same messages, the same as a StructNode generating them locally.
+Requests on one connection are answered in order.
+
+Messages are generated in chunks between writes, and the server waits for a
+client to take each chunk (StreamWriter.drain) before generating more, so a
+slow client holds at most one chunk and a write buffer of memory and other
+clients keep being served in between. Client is a blocking client for
+harnesses that aren't asyncio based.
+"""
+
+FRAMINGS = ("stream", "packed")
+
+# messages generated between writes to a client
+CHUNK_MESSAGES = 64
+
+# write buffer of a client connection, above which generation waits
+HIGH_WATER = 1 << 20
+
+_uint32 = struct.Struct("<I")
+
+
+# request options given as objects, key -> (types, minimum, whether null is
+# allowed). A null budget limit is not enforced, see Budget.
+BUDGET_LIMITS = {name: (int, 0, True) for name in Budget.__slots__}
+TEMPLATE_OPTIONS = {"templates": (int, 1, False), "reshape_rate": ((int, float), 0, False)}
+
+
+class RequestError(ValueError):
+    pass
+
+
+def _check_options(name, options, allowed):
+    # Checks the budget or templates object of a request, missing keys keep
+    # their defaults
+    if options is None:
+        return
+    if not isinstance(options, dict):
+        raise RequestError(f"{name} must be an object, not {options!r}")
+    for key, value in options.items():
+        if key not in allowed:
+            raise RequestError(f"unknown {name} key {key!r}, expected one of {sorted(allowed)}")
+        types, minimum, nullable = allowed[key]
+        if value is None and nullable:
+            continue
+        if not isinstance(value, types) or value < minimum:
+            raise RequestError(f"{name}.{key} must be a number of at least {minimum}, not {value!r}")
+
+
+class GeneratorServer:
+    def __init__(self, schema_paths, cache_dir=None, backend="random", chunk_messages=CHUNK_MESSAGES, high_water=HIGH_WATER):
+        # schema path -> RootNode, and file name -> schema path
+        self.roots = {}
+        self.names = {}
+        for path in schema_paths:
+            path = os.path.realpath(path)
+            self.roots[path] = _load_root(path, cache_dir)
+            self.names.setdefault(os.path.basename(path), path)
+        self.backend = backend
+        self.chunk_messages = chunk_messages
+        self.high_water = high_water
+        self.clients = 0
+        self.messages = 0
+
+    def root_node(self, schema):
+        if schema is None:
+            if len(self.roots) != 1:
+                raise RequestError(f"schema is required, one of {sorted(self.names)}")
+            return next(iter(self.roots.values()))
+        path = self.names.get(schema, os.path.realpath(schema))
+        root_node = self.roots.get(path)
+        if root_node is None:
+            raise RequestError(f"unknown schema {schema!r}, expected one of {sorted(self.names)}")
+        return root_node
+
+    def node(self, request):
+        # The node a request is generated with: a fresh RNG on the warm root
+        # node, whose generation plans are already compiled
+        root_node = self.root_node(request.get("schema"))
+        module = root_node.structs_by_name.get(request.get("type"))
+        if module is None:
+            raise RequestError(f"unknown type {request.get('type')!r}")
+        rng = RNG(request.get("seed", 0), request.get("step", DEFAULT_STEP), backend=request.get("backend", self.backend))
+        budget = request.get("budget")
+        node = StructNode(module, root_node, rng, budget=Budget(**budget) if budget else None)
+        templates = request.get("templates")
+        if templates:
+            node = TemplateNode(node, **templates)
+        return node
+
+    def messages_for(self, request):
+        # Iterator of the framed messages answering `request`, and its count
+        if not isinstance(request, dict):
+            raise RequestError("a request is a JSON object")
+        framing = request.get("framing", "stream")
+        if framing not in FRAMINGS:
+            raise RequestError(f"unknown framing {framing!r}, expected one of {list(FRAMINGS)}")
+        count = request.get("count")
+        if count is not None and (not isinstance(count, int) or count < 0):
+            raise RequestError(f"count must be a non negative integer or null, not {count!r}")
+        start = request.get("start", 0)
+        if not isinstance(start, int) or start < 0:
+            raise RequestError(f"start must be a non negative integer, not {start!r}")
+        step = request.get("step", DEFAULT_STEP)
+        if not isinstance(step, int) or step < 1:
+            raise RequestError(f"step must be a positive integer, not {step!r}")
+        _check_options("budget", request.get("budget"), BUDGET_LIMITS)
+        _check_options("templates", request.get("templates"), TEMPLATE_OPTIONS)
+        try:
+            node = self.node(request)
+        except (TypeError, ValueError) as e:
+            raise RequestError(str(e))
+        messages = iter_messages(node, count, framing == "packed", start)
+        if request.get("length_prefix"):
+            messages = (_uint32.pack(len(data)) + data for data in messages)
+        return messages, count
+
+    async def handle(self, reader, writer):
+        self.clients += 1
+        writer.transport.set_write_buffer_limits(high=self.high_water)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    messages, count = self.messages_for(json.loads(line))
+                    # generated before the count line is written, so that a
+                    # request that fails to generate gets an error back
+                    first = next(messages, None)
+                except (RequestError, json.JSONDecodeError) as e:
+                    error = str(e)
+                except Exception as e:
+                    error = f"generation failed: {type(e).__name__}: {e}"
+                else:
+                    error = None
+                if error is not None:
+                    writer.write(json.dumps({"error": error}).encode() + b"\n")
+                    await writer.drain()
+                    continue
+                writer.write(json.dumps({"count": count}).encode() + b"\n")
+                if first is not None:
+                    await self.send(itertools.chain((first,), messages), writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def send(self, messages, writer):
+        while True:
+            chunk = list(itertools.islice(messages, self.chunk_messages))
+            if not chunk:
+                return
+            writer.write(b"".join(chunk))
+            self.messages += len(chunk)
+            # backpressure, and a chance for other clients to be served
+            await writer.drain()
+
+    async def start_unix(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        return await asyncio.start_unix_server(self.handle, path)
+
+    async def start_tcp(self, host, port):
+        return await asyncio.start_server(self.handle, host, port)
+
+
+def read_frame(read):
+    # Reads one message in the standard (unpacked) stream framing with
+    # read(n), which returns exactly n bytes
+    header = read(4)
+    count = _uint32.unpack(header)[0] + 1
+    table = read(((4 + 4 * count + 7) & ~7) - 4)
+    size = sum(struct.unpack_from(f"<{count}I", table)) * 8
+    return header + table + read(size)
+
+
+class Client:
+    # Blocking client. address is a Unix socket path or a (host, port) tuple.
+    def __init__(self, address):
+        if isinstance(address, str):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.connect(address)
+        self.file = self.socket.makefile("rwb")
+
+    def _read(self, size):
+        data = self.file.read(size)
+        if len(data) != size:
+            raise ConnectionError("server closed the connection")
+        return data
+
+    def messages(self, type, seed=0, count=1, **request):
+        # Yields the framed messages of one request (see the module
+        # docstring for the keys). Packed messages need length_prefix to be
+        # split, without it packed requests yield the raw response stream.
+        request.update(type=type, seed=seed, count=count)
+        self.file.write(json.dumps(request).encode() + b"\n")
+        self.file.flush()
+        response = json.loads(self.file.readline())
+        if "error" in response:
+            raise RequestError(response["error"])
+        counter = itertools.count() if count is None else range(count)
+        for _ in counter:
+            if request.get("length_prefix"):
+                yield self._read(_uint32.unpack(self._read(4))[0])
+            elif request.get("framing") == "packed":
+                raise RequestError("packed messages can only be split with length_prefix")
+            else:
+                yield read_frame(self._read)
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+async def serve(server, unix=None, tcp=None):
+    servers = []
+    if unix:
+        servers.append(await server.start_unix(unix))
+    if tcp:
+        host, _, port = tcp.rpartition(":")
+        servers.append(await server.start_tcp(host or "127.0.0.1", int(port)))
+    await asyncio.gather(*(s.serve_forever() for s in servers))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="serve generated capnp messages over a socket")
+    parser.add_argument("schemas", nargs="+", help="capnp schema files to keep loaded")
+    parser.add_argument("--unix", help="Unix socket path to listen on")
+    parser.add_argument("--tcp", help="[host:]port to listen on")
+    parser.add_argument("--backend", default="random", help="default RNG backend (random, numpy, pcg64)")
+    parser.add_argument("--cache-dir", default=None, help="schema index cache directory")
+    parser.add_argument("--chunk", type=int, default=CHUNK_MESSAGES, help=f"messages generated between writes (default {CHUNK_MESSAGES})")
+    args = parser.parse_args(argv)
+    if not args.unix and not args.tcp:
+        parser.error("at least one of --unix and --tcp is required")
+    server = GeneratorServer(args.schemas, args.cache_dir, args.backend, args.chunk)
+    try:
+        asyncio.run(serve(server, args.unix, args.tcp))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import itertools
+
+"""
+Streaming output of generated messages. Instead of generating a builder,
+serializing it and writing it out one file at a time, iter_messages() yields
+serialized messages straight from a StructNode and MessageWriter collects
+them into large writes on any binary file-like object (a file, a pipe such
+as sys.stdout.buffer, a socket's makefile("wb"), io.BytesIO, ...).
+
+Messages use the standard capnp stream framing (segment table followed by
+the segments, see to_bytes()), optionally packed, so the output can be read
+back with read_multiple_bytes()/read_multiple_bytes_packed() or any other
+capnp stream reader. Each builder is dropped as soon as it is serialized and
+at most buffer_size bytes are held before being written, so memory stays
+bounded however many messages are streamed.
+"""
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+
+def serialize(msg, packed=False):
+    return msg.to_bytes_packed() if packed else msg.to_bytes()
+
+
+def iter_messages(node, count=None, packed=False, start=0):
+    # Yields `count` serialized messages generated by `node` (a StructNode,
+    # or a TemplateNode, see template.py), forever if count is None. With
+    # start, the first one is message `start` of the run (see generate_at).
+    counter = itertools.count() if count is None else range(count)
+    if start:
+        if count == 0:
+            return
+        counter = iter(counter)
+        next(counter)
+        yield serialize(node.generate_at(start), packed)
+    generate_bytes = getattr(node, "generate_bytes", None)
+    if generate_bytes is not None:
+        for _ in counter:
+            yield generate_bytes(packed)
+        return
+    for _ in counter:
+        msg = node.generate()
+        data = serialize(msg, packed)
+        del msg
+        yield data
+
+
+class MessageWriter:
+    def __init__(self, out, packed=False, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.out = out
+        self.packed = packed
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.messages = 0
+        self.bytes = 0
+
+    def write(self, msg):
+        self.write_bytes(serialize(msg, self.packed))
+
+    def write_bytes(self, data):
+        # data must already be framed (and packed if the writer is)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.messages += 1
+        self.bytes += len(data)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.out.write(b"".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        flush = getattr(self.out, "flush", None)
+        if flush is not None:
+            flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def stream_messages(node, out, count=None, packed=False, buffer_size=DEFAULT_BUFFER_SIZE):
+    # Generates messages with `node` and writes them to `out` until `count`
+    # messages were written (or forever). Returns (messages, bytes) written.
+    with MessageWriter(out, packed, buffer_size) as writer:
+        for data in iter_messages(node, count, packed):
+            writer.write_bytes(data)
+    return writer.messages, writer.bytes
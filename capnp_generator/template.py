@@ -0,0 +1,301 @@
+import struct
+from .inplace import ELEMENT_BITS, ELEMENT_COMPOSITE, ELEMENT_POINTER, PRIMITIVE_SIZES, composite_tag, iter_frames, resolve_pointer
+
+"""
+Template generation. StructNode.generate() builds every message from scratch:
+it inits each list, allocates each nested struct and picks each union arm
+through pycapnp. A TemplateNode keeps a pool of serialized messages from its
+StructNode as skeletons, with the location of every leaf value (primitive
+and enum fields, the bytes of text and data, the elements of primitive and
+enum lists) worked out once per skeleton by walking its wire format. A new
+message is a copy of a random skeleton's bytes with fresh values written
+over its leaves, so its shape (list lengths, union arms, which pointers are
+null) is the skeleton's. With probability reshape_rate, and for every
+message until the pool is full, a new skeleton is generated instead.
+
+    template_node = TemplateNode(node, templates=16, reshape_rate=0.01)
+    data = template_node.generate_bytes()
+
+Leaf values are drawn from the same RNG getters (and per field samplers) as
+StructNode uses. Text and data keep their lengths, so a budget the skeletons
+were generated under still holds. The pool is emptied at every RNG
+checkpoint (see RNG.advance), which keeps generate_at() working: message N
+only depends on the messages since the last checkpoint.
+
+Like the in place mutator (see inplace.py), values are written as is and
+not XORed with field defaults, which only matters for fields with a
+non-zero default.
+"""
+
+FORMATS = {
+    "uint8": "B", "int8": "b",
+    "uint16": "H", "int16": "h",
+    "uint32": "I", "int32": "i",
+    "uint64": "Q", "int64": "q",
+    "float32": "f", "float64": "d",
+}
+
+_uint16 = struct.Struct("<H")
+_structs = {typestring: struct.Struct("<" + code) for typestring, code in FORMATS.items()}
+FLOAT32_MAX = 3.4028234663852886e+38
+
+
+def _float32(value):
+    # What C++ (and so pycapnp) stores for a double out of float32 range
+    if value > FLOAT32_MAX:
+        return float("inf")
+    if value < -FLOAT32_MAX:
+        return float("-inf")
+    return value
+
+
+def segment_offsets(data):
+    # Byte offset of each segment of the first message in `data`
+    count = struct.unpack_from("<I", data, 0)[0] + 1
+    sizes = struct.unpack_from(f"<{count}I", data, 4)
+    offset = (4 + 4 * count + 7) & ~7
+    offsets = []
+    for size in sizes:
+        offsets.append(offset)
+        offset += size * 8
+    return offsets
+
+
+class Template:
+    # A skeleton message: its framed bytes, the offsets of its primitive
+    # fields grouped as [(typestring, sampler or None, [offset])] so each
+    # group is drawn with one getList(), and its other leaves, each a tuple
+    # of (kind, byte offset, ...) as collected by LeafCollector
+    __slots__ = ("data", "fields", "leaves")
+
+    def __init__(self, data, fields, leaves):
+        self.data = data
+        self.fields = fields
+        self.leaves = leaves
+
+
+class LeafCollector:
+    # Walks one serialized message of type `plan` and collects its leaves:
+    #   ("primitive", offset, op)
+    #   ("bool", offset, bit mask)
+    #   ("enum", offset, number of enumerants)
+    #   ("text", offset, length) - without the NUL capnp adds
+    #   ("data", offset, length)
+    #   ("list", offset, count, element op)
+    #   ("bools", offset, count)
+    #   ("enums", offset, count, number of enumerants)
+    def __init__(self, data):
+        self.segments = next(iter_frames(data))
+        self.offsets = segment_offsets(data)
+        self.leaves = []
+        # plan id -> { discriminant: FieldOp }
+        self.union_ops = {}
+
+    def collect(self, plan):
+        target = resolve_pointer(self.segments, 0, 0)
+        if target is not None:
+            seg, start, tag = target
+            self.struct(seg, start, (tag >> 32) & 0xffff, tag >> 48, plan)
+        return self.leaves
+
+    def struct(self, seg, start, data_words, pointer_words, plan):
+        self.sections(seg, start, data_words, start + data_words, pointer_words, plan)
+
+    def sections(self, seg, start, data_words, pointers, pointer_words, plan):
+        for op in plan.fields:
+            self.field(seg, start, data_words, pointers, pointer_words, op)
+        if plan.union:
+            union_ops = self.union_ops.get(plan.id)
+            if union_ops is None:
+                union_ops = self.union_ops[plan.id] = {op.discriminant: op for op in plan.union}
+            offset = plan.discriminant_offset * 2
+            discriminant = 0
+            if offset + 2 <= data_words * 8:
+                discriminant = _uint16.unpack_from(self.segments[seg], start * 8 + offset)[0]
+            op = union_ops.get(discriminant)
+            if op is not None:
+                self.field(seg, start, data_words, pointers, pointer_words, op)
+
+    def field(self, seg, start, data_words, pointers, pointer_words, op):
+        kind = op.kind
+        base = self.offsets[seg] + start * 8
+        if kind == "primitive":
+            if op.typestring == "bool":
+                if op.offset >> 3 < data_words * 8:
+                    self.leaves.append(("bool", base + (op.offset >> 3), 1 << (op.offset & 7)))
+                return
+            size = PRIMITIVE_SIZES[op.typestring]
+            if (op.offset + 1) * size <= data_words * 8:
+                self.leaves.append(("primitive", base + op.offset * size, op))
+        elif kind == "enum":
+            if (op.offset + 1) * 2 <= data_words * 8:
+                self.leaves.append(("enum", base + op.offset * 2, len(op.enumerants)))
+        elif kind == "group":
+            self.sections(seg, start, data_words, pointers, pointer_words, op.plan)
+        elif kind in ("text", "data", "struct", "list"):
+            if op.offset < pointer_words:
+                self.pointer(seg, pointers + op.offset, op)
+
+    def pointer(self, seg, index, op):
+        target = resolve_pointer(self.segments, seg, index)
+        if target is None:
+            return
+        seg, start, tag = target
+        kind = op.kind
+        if kind == "struct":
+            if tag & 3 == 0:
+                self.struct(seg, start, (tag >> 32) & 0xffff, tag >> 48, op.plan)
+            return
+        if tag & 3 != 1:
+            return
+        element_size = (tag >> 32) & 7
+        count = tag >> 35
+        offset = self.offsets[seg] + start * 8
+        if kind == "text":
+            if element_size == 2 and count > 1:
+                self.leaves.append(("text", offset, count - 1))
+        elif kind == "data":
+            if element_size == 2 and count:
+                self.leaves.append(("data", offset, count))
+        elif kind == "list":
+            self.list(seg, start, element_size, count, op.element)
+
+    def list(self, seg, start, element_size, count, element):
+        kind = element.kind
+        offset = self.offsets[seg] + start * 8
+        if kind == "primitive":
+            if not count:
+                return
+            if element.typestring == "bool":
+                if element_size == 1:
+                    self.leaves.append(("bools", offset, count))
+            elif ELEMENT_BITS.get(element_size) == PRIMITIVE_SIZES[element.typestring] * 8:
+                self.leaves.append(("list", offset, count, element))
+        elif kind == "enum":
+            if count and element_size == 3:
+                self.leaves.append(("enums", offset, count, len(element.enumerants)))
+        elif kind == "struct":
+            if element_size != ELEMENT_COMPOSITE:
+                return
+            elements, data_words, pointer_words = composite_tag(self.segments, seg, start, count)
+            step = data_words + pointer_words
+            for i in range(elements):
+                self.struct(seg, start + 1 + i * step, data_words, pointer_words, element.plan)
+        elif kind in ("text", "data", "list"):
+            if element_size != ELEMENT_POINTER:
+                return
+            for i in range(count):
+                self.pointer(seg, start + i, element)
+
+
+class TemplateNode:
+    def __init__(self, node, templates=16, reshape_rate=0.01):
+        # node is the StructNode the skeletons are generated with
+        self.node = node
+        self.rng = node.rng
+        self.templates = templates
+        self.reshape_rate = reshape_rate
+        self.pool = []
+        # RNG checkpoint the pool was built after
+        self.checkpoint = None
+
+    def generate_bytes(self, packed=False):
+        # A new framed message
+        rng = self.rng
+        checkpoint = rng.message - rng.message % rng.step
+        if checkpoint != self.checkpoint:
+            self.pool = []
+            self.checkpoint = checkpoint
+        pool = self.pool
+        if len(pool) < self.templates or rng.random.random() < self.reshape_rate:
+            data = self.reshape()
+        else:
+            template = pool[rng.getRandom(0, len(pool) - 1)]
+            buf = bytearray(template.data)
+            self.fill(buf, template)
+            rng.advance()
+            data = bytes(buf)
+        if packed:
+            with self.node.node.from_bytes(data) as reader:
+                return reader.as_builder().to_bytes_packed()
+        return data
+
+    def generate(self):
+        # A new message as a builder, like StructNode.generate()
+        with self.node.node.from_bytes(self.generate_bytes()) as reader:
+            return reader.as_builder()
+
+    def generate_at(self, index):
+        # See StructNode.generate_at. The pool has to be rebuilt from the
+        # checkpoint even if it already is at that checkpoint.
+        self.checkpoint = None
+        for _ in range(index - self.rng.seek(index)):
+            self.generate_bytes()
+        return self.generate()
+
+    def reshape(self):
+        # Generates a new skeleton, adds it to the pool (replacing a random
+        # one once the pool is full) and returns its bytes. The slot is picked
+        # first, generate() moves the RNG on to the next message.
+        if len(self.pool) < self.templates:
+            slot = len(self.pool)
+            self.pool.append(None)
+        else:
+            slot = self.rng.getRandom(0, len(self.pool) - 1)
+        data = self.node.generate().to_bytes()
+        self.pool[slot] = self.template(data)
+        return data
+
+    def template(self, data):
+        field_samplers = self.node.field_samplers
+        fields = {}
+        leaves = []
+        for leaf in LeafCollector(data).collect(self.node.plan):
+            if leaf[0] == "primitive":
+                op = leaf[2]
+                fields.setdefault((op.typestring, field_samplers.get(op)), []).append(leaf[1])
+            else:
+                leaves.append(leaf)
+        return Template(data, [(typestring, sampler, offsets) for (typestring, sampler), offsets in fields.items()], leaves)
+
+    def fill(self, buf, template):
+        # Writes fresh values over every leaf of a copied skeleton
+        rng = self.rng
+        field_samplers = self.node.field_samplers
+        for typestring, sampler, offsets in template.fields:
+            values = rng.getList(typestring, len(offsets), sampler)
+            if typestring == "float32":
+                values = [_float32(value) for value in values]
+            pack_into = _structs[typestring].pack_into
+            for offset, value in zip(offsets, values):
+                pack_into(buf, offset, value)
+        for leaf in template.leaves:
+            kind = leaf[0]
+            offset = leaf[1]
+            if kind == "bool":
+                if rng.getBool():
+                    buf[offset] |= leaf[2]
+                else:
+                    buf[offset] &= ~leaf[2] & 0xff
+            elif kind == "enum":
+                _uint16.pack_into(buf, offset, rng.getRandom(0, leaf[2] - 1))
+            elif kind == "text":
+                buf[offset:offset + leaf[2]] = rng.getTextBytes(leaf[2])
+            elif kind == "data":
+                buf[offset:offset + leaf[2]] = rng.getBlob(leaf[2])
+            elif kind == "list":
+                count, element = leaf[2], leaf[3]
+                values = rng.getList(element.typestring, count, field_samplers.get(element))
+                if element.typestring == "float32":
+                    values = [_float32(value) for value in values]
+                struct.pack_into(f"<{count}{FORMATS[element.typestring]}", buf, offset, *values)
+            elif kind == "bools":
+                count = leaf[2]
+                bits = 0
+                for i, value in enumerate(rng.getList("bool", count)):
+                    if value:
+                        bits |= 1 << i
+                buf[offset:offset + (count + 7) // 8] = bits.to_bytes((count + 7) // 8, "little")
+            elif kind == "enums":
+                count, enumerants = leaf[2], leaf[3]
+                struct.pack_into(f"<{count}H", buf, offset, *[rng.getRandom(0, enumerants - 1) for _ in range(count)])
@@ -0,0 +1,110 @@
+import numpy
+
+from .rng import INT_TYPES, codepoint_ranges
+
+"""
+Batched value generation for the numpy RNG backend. RNG.getList() and
+getBlob() otherwise make one Python call per element, each of which draws a
+value from the type's WeightedSampler (see rng.py). Here the sources of a
+whole list are picked with one array draw (uniformly or with the sampler's
+probabilities), then the values of each source are drawn as one array, from
+the source's table (kept as a numpy array on the sampler) or straight from
+its integer range. The distribution is the same as the scalar getters:
+sources are picked by their weights and values within a source are uniform.
+getUTF8() does the same for RNG.getTextBytes: codepoint sizes and values
+are drawn as arrays and encoded straight into a preallocated byte array.
+"""
+
+UNSIGNED = {8: numpy.uint8, 16: numpy.uint16, 32: numpy.uint32, 64: numpy.uint64}
+SIGNED = {8: numpy.int8, 16: numpy.int16, 32: numpy.int32, 64: numpy.int64}
+
+
+def _dtype(typestring):
+    if typestring in INT_TYPES:
+        bits, signed = INT_TYPES[typestring]
+        return SIGNED[bits] if signed else UNSIGNED[bits]
+    return numpy.float64
+
+
+class VectorSampler:
+    def __init__(self, backend):
+        # The backend's generator is looked up on every call since reseeding
+        # replaces it.
+        self.backend = backend
+
+    def getArray(self, typestring, length, sampler=None):
+        generator = self.backend.generator
+        if typestring == "bool":
+            return generator.integers(0, 2, size=length).astype(numpy.bool_)
+        dtype = _dtype(typestring)
+        if sampler.arrays is None:
+            # tables as arrays of the output type, None for ranges
+            sampler.arrays = [
+                None if isinstance(values, range) else numpy.array(values, dtype=dtype)
+                for values in sampler.values
+            ]
+        if sampler.uniform:
+            selector = generator.integers(0, len(sampler.values), size=length)
+        else:
+            selector = generator.choice(len(sampler.values), size=length, p=sampler.probabilities)
+        values = numpy.empty(length, dtype=dtype)
+        for source, table in enumerate(sampler.arrays):
+            index = numpy.flatnonzero(selector == source)
+            if not len(index):
+                continue
+            if table is not None:
+                values[index] = table[generator.integers(0, len(table), size=len(index))]
+            else:
+                bounds = sampler.values[source]
+                draw_type = numpy.int64 if bounds.start < 0 else numpy.uint64
+                values[index] = generator.integers(bounds.start, bounds.stop - 1, endpoint=True, size=len(index), dtype=draw_type)
+        return values
+
+    def getUTF8(self, length):
+        # Same output distribution as RNG._random_utf8_text
+        if length <= 0:
+            return b""
+        generator = self.backend.generator
+        # Codepoints take at least one byte, so `length` sizes are always
+        # enough. Sizes are random until fewer than 4 bytes are left, then
+        # the last codepoint takes up exactly what remains.
+        sizes = generator.integers(1, 5, size=length, dtype=numpy.int64)
+        starts = numpy.cumsum(sizes) - sizes
+        last = int(numpy.searchsorted(starts, length - 3))
+        remaining = length - int(starts[last])
+        sizes = sizes[:last + 1] if remaining else sizes[:last]
+        starts = starts[:len(sizes)]
+        if remaining:
+            sizes[last] = remaining
+
+        output = numpy.empty(length, dtype=numpy.uint8)
+        for size in (1, 2, 3, 4):
+            index = numpy.flatnonzero(sizes == size)
+            if not len(index):
+                continue
+            total, ranges = codepoint_ranges[size]
+            drawn = generator.integers(0, total, size=len(index), dtype=numpy.int64)
+            # map the draws over the ranges, skipping the gaps between them
+            values = drawn + ranges[0][0]
+            below = ranges[0][1]
+            end = ranges[0][0] + ranges[0][1]
+            for start, count in ranges[1:]:
+                values[drawn >= below] += start - end
+                below += count
+                end = start + count
+            pos = starts[index]
+            if size == 1:
+                output[pos] = values
+            elif size == 2:
+                output[pos]     = ((values & 0x07c0) >> 6) | 0xc0
+                output[pos + 1] =  (values & 0x003f)       | 0x80
+            elif size == 3:
+                output[pos]     = ((values & 0xf000) >> 12) | 0xe0
+                output[pos + 1] = ((values & 0x0fc0) >> 6)  | 0x80
+                output[pos + 2] =  (values & 0x003f)        | 0x80
+            else:
+                output[pos]     = ((values & 0x1c0000) >> 18) | 0xf0
+                output[pos + 1] = ((values & 0x03f000) >> 12) | 0x80
+                output[pos + 2] = ((values & 0x000fc0) >> 6)  | 0x80
+                output[pos + 3] =  (values & 0x00003f)        | 0x80
+        return output.tobytes()
@@ -5,5 +5,8 @@ setup(
     packages=find_packages(),
     version='0.1.1',
     description='generate random data for capnp schema',
-    author='IOActive'
+    author='IOActive',
+    extras_require={
+        'numpy': ['numpy'],
+    }
 )
@@ -0,0 +1,13 @@
+import pytest
+from capnp_generator.backends import BACKENDS, make_backend
+from capnp_generator.rng import RNG
+
+
+@pytest.mark.parametrize("backend", sorted(BACKENDS))
+@pytest.mark.parametrize("seed", [0, 1, -1, -(1 << 70), 1 << 100])
+def test_every_backend_takes_the_same_seeds(backend, seed):
+    first = make_backend(backend, seed)
+    second = make_backend(backend, seed)
+    assert [first.randint(0, 1 << 40) for _ in range(8)] == [second.randint(0, 1 << 40) for _ in range(8)]
+    rng = RNG(seed, 100, backend=backend)
+    assert isinstance(rng.getUInt64(), int)
@@ -0,0 +1,23 @@
+from capnp_generator.bench import compare
+
+
+def test_only_speed_regressions_are_counted():
+    baseline = {"results": {"generate:flat-8": {
+        "generate_messages_per_s": 1000, "root_node_s": 0.01,
+        "to_bytes_bytes_per_message": 100, "root_node_cold_cache_s": 0.5, "case_s": 3,
+    }}}
+    report = {"results": {"generate:flat-8": {
+        "generate_messages_per_s": 500, "root_node_s": 0.02,
+        "to_bytes_bytes_per_message": 200, "root_node_cold_cache_s": 1.5, "case_s": 9,
+    }}}
+    lines, regressions = compare(report, baseline, 0.1)
+    assert regressions == 2
+    flagged = {line.split()[2].rstrip(":") for line in lines if line.startswith("REGRESSION")}
+    assert flagged == {"generate_messages_per_s", "root_node_s"}
+    assert len(lines) == 5
+
+
+def test_within_tolerance():
+    baseline = {"results": {"rng:random:text": {"len16_items_per_s": 1000}}}
+    report = {"results": {"rng:random:text": {"len16_items_per_s": 950}}}
+    assert compare(report, baseline, 0.1)[1] == 0
@@ -0,0 +1,68 @@
+import os
+import capnp
+import pytest
+import capnp_generator
+from capnp_generator.budget import Budget
+from capnp_generator.corpus import _load_root
+from capnp_generator.node import RootNode, StructNode
+from capnp_generator.rng import RNG
+
+EXAMPLE = os.path.join(os.path.dirname(capnp_generator.__file__), "example.capnp")
+
+# no union has a struct member, so nothing can go over max_words
+SCHEMA = """
+@0xc5d6e7f8091a2b3c;
+struct Node { value @0 :UInt32; name @1 :Text; children @2 :List(Node); attrs @3 :List(Attr); blob @4 :Data; }
+struct Attr { key @0 :Text; values @1 :List(UInt64); flags @2 :List(Bool); sub @3 :Node; }
+"""
+
+
+@pytest.fixture(scope="module")
+def example():
+    return _load_root(EXAMPLE, None)
+
+
+@pytest.fixture
+def tree(tmp_path):
+    path = tmp_path / "tree.capnp"
+    path.write_text(SCHEMA)
+    return RootNode(capnp.SchemaParser().load(str(path)))
+
+
+@pytest.mark.parametrize("type_name", ["Person", "Company", "ExposesInternalStructs"])
+def test_usage_matches_message_size(example, type_name):
+    node = StructNode(example.structs_by_name[type_name], example, RNG(1, 1000), budget=Budget(max_words=1 << 30))
+    for _ in range(100):
+        msg = node.generate()
+        # total_size leaves out the root pointer
+        assert node.usage.words == msg.total_size.word_count + 1
+
+
+def test_usage_matches_message_size_with_lists(tree):
+    node = StructNode(tree.structs_by_name["Node"], tree, RNG(2, 1000), budget=Budget(max_words=4096, max_list_length=8))
+    for _ in range(100):
+        msg = node.generate()
+        assert node.usage.words == msg.total_size.word_count + 1
+
+
+@pytest.mark.parametrize("max_words", [16, 64, 256, 1024])
+def test_messages_stay_within_max_words(tree, max_words):
+    node = StructNode(tree.structs_by_name["Node"], tree, RNG(3, 1000), budget=Budget(max_words=max_words))
+    sizes = [node.generate().total_size.word_count + 1 for _ in range(100)]
+    assert max(sizes) <= max_words
+    # and the budget is used, not just respected
+    assert max(sizes) > max_words // 2
+
+
+def test_depth_and_list_limits(tree):
+    budget = Budget(max_depth=2, max_list_length=3, max_elements=10)
+    node = StructNode(tree.structs_by_name["Node"], tree, RNG(4, 1000), budget=budget)
+
+    def depth(msg):
+        below = [depth(child) for child in msg.children] + [depth(attr.sub) for attr in msg.attrs if attr._has("sub")]
+        return 1 + max(below, default=0)
+
+    for _ in range(100):
+        msg = node.generate()
+        assert len(msg.children) <= 3 and len(msg.attrs) <= 3
+        assert depth(msg) <= 3
@@ -0,0 +1,70 @@
+import os
+import shutil
+import pytest
+import capnp_generator
+from capnp_generator import cache
+from capnp_generator.corpus import _load_root
+from capnp_generator.node import StructNode
+from capnp_generator.rng import RNG
+
+PACKAGE = os.path.dirname(capnp_generator.__file__)
+
+
+@pytest.fixture
+def schema(tmp_path):
+    # a copy of the example schemas, so that they can be edited
+    directory = tmp_path / "schemas"
+    directory.mkdir()
+    for name in ("example.capnp", "example_import.capnp"):
+        shutil.copy(os.path.join(PACKAGE, name), directory / name)
+    return str(directory / "example.capnp")
+
+
+def generated(root_node, type_name):
+    node = StructNode(root_node.structs_by_name[type_name], root_node, RNG(0x1234, 1000))
+    return [node.generate().to_bytes() for _ in range(20)]
+
+
+def test_warm_cache_gives_the_same_index(schema, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    assert cache.load_index(cache_dir, schema) is None
+    cold = _load_root(schema, cache_dir)
+    assert cache.load_index(cache_dir, schema) is not None
+    warm = _load_root(schema, cache_dir)
+    assert warm.dump_types() == cold.dump_types()
+    assert warm.struct_names == cold.struct_names
+    assert list(warm.structs_by_id) == list(cold.structs_by_id)
+    assert warm.enum_names == cold.enum_names
+    assert warm.interface_names == cold.interface_names
+    assert warm.import_paths == cold.import_paths
+    assert sorted(warm.plans) == sorted(cold.plans)
+    for type_name in ("Person", "Company", "Date"):
+        assert generated(warm, type_name) == generated(cold, type_name)
+
+
+@pytest.mark.parametrize("edited", ["example.capnp", "example_import.capnp"])
+def test_editing_a_schema_file_invalidates_the_entry(schema, tmp_path, edited):
+    cache_dir = str(tmp_path / "cache")
+    _load_root(schema, cache_dir)
+    assert cache.load_index(cache_dir, schema) is not None
+    with open(os.path.join(os.path.dirname(schema), edited), "a") as f:
+        f.write("\nstruct Added { value @0 :UInt8; }\n")
+    assert cache.load_index(cache_dir, schema) is None
+    # rebuilt from the edited files, and cached again
+    rebuilt = _load_root(schema, cache_dir)
+    assert "Added" in rebuilt.struct_names
+    warm = _load_root(schema, cache_dir)
+    assert cache.load_index(cache_dir, schema) is not None
+    assert warm.dump_types() == rebuilt.dump_types()
+
+
+def test_stale_or_broken_entries_are_ignored(schema, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    _load_root(schema, cache_dir)
+    entry = cache._entry_path(cache_dir, schema)
+    with open(entry, "w") as f:
+        f.write("{not json")
+    assert cache.load_index(cache_dir, schema) is None
+    # rebuilt and stored again
+    _load_root(schema, cache_dir)
+    assert cache.load_index(cache_dir, schema) is not None
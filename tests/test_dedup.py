@@ -0,0 +1,120 @@
+import capnp
+import pytest
+from capnp_generator.dedup import BloomFilter, Deduplicator, FingerprintSet, ShapeHasher, iter_distinct
+from capnp_generator.node import RootNode, StructNode
+from capnp_generator.plan import compile_struct
+from capnp_generator.rng import RNG
+
+SCHEMA = """
+@0xd6e7f8091a2b3c4d;
+enum Color { red @0; green @1; blue @2; }
+struct Item { id @0 :UInt32; label @1 :Text; }
+struct Shape {
+  value @0 :UInt64;
+  name @1 :Text;
+  color @2 :Color;
+  items @3 :List(Item);
+  numbers @4 :List(UInt16);
+  kind :union {
+    none @5 :Void;
+    item @6 :Item;
+    count @7 :UInt8;
+  }
+}
+"""
+
+
+@pytest.fixture
+def root_node(tmp_path):
+    path = tmp_path / "shape.capnp"
+    path.write_text(SCHEMA)
+    return RootNode(capnp.SchemaParser().load(str(path)))
+
+
+def shape(root_node, value=1, name="abcd", color="red", items=2, numbers=3, kind="none"):
+    msg = root_node.structs_by_name["Shape"].new_message(value=value, color=color)
+    if name is not None:
+        msg.name = name
+    if items is not None:
+        for i, item in enumerate(msg.init("items", items)):
+            item.id = value + i
+            item.label = name or ""
+    msg.numbers = [value % 7] * numbers
+    if kind == "item":
+        msg.kind.init("item").id = value
+    elif kind == "count":
+        msg.kind.count = value % 200
+    return msg.to_bytes()
+
+
+# the same shape as shape(root_node): other values, same length buckets
+SAME = [
+    dict(value=99),
+    dict(value=12345, name="wxyz"),
+    dict(name="abcdefg"),
+    dict(numbers=2),
+]
+
+# each one differs from shape(root_node) in one aspect of the shape
+DIFFERENT = [
+    dict(name=None),
+    dict(name="a much longer name"),
+    dict(color="blue"),
+    dict(items=None),
+    dict(items=5),
+    dict(numbers=9),
+    dict(kind="item"),
+    dict(kind="count"),
+]
+
+
+@pytest.fixture(params=["set", "bloom"])
+def seen(request):
+    return FingerprintSet(1000) if request.param == "set" else BloomFilter(1000, 0.0001)
+
+
+def test_duplicate_shapes_are_dropped(root_node, seen):
+    dedup = Deduplicator(compile_struct(root_node.structs_by_name["Shape"], root_node), seen)
+    assert dedup.add(shape(root_node))
+    for changes in SAME:
+        assert not dedup.add(shape(root_node, **changes)), changes
+    assert (dedup.kept, dedup.dropped) == (1, len(SAME))
+
+
+def test_distinct_shapes_are_kept(root_node, seen):
+    dedup = Deduplicator(compile_struct(root_node.structs_by_name["Shape"], root_node), seen)
+    assert dedup.add(shape(root_node))
+    for changes in DIFFERENT:
+        assert dedup.add(shape(root_node, **changes)), changes
+    # and each of them only once
+    for changes in DIFFERENT:
+        assert not dedup.add(shape(root_node, value=7, **changes)), changes
+    assert dedup.kept == len(DIFFERENT) + 1
+    assert len(seen) == len(DIFFERENT) + 1
+
+
+def test_fingerprints_are_stable(root_node):
+    plan = compile_struct(root_node.structs_by_name["Shape"], root_node)
+    data = shape(root_node, kind="item")
+    assert ShapeHasher(plan).fingerprint(data) == ShapeHasher(plan).fingerprint(data)
+
+
+def test_fingerprint_set_capacity():
+    seen = FingerprintSet(4)
+    assert all(seen.add(i) for i in range(10))
+    assert len(seen) <= 4
+    # the most recent ones are still remembered
+    assert not seen.add(9)
+
+
+def test_iter_distinct_indices_replay(root_node):
+    node = StructNode(root_node.structs_by_name["Shape"], root_node, RNG(5, 100), max_expansions=8)
+    plan = node.plan
+    dedup = Deduplicator(plan, FingerprintSet(1000))
+    kept = list(iter_distinct(node, dedup, count=300))
+    assert 0 < len(kept) < 300
+    fingerprints = [ShapeHasher(plan).fingerprint(data) for _, data in kept]
+    assert len(set(fingerprints)) == len(kept)
+    replay = StructNode(root_node.structs_by_name["Shape"], root_node, RNG(5, 100), max_expansions=8)
+    for index, data in kept[-5:]:
+        assert replay.generate_at(index).to_bytes() == data
@@ -0,0 +1,75 @@
+import asyncio
+import capnp
+import pytest
+from capnp_generator.driver import TrafficDriver, stand_in
+from capnp_generator.node import RootNode, StructNode
+from capnp_generator.rng import RNG
+
+SCHEMA = """
+@0xf2a3b4c5d6e7f809;
+struct Sample { id @0 :UInt32; name @1 :Text; data @2 :List(UInt16); }
+"""
+
+
+@pytest.fixture
+def node(tmp_path):
+    path = tmp_path / "sample.capnp"
+    path.write_text(SCHEMA)
+    root_node = RootNode(capnp.SchemaParser().load(str(path)))
+    return StructNode(root_node.structs_by_name["Sample"], root_node, RNG(0x1234, 1000))
+
+
+def drive(node, tmp_path, count, pipeline, crash_after=None):
+    target = ("unix", str(tmp_path / "target.sock"))
+
+    async def run():
+        server = await stand_in(target, crash_after)
+        try:
+            driver = TrafficDriver(node, [target], count=count, pipeline=pipeline,
+                                   response="frame", reconnect_delay=0.001)
+            await asyncio.wait_for(driver.run(), 30)
+            return driver
+        finally:
+            server.close()
+
+    return asyncio.run(run())
+
+
+def test_round_trip(node, tmp_path):
+    driver = drive(node, tmp_path, count=200, pipeline=4)
+    assert driver.crashes == []
+    assert driver.sent == driver.answered == 200
+
+
+@pytest.mark.parametrize("pipeline", [1, 8])
+def test_crashes_are_recorded_and_run_returns(node, tmp_path, pipeline):
+    # the last message is a crash, so with pipeline > 1 a connection fails
+    # after it already took its end marker off the queue
+    driver = drive(node, tmp_path, count=500, pipeline=pipeline, crash_after=50)
+    assert driver.crashes
+    assert driver.sent == 500
+    indices = [index for crash in driver.crashes for index in crash["indices"]]
+    assert len(indices) == len(set(indices))
+    assert all(0 <= index < 500 for index in indices)
+    # every message was either answered or recorded as in flight
+    assert driver.answered + len(indices) == 500
+    for crash in driver.crashes:
+        assert crash["seed"] == 0x1234
+        assert crash["step"] == 1000
+        assert crash["error"]
+
+
+def test_generation_error_ends_the_run(node, tmp_path):
+    generate = node.generate
+    generated = 0
+
+    def fail_after_some():
+        nonlocal generated
+        generated += 1
+        if generated > 30:
+            raise RuntimeError("generation failed")
+        return generate()
+
+    node.generate = fail_after_some
+    with pytest.raises(RuntimeError, match="generation failed"):
+        drive(node, tmp_path, count=100, pipeline=4)
@@ -0,0 +1,52 @@
+import capnp
+from capnp_generator.node import RootNode, StructNode
+from capnp_generator.rng import RNG
+
+MAIN = """
+@0xc3a1f2e4b5d60719;
+using Shared = import "shared.capnp";
+struct Event { when @0 :Shared.Stamp; kind @1 :Shared.Kind; }
+"""
+
+SHARED = """
+@0xd4b2e3f5c6a7081a;
+enum Kind { start @0; stop @1; }
+struct Stamp { seconds @0 :UInt64; }
+"""
+
+
+def write_schema(directory):
+    directory.mkdir()
+    (directory / "shared.capnp").write_text(SHARED)
+    (directory / "main.capnp").write_text(MAIN)
+
+
+def test_schema_can_be_loaded_again_after_root_node(tmp_path, monkeypatch):
+    # imports used to stay registered with the global schema parser, under a
+    # name relative to the import search path. Loading the file again imports
+    # them under a different name, which aborted the interpreter with
+    # "Duplicate ID".
+    write_schema(tmp_path / "schemas")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.chdir(tmp_path / "schemas")
+    path = "main.capnp"
+    try:
+        root_node = RootNode(capnp.load(path))
+        assert {"Event", "Stamp"} <= set(root_node.struct_names)
+        assert "Kind" in root_node.enum_names
+        schema = capnp.load(path)
+        assert schema.Event.schema.node.id == root_node.structs_by_name["Event"].schema.node.id
+        node = StructNode(root_node.structs_by_name["Event"], root_node, RNG(1, 100))
+        node.generate().to_bytes()
+    finally:
+        capnp.lib.capnp.cleanup_global_schema_parser()
+
+
+def test_copies_of_an_import_at_two_paths(tmp_path):
+    # the same files (and so the same IDs) imported from two directories
+    roots = []
+    for name in ("first", "second"):
+        write_schema(tmp_path / name)
+        roots.append(RootNode(capnp.SchemaParser().load(str(tmp_path / name / "main.capnp"))))
+    for root_node in roots:
+        assert "Stamp" in root_node.struct_names
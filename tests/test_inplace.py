@@ -0,0 +1,189 @@
+import struct
+import capnp
+import pytest
+from capnp_generator.dedup import ShapeHasher
+from capnp_generator.inplace import InPlaceMutator, MalformedMessage, iter_frames, resolve_pointer
+from capnp_generator.node import RootNode
+from capnp_generator.plan import compile_struct
+from capnp_generator.rng import RNG
+from capnp_generator.template import LeafCollector
+
+SCHEMA = """
+@0xb3c4d5e6f708192a;
+struct Inner { x @0 :UInt32; name @1 :Text; }
+struct Outer { value @0 :UInt64; inner @1 :Inner; items @2 :List(UInt16); children @3 :List(Inner); }
+"""
+
+
+@pytest.fixture
+def root_node(tmp_path):
+    path = tmp_path / "far.capnp"
+    path.write_text(SCHEMA)
+    return RootNode(capnp.SchemaParser().load(str(path)))
+
+
+def frame(*segments):
+    header = struct.pack(f"<{len(segments) + 1}I", len(segments) - 1, *(len(s) // 8 for s in segments))
+    if len(header) % 8:
+        header += b"\0" * 4
+    return header + b"".join(segments)
+
+
+def build(root_node, **kwargs):
+    msg = root_node.structs_by_name["Outer"].new_message(**kwargs)
+    msg.value = 5
+    inner = msg.init("inner")
+    inner.x = 7
+    inner.name = "hello"
+    msg.items = [1, 2, 3]
+    return msg.to_bytes()
+
+
+def single_far(root_node):
+    # one small segment per object, the allocator links them with single
+    # far pointers whose landing pads sit next to the objects
+    return build(root_node, num_first_segment_words=1, allocate_seg_callable=lambda words: bytearray(words * 8))
+
+
+def double_far(root_node):
+    # The root struct (and everything after it) moved to segment 2, reached
+    # through a double far root pointer to a landing pad in segment 1
+    data = build(root_node)
+    (segment,) = next(iter_frames(data))
+    root = struct.unpack_from("<Q", segment, 0)[0]
+    assert root & 0xfffffffc == 0
+    return frame(
+        struct.pack("<Q", 2 | 1 << 2 | 1 << 32),
+        struct.pack("<QQ", 2 | 2 << 32, root),
+        bytes(segment[8:]),
+    )
+
+
+@pytest.mark.parametrize("make", [single_far, double_far])
+def test_far_pointers_are_followed(root_node, make):
+    data = make(root_node)
+    segments = next(iter_frames(data))
+    assert len(segments) > 1
+    assert resolve_pointer(segments, 0, 0)[0] != 0
+    with root_node.structs_by_name["Outer"].from_bytes(data) as reader:
+        assert reader.inner.name == "hello"
+    plan = compile_struct(root_node.structs_by_name["Outer"], root_node)
+    leaves = LeafCollector(data).collect(plan)
+    # primitive leaves by field name, the others by kind
+    values = {leaf[2].name if leaf[0] == "primitive" else leaf[0]: leaf for leaf in leaves}
+    assert struct.unpack_from("<Q", data, values["value"][1])[0] == 5
+    assert struct.unpack_from("<I", data, values["x"][1])[0] == 7
+    _, offset, length = values["text"]
+    assert data[offset:offset + length] == b"hello"
+    _, offset, count, _ = values["list"]
+    assert struct.unpack_from(f"<{count}H", data, offset) == (1, 2, 3)
+
+
+@pytest.mark.parametrize("make", [single_far, double_far])
+def test_mutation_through_far_pointers(root_node, make):
+    data = make(root_node)
+    buf = bytearray(data)
+    mutator = InPlaceMutator(root_node, RNG(1, 1000), prob_field=1.0)
+    for _ in range(20):
+        assert mutator.mutate_buffer(buf, "Outer") == 1
+    assert len(buf) == len(data)
+    assert buf != data
+    with root_node.structs_by_name["Outer"].from_bytes(bytes(buf)) as reader:
+        assert len(reader.inner.name) == 5
+        assert len(reader.items) == 3
+
+
+def test_several_messages(root_node):
+    data = build(root_node) + single_far(root_node) + double_far(root_node)
+    assert len(list(iter_frames(data))) == 3
+
+
+@pytest.mark.parametrize("cut", [1, 3, 4, 6])
+def test_truncated_segment_table(root_node, cut):
+    data = build(root_node) + single_far(root_node)
+    first = len(build(root_node))
+    with pytest.raises(MalformedMessage):
+        list(iter_frames(data[:first + cut]))
+
+
+def test_truncated_segment(root_node):
+    data = single_far(root_node)
+    with pytest.raises(MalformedMessage):
+        list(iter_frames(data[:-8]))
+
+
+@pytest.mark.parametrize("root", [
+    2 | 7 << 32,            # single far to a missing segment
+    2 | 100 << 3,           # single far past the end of segment 0
+    2 | 1 << 2 | 7 << 32,   # double far to a missing segment
+])
+def test_bad_far_pointers(root_node, root):
+    data = frame(struct.pack("<QQ", root, 0))
+    with pytest.raises(MalformedMessage):
+        InPlaceMutator(root_node, RNG(1, 1000)).mutate_buffer(bytearray(data), "Outer")
+
+
+def struct_pointer(offset, data_words, pointer_words):
+    return (offset & 0x3fffffff) << 2 | data_words << 32 | pointer_words << 48
+
+
+def walkers(root_node):
+    # every walker of the wire format, as functions of the framed bytes
+    plan = compile_struct(root_node.structs_by_name["Outer"], root_node)
+    return [
+        lambda data: InPlaceMutator(root_node, RNG(1, 1000), prob_field=1.0).mutate_buffer(bytearray(data), "Outer"),
+        lambda data: LeafCollector(data).collect(plan),
+        lambda data: ShapeHasher(plan).fingerprint(data),
+    ]
+
+
+@pytest.mark.parametrize("offset", [
+    -3,     # before the start of the segment
+    2,      # the struct runs past the end of the segment
+])
+def test_pointer_target_out_of_bounds(root_node, offset):
+    segment = struct.pack("<4Q", struct_pointer(offset, 2, 0), 1, 2, 3)
+    data = frame(segment)
+    for walk in walkers(root_node):
+        with pytest.raises(MalformedMessage):
+            walk(data)
+
+
+def composite_message(root_node):
+    # a message with only a List(Inner) and the word index of its tag
+    msg = root_node.structs_by_name["Outer"].new_message()
+    children = msg.init("children", 2)
+    children[0].x = 1
+    children[1].x = 2
+    data = msg.to_bytes()
+    segments = next(iter_frames(data))
+    _, start, tag = resolve_pointer(segments, 0, 0)
+    pointers = start + ((tag >> 32) & 0xffff)
+    _, list_start, _ = resolve_pointer(segments, 0, pointers + 2)
+    return bytes(segments[0]), list_start
+
+
+def test_composite_list(root_node):
+    segment, _ = composite_message(root_node)
+    for walk in walkers(root_node):
+        walk(frame(segment))
+
+
+def test_truncated_composite_list(root_node):
+    segment, tag_index = composite_message(root_node)
+    for end in (tag_index, tag_index + 2):
+        data = frame(segment[:end * 8])
+        for walk in walkers(root_node):
+            with pytest.raises(MalformedMessage):
+                walk(data)
+
+
+def test_composite_tag_larger_than_list(root_node):
+    segment, tag_index = composite_message(root_node)
+    tag = struct.unpack_from("<Q", segment, tag_index * 8)[0]
+    # claim 5 elements instead of 2
+    tag = tag & ~(0x3fffffff << 2) | 5 << 2
+    data = frame(segment[:tag_index * 8] + struct.pack("<Q", tag) + segment[tag_index * 8 + 8:])
+    for walk in walkers(root_node):
+        with pytest.raises(MalformedMessage):
+            walk(data)
@@ -0,0 +1,36 @@
+import capnp
+from capnp_generator.node import MAX_EXPANSIONS, RootNode, StructNode
+from capnp_generator.rng import RNG
+
+SCHEMA = """
+@0xe1c2a3b4d5f60718;
+struct Node { value @0 :UInt32; children @1 :List(Node); attrs @2 :List(Attr); }
+struct Attr { name @0 :Text; sub @1 :Node; }
+struct Tree { value @0 :UInt32; children @1 :List(List(Tree)); }
+"""
+
+
+def load(tmp_path):
+    path = tmp_path / "recursive.capnp"
+    path.write_text(SCHEMA)
+    return RootNode(capnp.SchemaParser().load(str(path)))
+
+
+def count_trees(tree):
+    return 1 + sum(count_trees(child) for children in tree.children for child in children)
+
+
+def test_nested_list_recursion_is_bounded(tmp_path):
+    # every element of a recursive list is expanded, so only the per
+    # message cap keeps List(List(Tree)) from growing exponentially
+    root_node = load(tmp_path)
+    node = StructNode(root_node.structs_by_name["Tree"], root_node, RNG(1, 1000))
+    for _ in range(50):
+        assert count_trees(node.generate()) <= MAX_EXPANSIONS + 1
+
+
+def test_list_and_field_recursion_is_bounded(tmp_path):
+    root_node = load(tmp_path)
+    node = StructNode(root_node.structs_by_name["Node"], root_node, RNG(1, 1000), max_expansions=16)
+    for _ in range(50):
+        assert node.generate().total_size.word_count < 16 * 64
@@ -0,0 +1,68 @@
+import pytest
+from capnp_generator.backends import BACKENDS
+from capnp_generator.instrument import Instrumentation
+from capnp_generator.rng import RNG, default_sources, make_sampler
+
+DICTIONARY = [0xdeadbeef, 0xcafebabe]
+# only the range and the dictionary, 1:3
+WEIGHTS = {"special": 0, "chars": 0, "shorts": 0, "ints": 0, "range": 1, "dictionary": 3}
+
+
+@pytest.mark.parametrize("backend", sorted(BACKENDS))
+def test_dictionary_weight(backend):
+    rng = RNG(0x1234, 1000, backend=backend)
+    rng.set_values("uint32", WEIGHTS, DICTIONARY)
+    draws = 20000
+    values = [rng.getUInt32() for _ in range(draws // 2)] + rng.getList("uint32", draws // 2)
+    hits = [sum(value == word for value in values) for word in DICTIONARY]
+    assert sum(hits) / draws == pytest.approx(0.75, abs=0.02)
+    # values within a source are equally likely
+    assert hits[0] / sum(hits) == pytest.approx(0.5, abs=0.03)
+
+
+def test_sampler_proportions():
+    sampler = make_sampler("uint8", {"special": 0, "chars": 0, "range": 1, "dictionary": 1}, [0x7f])
+    assert sampler.probabilities == [0.5, 0.5]
+    rng = RNG(7, 1000)
+    hits = sum(sampler.sample(rng.random) == 0x7f for _ in range(10000))
+    # half from the dictionary, plus the range hitting 0x7f 1 in 256 times
+    assert hits / 10000 == pytest.approx(0.5 + 0.5 / 256, abs=0.02)
+
+
+def test_unknown_source():
+    with pytest.raises(ValueError):
+        make_sampler("uint8", {"qwords": 1})
+
+
+@pytest.mark.parametrize("backend", sorted(BACKENDS))
+def test_int16_values_are_signed_16_bit(backend):
+    rng = RNG(0x1234, 1000, backend=backend)
+    values = [rng.getInt16() for _ in range(5000)] + rng.getList("int16", 5000)
+    assert all(-(1 << 15) <= value < 1 << 15 for value in values)
+    assert min(values) < 0 < max(values)
+    for name, source in default_sources("int16"):
+        assert all(-(1 << 15) <= value < 1 << 15 for value in source), name
+
+
+def test_text_getters():
+    rng = RNG(9, 1000)
+    text = rng.getText(12)
+    assert isinstance(text, str)
+    data = rng.getTextBytes(12)
+    assert isinstance(data, bytes) and len(data) == 12 and data.endswith(b"\0")
+    data[:-1].decode("utf-8")
+    texts = rng.getTextsBytes(5, 8)
+    assert len(texts) == 5
+    assert all(isinstance(data, bytes) and len(data) == 8 for data in texts)
+
+
+def test_text_getters_are_instrumented():
+    rng = RNG(9, 1000)
+    instrumentation = Instrumentation()
+    instrumentation.attach_rng(rng)
+    rng.getTextsBytes(3, 8)
+    getters = instrumentation.stats.getters
+    assert getters["getTextsBytes"].bytes == 24
+    # the getTextBytes calls inside are counted, but their bytes only once
+    assert getters["getTextBytes"].calls == 3
+    assert instrumentation.bytes == 24
@@ -0,0 +1,38 @@
+import asyncio
+import os
+import capnp
+import capnp_generator
+from capnp_generator.corpus import _load_root
+from capnp_generator.rng import RNG
+from capnp_generator.rpc import InterfaceNode, call_batch, connect, stand_in
+
+EXAMPLE = os.path.join(os.path.dirname(capnp_generator.__file__), "example.capnp")
+
+
+def test_call_batch_through_stand_in(tmp_path):
+    root_node = _load_root(EXAMPLE, None)
+    interface = root_node.interfaces_by_name["TestInterface"]
+    calls = InterfaceNode(interface, root_node, RNG(1, 1000))
+    results = InterfaceNode(interface, root_node, RNG(2, 1000))
+    target = ("unix", str(tmp_path / "service.sock"))
+
+    async def run():
+        server = await stand_in(results, target)
+        try:
+            client = await connect(target, interface)
+            return await call_batch(client, calls, 200, pipeline=8)
+        finally:
+            server.close()
+
+    assert asyncio.run(capnp.run(run())) == []
+    assert calls.rng.message == 200
+
+
+def test_generate_call_at_replays_calls():
+    root_node = _load_root(EXAMPLE, None)
+    interface = root_node.interfaces_by_name["TestInterface"]
+    node = InterfaceNode(interface, root_node, RNG(3, 16))
+    calls = [msg.to_bytes() for _, msg in node.generate_calls(40)]
+    replay = InterfaceNode(interface, root_node, RNG(3, 16))
+    for index in (0, 17, 39):
+        assert replay.generate_call_at(index)[1].to_bytes() == calls[index]
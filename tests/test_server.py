@@ -0,0 +1,98 @@
+import asyncio
+import os
+import threading
+import pytest
+import capnp_generator
+from capnp_generator.corpus import DEFAULT_STEP
+from capnp_generator.node import StructNode
+from capnp_generator.rng import RNG
+from capnp_generator.server import Client, GeneratorServer, RequestError
+from capnp_generator.stream import iter_messages
+
+EXAMPLE = os.path.join(os.path.dirname(capnp_generator.__file__), "example.capnp")
+
+
+@pytest.fixture(scope="module")
+def server():
+    return GeneratorServer([EXAMPLE])
+
+
+@pytest.fixture
+def address(server, tmp_path):
+    # serves `server` from an event loop in a background thread
+    path = str(tmp_path / "generator.sock")
+    loop = asyncio.new_event_loop()
+    listening = loop.run_until_complete(server.start_unix(path))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield path
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    listening.close()
+    loop.run_until_complete(listening.wait_closed())
+    loop.close()
+
+
+def local_messages(server, type, seed, count, start=0):
+    root_node = next(iter(server.roots.values()))
+    node = StructNode(root_node.structs_by_name[type], root_node, RNG(seed, DEFAULT_STEP))
+    return list(iter_messages(node, count, start=start))
+
+
+@pytest.mark.parametrize("start", [0, 5, 1500])
+def test_messages_match_iter_messages(server, address, start):
+    with Client(address) as client:
+        messages = list(client.messages("Person", seed=0x1234, count=20, start=start))
+    assert messages == local_messages(server, "Person", 0x1234, 20, start)
+
+
+def test_requests_on_one_connection(server, address):
+    with Client(address) as client:
+        first = list(client.messages("Company", seed=7, count=3))
+        second = list(client.messages("Date", seed=7, count=4, length_prefix=True))
+    assert first == local_messages(server, "Company", 7, 3)
+    assert second == local_messages(server, "Date", 7, 4)
+
+
+@pytest.mark.parametrize("request_", [
+    {"start": -1},
+    {"start": "10"},
+    {"count": -1},
+    {"type": "Nope"},
+    {"framing": "json"},
+    {"start": 3, "step": 0},
+    {"step": "1000"},
+    {"budget": {"max_words": "x"}},
+    {"budget": {"max_depth": -1}},
+    {"budget": {"max_bytes": 10}},
+    {"budget": 5},
+    {"templates": {"templates": 0}},
+    {"templates": {"reshape_rate": "often"}},
+    {"templates": {"templates": None}},
+])
+def test_bad_requests_are_answered_with_an_error(address, request_):
+    request = {"type": "Person", "count": 1}
+    request.update(request_)
+    with Client(address) as client:
+        with pytest.raises(RequestError):
+            list(client.messages(**request))
+        # the connection stays usable
+        assert len(list(client.messages("Date", count=2))) == 2
+
+
+def test_generation_errors_are_answered_before_the_count(server, address, monkeypatch):
+    # a request that passes validation but fails to generate
+    def fail(*args, **kwargs):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(StructNode, "generate", fail)
+    with Client(address) as client:
+        with pytest.raises(RequestError, match="boom"):
+            list(client.messages("Date", count=2))
+
+
+def test_budget_and_templates(server, address):
+    with Client(address) as client:
+        budgeted = list(client.messages("Person", count=5, budget={"max_words": 64, "max_depth": None}))
+        templated = list(client.messages("Person", count=5, templates={"templates": 2, "reshape_rate": 0.5}))
+    assert len(budgeted) == len(templated) == 5